@@ -0,0 +1,215 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import final_project
+from final_project import AppContext, SearchResult, SEARCH_CACHE, GooglePlacesGeocoder, parse_university_search, process_university_search, create_database, render_search_results, get_start_sites, geocode_universities
+from synthetic import SyntheticUniversities
+from fixture_server import FixtureServer
+
+# times searches, database builds, crawling, geocoding and result rendering against synthetic data, and writes the timings as json
+# run with --help for options, timings from two runs can be compared with --compare
+
+# the value each filter is searched with, every combination of them is timed
+SEARCH_FILTERS = {'state' : 'state=NY', 'major' : 'major=computer_science', 'tuition' : 'tuition=30000', 'acceptance' : 'acceptance=10-50',
+                  'gpa' : 'gpa=3.5', 'near' : 'near=40.71,-74.0 radius=300'}
+# number of results rendered to the results page
+RENDER_SIZES = [10, 1000, 10000]
+# slowdowns past this ratio are reported by --compare
+REGRESSION_RATIO = 1.2
+
+# takes a function and a number of runs, returns its last value and the seconds each run took
+def time_runs(function, runs):
+    value = None
+    times = []
+    for run in range(runs):
+        start = time.perf_counter()
+        value = function()
+        times.append(time.perf_counter() - start)
+    return value, times
+
+# takes run times in seconds, returns their summary in milliseconds
+def timing(times):
+    ordered = sorted(times)
+    return {'runs' : len(times), 'min_ms' : ordered[0] * 1000, 'median_ms' : ordered[len(ordered) // 2] * 1000,
+            'mean_ms' : sum(times) / len(times) * 1000, 'max_ms' : ordered[-1] * 1000}
+
+# takes a number of universities, a seed and a directory, returns the path of a synthetic database of that size
+# databases are kept in the directory and reused by later runs with the same size and seed
+def synthetic_database(scale, seed, directory):
+    path = os.path.join(directory, f'synthetic-{scale}-{seed}.db')
+    if not os.path.exists(path):
+        SyntheticUniversities(scale, seed).write_database(path + '.partial')
+        os.replace(path + '.partial', path)
+    return path
+
+# yields every non-empty combination of SEARCH_FILTERS as (filter names, search command)
+def search_commands():
+    names = list(SEARCH_FILTERS)
+    for size in range(1, len(names) + 1):
+        for combination in itertools.combinations(names, size):
+            yield '+'.join(combination), ' '.join(['search'] + [SEARCH_FILTERS[name] for name in combination])
+
+# takes an AppContext over a database, returns timings of every search through sql and through the snapshot
+def benchmark_searches(context, scale, runs):
+    entries = []
+    session = context.session
+
+    def sql_search(command):
+        SEARCH_CACHE.clear()
+        return process_university_search(command, session)
+
+    snapshot, times = time_runs(lambda: final_project.UniversitySnapshot.load(session), 1)
+    entries.append(dict(benchmark = 'snapshot_load', scale = scale, **timing(times)))
+    for filters, command in search_commands():
+        params = parse_university_search(command)
+        results, times = time_runs(lambda: sql_search(command), runs)
+        entries.append(dict(benchmark = 'search', scale = scale, path = 'sql', filters = filters, rows = len(results), **timing(times)))
+        results, times = time_runs(lambda: snapshot.search(params), runs)
+        entries.append(dict(benchmark = 'search', scale = scale, path = 'snapshot', filters = filters, rows = len(results), **timing(times)))
+    return entries
+
+# takes a number of universities, returns timings of create_database over a cache of that many synthetic pages
+def benchmark_build(scale, seed, workers, runs):
+    directory = tempfile.mkdtemp()
+    context = AppContext(os.path.join(directory, 'universities.db'), os.path.join(directory, 'cache.db'))
+    SyntheticUniversities(scale, seed).fill_cache(context)
+    saved = final_project.APP
+    final_project.APP = context
+    try:
+        loaded, times = time_runs(lambda: create_database(workers = workers, offline = True, clear = True), runs)
+    finally:
+        final_project.APP = saved
+        context.close()
+    entry = dict(benchmark = 'create_database', scale = scale, workers = workers, rows = loaded, **timing(times))
+    entry['universities_per_second'] = scale / (entry['median_ms'] / 1000)
+    return [entry]
+
+# takes a number of browse pages, returns timings of crawling them and geocoding their universities from a fixture server
+# answering every request after latency seconds
+def benchmark_crawl(pages, per_page, workers, latency, seed):
+    entries = []
+    directory = tempfile.mkdtemp()
+    context = AppContext(os.path.join(directory, 'universities.db'), os.path.join(directory, 'cache.db'))
+    saved = final_project.APP, final_project.PRINCETON_REVIEW_URL
+    with FixtureServer(pages * per_page, per_page, latency = latency, seed = seed) as server:
+        final_project.APP, final_project.PRINCETON_REVIEW_URL = context, server.princeton_review_url
+        try:
+            crawled, times = time_runs(lambda: get_start_sites(pages, workers = workers, rate = 0), 1)
+            requests = sum(server.stats()['requests'].values())
+            entries.append(dict(benchmark = 'crawl', pages = pages, workers = workers, latency_ms = latency * 1000, rows = len(context.links),
+                                requests = requests, requests_per_second = requests / times[0], **timing(times)))
+            context.geocoder = GooglePlacesGeocoder(key = 'benchmark', url = server.places_url)
+            names = [server.universities.university(index)[0].name for index in range(len(server.universities))]
+            coordinates, times = time_runs(lambda: geocode_universities(names), 1)
+            entries.append(dict(benchmark = 'geocode', workers = final_project.GEOCODE_WORKERS, latency_ms = latency * 1000, rows = len(coordinates),
+                                universities_per_second = len(coordinates) / times[0], **timing(times)))
+        finally:
+            final_project.APP, final_project.PRINCETON_REVIEW_URL = saved
+            context.close()
+    return entries
+
+# returns timings of writing results pages of RENDER_SIZES results
+def benchmark_render(runs):
+    entries = []
+    path = os.path.join(tempfile.mkdtemp(), 'university.html')
+    for size in RENDER_SIZES:
+        results = [SearchResult(f'University {number}', 50.0, 30000.0, 3.5, 40.0, -75.0, 'NY') for number in range(size)]
+        command = f'search tuition=50000 gpa acceptance limit={size}'
+
+        def render():
+            with open(path, 'w') as out:
+                render_search_results(command, results, out)
+
+        render()
+        value, times = time_runs(render, runs)
+        entries.append(dict(benchmark = 'render', rows = size, bytes = os.path.getsize(path), **timing(times)))
+    return entries
+
+# returns the commit being benchmarked, or None outside a git checkout
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True, check = True).stdout.strip()
+    except(OSError, subprocess.CalledProcessError):
+        return None
+
+# takes parsed arguments, runs the benchmarks they ask for, returns the report
+def run_benchmarks(args):
+    directory = args.data_dir or tempfile.mkdtemp()
+    os.makedirs(directory, exist_ok = True)
+    entries = []
+    for scale in args.scales:
+        print(f'searching {scale} universities...', file = sys.stderr)
+        context = AppContext(synthetic_database(scale, args.seed, directory), os.path.join(directory, 'cache.db'))
+        try:
+            entries.extend(benchmark_searches(context, scale, args.runs))
+        finally:
+            context.close()
+    for scale in args.build_scales:
+        print(f'building {scale} universities...', file = sys.stderr)
+        entries.extend(benchmark_build(scale, args.seed, args.workers, args.build_runs))
+    if args.crawl_pages:
+        print(f'crawling {args.crawl_pages} browse pages...', file = sys.stderr)
+        entries.extend(benchmark_crawl(args.crawl_pages, args.crawl_per_page, args.crawl_workers, args.crawl_latency, args.seed))
+    if not args.skip_render:
+        print('rendering results...', file = sys.stderr)
+        entries.extend(benchmark_render(args.runs))
+    return {'commit' : current_commit(), 'time' : time.strftime('%Y-%m-%dT%H:%M:%S'), 'python' : platform.python_version(),
+            'platform' : platform.platform(), 'seed' : args.seed, 'results' : entries}
+
+# takes a benchmark entry, returns what identifies it between runs
+def entry_key(entry):
+    return tuple(entry.get(field) for field in ('benchmark', 'scale', 'path', 'filters', 'workers', 'pages', 'latency_ms')) + ((entry['rows'],) if entry['benchmark'] == 'render' else ())
+
+# takes an older and a newer report, returns (key, old median, new median, ratio) for every benchmark in both
+def compare_reports(old, new):
+    old_entries = {entry_key(entry) : entry for entry in old['results']}
+    rows = []
+    for entry in new['results']:
+        key = entry_key(entry)
+        if key in old_entries:
+            before, after = old_entries[key]['median_ms'], entry['median_ms']
+            rows.append((key, before, after, after / before if before else float('inf')))
+    return rows
+
+def parse_scales(value):
+    return [int(scale) for scale in value.split(',') if scale]
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Time searches, database builds and result rendering against synthetic data.')
+    parser.add_argument('--scales', type = parse_scales, default = [1000, 10000], help = 'comma separated numbers of universities to search, like 1000,10000,100000')
+    parser.add_argument('--build-scales', type = parse_scales, default = [1000], help = 'comma separated numbers of universities to build databases of from html')
+    parser.add_argument('--runs', type = int, default = 5, help = 'runs of each search and render')
+    parser.add_argument('--build-runs', type = int, default = 1, help = 'runs of each database build')
+    parser.add_argument('--workers', type = int, default = None, help = 'processes parsing pages during builds')
+    parser.add_argument('--crawl-pages', type = int, default = 4, help = 'browse pages crawled from a local fixture server, 0 to skip crawling')
+    parser.add_argument('--crawl-per-page', type = int, default = 25, help = 'universities on each browse page')
+    parser.add_argument('--crawl-workers', type = int, default = 8, help = 'threads fetching pages during the crawl')
+    parser.add_argument('--crawl-latency', type = float, default = 0.02, help = 'seconds the fixture server waits before every response')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--data-dir', help = 'directory synthetic databases are kept in and reused from')
+    parser.add_argument('--skip-render', action = 'store_true')
+    parser.add_argument('--output', help = 'file the json report is written to instead of stdout')
+    parser.add_argument('--compare', help = 'earlier json report to compare the new timings with')
+    args = parser.parse_args(argv)
+    report = run_benchmarks(args)
+    if args.output:
+        with open(args.output, 'w') as out:
+            json.dump(report, out, indent = 1)
+    else:
+        print(json.dumps(report, indent = 1))
+    if args.compare:
+        with open(args.compare, 'r') as old_file:
+            old = json.load(old_file)
+        for key, before, after, ratio in compare_reports(old, report):
+            flag = '  SLOWER' if ratio > REGRESSION_RATIO else ''
+            print(f'{" ".join(str(part) for part in key if part is not None):<60} {before:10.2f} ms {after:10.2f} ms {ratio:6.2f}x{flag}', file = sys.stderr)
+    return report
+
+if __name__ == '__main__':
+    main()
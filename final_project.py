@@ -1,51 +1,544 @@
-import requests
 import os
-from bs4 import BeautifulSoup as bs
+import sys
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from collections import deque, namedtuple, OrderedDict
+from urllib.parse import urlsplit, urldefrag, quote, unquote
 import json
-import pprint
-import plotly
-import plotly.graph_objs as go
-import numpy as np
-import webbrowser
-from jinja2 import Template
-from flask import Flask, render_template
-from sqlalchemy_utils import database_exists
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, func, and_, text
+import argparse
+import bisect
+import csv
+import logging
+import gzip
+import hashlib
+import itertools
+import math
+import re
+import sqlite3
+import zlib
+from collections.abc import MutableMapping
+from functools import cached_property, wraps
+from contextlib import contextmanager
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, func, and_, text, select, bindparam, MetaData, Table
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from secrets import google_places_key
-from secrets import mapbox_key
+from sqlalchemy import exc, event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.engine import Engine
+
+# requests, bs4, plotly, numpy and jinja2 are slow to import, so they are imported
+# inside the functions that use them to keep query-only use of this module fast
+
+### INSTRUMENTATION ###
+
+# upper bounds in ms of the latency histogram buckets, anything slower goes in a last, unbounded bucket
+LATENCY_BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+# counters and latency histograms for the hot paths, see METRICS and timed
+# extraction worker processes keep their own and hand them back with each record to be merged in
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        # name to [count, total seconds, max seconds, bucket counts]
+        self.timers = {}
+
+    def count(self, name, amount = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe(self, name, seconds):
+        bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds * 1000)
+        with self.lock:
+            timer = self.timers.get(name)
+            if timer is None:
+                timer = self.timers[name] = [0, 0.0, 0.0, [0] * (len(LATENCY_BUCKETS) + 1)]
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+            timer[3][bucket] += 1
+
+    # times the with block under name
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    # returns everything recorded so far in a form merge takes, and starts over
+    def drain(self):
+        with self.lock:
+            raw = {'counters' : self.counters, 'timers' : self.timers}
+            self.counters, self.timers = {}, {}
+        return raw
+
+    def merge(self, raw):
+        with self.lock:
+            for name, amount in raw['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+            for name, (count, total, longest, buckets) in raw['timers'].items():
+                timer = self.timers.setdefault(name, [0, 0.0, 0.0, [0] * (len(LATENCY_BUCKETS) + 1)])
+                timer[0] += count
+                timer[1] += total
+                timer[2] = max(timer[2], longest)
+                timer[3] = [mine + theirs for mine, theirs in zip(timer[3], buckets)]
+
+    def reset(self):
+        self.drain()
+
+    # returns the counters and, for each timer, its count, total, mean, max and percentiles in ms
+    # percentiles are the upper bound of the bucket they fall in, so they are estimates
+    def stats(self):
+        with self.lock:
+            counters = dict(self.counters)
+            timers = {name : (count, total, longest, list(buckets)) for name, (count, total, longest, buckets) in self.timers.items()}
+        summary = {}
+        for name, (count, total, longest, buckets) in sorted(timers.items()):
+            summary[name] = {'count' : count, 'total_ms' : total * 1000, 'mean_ms' : total * 1000 / count, 'max_ms' : longest * 1000}
+            for percentile in (50, 90, 99):
+                seen = 0
+                for bound, bucket_count in zip(LATENCY_BUCKETS + [None], buckets):
+                    seen += bucket_count
+                    if seen >= count * percentile / 100:
+                        break
+                summary[name][f'p{percentile}_ms'] = min(bound, longest * 1000) if bound is not None else longest * 1000
+            summary[name]['buckets'] = {('le_' + str(bound)) if bound is not None else 'inf' : bucket_count for bound, bucket_count in zip(LATENCY_BUCKETS + [None], buckets)}
+        return {'counters' : dict(sorted(counters.items())), 'timers' : summary}
+
+    # takes a path and writes stats() there as json
+    def export(self, path):
+        with open(path, 'w') as out:
+            json.dump(self.stats(), out, indent = 1)
+
+    # returns stats() as a table for printing
+    def report(self):
+        stats = self.stats()
+        if not stats['timers'] and not stats['counters']:
+            return 'Nothing recorded yet.'
+        lines = [f'{"timer":<28}{"count":>8}{"total ms":>12}{"mean ms":>10}{"p50 ms":>10}{"p90 ms":>10}{"p99 ms":>10}{"max ms":>10}']
+        for name, timer in stats['timers'].items():
+            lines.append(f'{name:<28}{timer["count"]:>8}{timer["total_ms"]:>12.1f}{timer["mean_ms"]:>10.2f}{timer["p50_ms"]:>10.1f}{timer["p90_ms"]:>10.1f}{timer["p99_ms"]:>10.1f}{timer["max_ms"]:>10.1f}')
+        if stats['counters']:
+            lines.append('')
+            lines.append(f'{"counter":<28}{"count":>8}')
+            for name, count in stats['counters'].items():
+                lines.append(f'{name:<28}{count:>8}')
+        return '\n'.join(lines)
+
+
+METRICS = Metrics()
+
+# decorates a function so each call is timed under name
+def timed(name):
+    def decorate(function):
+        @wraps(function)
+        def timed_function(*args, **kwargs):
+            with METRICS.timer(name):
+                return function(*args, **kwargs)
+        return timed_function
+    return decorate
+
+# every sql statement is timed, and with SQL_LOG set logged to the final_project.sql logger: all of them with echo,
+# otherwise only those taking at least slow_ms, see configure_sql_log
+SQL_LOG = {'echo' : False, 'slow_ms' : None}
+SQL_LOGGER = logging.getLogger('final_project.sql')
+
+# takes whether to log every statement and the ms past which a statement is logged as slow, None for neither
+# log lines go to stderr, or to the file at path
+def configure_sql_log(echo = False, slow_ms = None, path = None):
+    SQL_LOG['echo'] = echo
+    SQL_LOG['slow_ms'] = slow_ms
+    for handler in list(SQL_LOGGER.handlers):
+        SQL_LOGGER.removeHandler(handler)
+        handler.close()
+    if echo or slow_ms is not None:
+        handler = logging.FileHandler(path) if path else logging.StreamHandler()
+        handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        SQL_LOGGER.addHandler(handler)
+        SQL_LOGGER.setLevel(logging.INFO)
+
+# the start is kept on the statement's execution context, so a statement that raises leaves nothing behind
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement(connection, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.statement_start = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def finish_statement(connection, cursor, statement, parameters, context, executemany):
+    if getattr(context, 'statement_start', None) is None:
+        return
+    elapsed = time.perf_counter() - context.statement_start
+    METRICS.observe('sql.executemany' if executemany else 'sql.execute', elapsed)
+    if SQL_LOG['echo'] or (SQL_LOG['slow_ms'] is not None and elapsed * 1000 >= SQL_LOG['slow_ms']):
+        shown = f'[{len(parameters)} rows]' if executemany else repr(parameters)
+        SQL_LOGGER.info('%s%.1f ms: %s %s', 'slow ' if not SQL_LOG['echo'] else '', elapsed * 1000, ' '.join(statement.split()), shown)
+
+### HTTP CLIENT ###
+
+# seconds to wait for a connection and then for each read of a response
+HTTP_TIMEOUT = (5, 30)
+# requests made for a url before giving up, waiting HTTP_BACKOFF ms and doubling up to HTTP_MAX_BACKOFF between them
+HTTP_ATTEMPTS = 3
+HTTP_BACKOFF = 500
+HTTP_MAX_BACKOFF = 8000
+# responses worth asking for again, anything else is returned as is
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+# keep-alive connections kept open to each host, enough for every crawl and geocoding thread
+HTTP_POOL_SIZE = 16
+
+# takes nothing, returns a requests session reusing keep-alive connections, asking for compressed responses
+# brotli is only asked for when the brotli package is installed to decode it
+def http_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections = HTTP_POOL_SIZE, pool_maxsize = HTTP_POOL_SIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    try:
+        import brotli
+        session.headers['Accept-Encoding'] = 'gzip, deflate, br'
+    except(ImportError):
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return session
+
+# takes a url, returns the requests response, timed under http.get and counted by status code
+# requests go through APP.http with HTTP_TIMEOUT unless given a timeout, and connection errors, timeouts and
+# HTTP_RETRY_STATUSES are retried with exponential backoff, attempts times in all, the last response is returned
+# even if its status is one of HTTP_RETRY_STATUSES
+def http_get(url, attempts = None, **kwargs):
+    import requests
+    from retrying import Retrying, RetryError
+    kwargs.setdefault('timeout', HTTP_TIMEOUT)
+    session = APP.http
+
+    def attempt():
+        with METRICS.timer('http.get'):
+            response = session.get(url, **kwargs)
+        METRICS.count(f'http.status.{response.status_code}')
+        return response
+
+    retrier = Retrying(stop_max_attempt_number = attempts or HTTP_ATTEMPTS, wait_exponential_multiplier = HTTP_BACKOFF,
+                       wait_exponential_max = HTTP_MAX_BACKOFF, retry_on_result = lambda response: response.status_code in HTTP_RETRY_STATUSES,
+                       retry_on_exception = lambda error: isinstance(error, (requests.ConnectionError, requests.Timeout)))
+    try:
+        return retrier.call(attempt)
+    except(RetryError) as error:
+        return error.last_attempt.value
+
+# takes a link and the store caching it, returns the page's html
+# a cached page is revalidated with the etag and last-modified date it was stored with, so an unchanged page
+# costs a 304 instead of the whole page, anything else is stored along with its new etag and last-modified date
+# error statuses raise requests.HTTPError and leave the cache as it was
+# the page is fetched and cached under its canonical_url
+def fetch_page(link, store = None):
+    link = canonical_url(link)
+    store = APP.pages if store is None else store
+    headers = {}
+    if isinstance(store, PageStore):
+        etag, last_modified = store.validators(link)
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+    response = http_get(link, headers = headers)
+    if response.status_code == 304 and headers:
+        try:
+            return store[link]
+        except(KeyError):
+            # the page was deleted since it was revalidated, so fetch it whole
+            response = http_get(link)
+    response.raise_for_status()
+    if isinstance(store, PageStore):
+        store.store(link, response.text, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+    else:
+        store[link] = response.text
+    return response.text
 
 ### CACHING ###
 
-# caching html from individual university pages
-try:
-    cache_file = open('university_htmls.txt', 'r')
-    cache_contents = cache_file.read()
-    UNIVERSITIES = json.loads(cache_contents)
-    cache_file.close()
-except:
-    UNIVERSITIES = {}
-
-# caching results from google places search
-try:
-    cache_file = open('google_places.txt', 'r')
-    cache_contents = cache_file.read()
-    GOOGLE_PLACES = json.loads(cache_contents)
-    cache_file.close()
-except:
-    GOOGLE_PLACES = {}
-
-# caching links from individual university pages in a list for efficient looping
-try:
-    cache_file = open('links_list.txt', 'r')
-    cache_contents = cache_file.read()
-    UNIVERSITY_LIST = list(json.loads(cache_contents))
-    cache_file.close()
-except:
-    UNIVERSITY_LIST = []
+# takes a link, returns the link pages are fetched and cached under
+# fragments like #!academics are never sent to the server, so every fragment of a page is the same document
+def canonical_url(link):
+    return urldefrag(link)[0]
+
+# file holding every cached page, google places result and university link
+PAGE_CACHE = 'page_cache.db'
+
+# keyed store of cached pages backed by a table in a sqlite file
+# bodies are zlib compressed, read only when asked for and committed as soon as they are written,
+# so a crash mid-crawl loses at most the page being fetched
+class PageStore(MutableMapping):
+    def __init__(self, path, table):
+        self.table = table
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread = False, isolation_level = None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS {table} (key TEXT PRIMARY KEY, body BLOB, etag TEXT, last_modified TEXT)')
+        # stores made before pages were revalidated have no columns for the validators
+        columns = [row[1] for row in self.connection.execute(f'PRAGMA table_info({table})')]
+        for column in ('etag', 'last_modified'):
+            if column not in columns:
+                self.connection.execute(f'ALTER TABLE {table} ADD COLUMN {column} TEXT')
+
+    def __getitem__(self, key):
+        with self.lock:
+            row = self.connection.execute(f'SELECT body FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return zlib.decompress(row[0]).decode('utf-8')
+
+    def __setitem__(self, key, value):
+        body = zlib.compress(value.encode('utf-8'))
+        with self.lock:
+            self.connection.execute(f'INSERT OR REPLACE INTO {self.table} (key, body) VALUES (?, ?)', (key, body))
+
+    def __delitem__(self, key):
+        with self.lock:
+            cursor = self.connection.execute(f'DELETE FROM {self.table} WHERE key = ?', (key,))
+        if cursor.rowcount == 0:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        with self.lock:
+            row = self.connection.execute(f'SELECT 1 FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        return row is not None
+
+    def __iter__(self):
+        with self.lock:
+            keys = [row[0] for row in self.connection.execute(f'SELECT key FROM {self.table}')]
+        return iter(keys)
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    # takes a key, a page and the etag and last-modified headers it was served with, stores them together
+    def store(self, key, value, etag = None, last_modified = None):
+        body = zlib.compress(value.encode('utf-8'))
+        with self.lock:
+            self.connection.execute(f'INSERT OR REPLACE INTO {self.table} (key, body, etag, last_modified) VALUES (?, ?, ?, ?)', (key, body, etag, last_modified))
+
+    # takes a key, returns the (etag, last-modified) its page was stored with, None for either one it wasn't
+    def validators(self, key):
+        with self.lock:
+            row = self.connection.execute(f'SELECT etag, last_modified FROM {self.table} WHERE key = ?', (key,)).fetchone()
+        return row if row is not None else (None, None)
+
+    # gives the space of deleted pages back to the file system
+    def vacuum(self):
+        with self.lock:
+            self.connection.execute('VACUUM')
+
+    # writes many pages in a single transaction
+    def update(self, pages):
+        rows = [(key, zlib.compress(value.encode('utf-8'))) for key, value in dict(pages).items()]
+        with self.lock, self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.executemany(f'INSERT OR REPLACE INTO {self.table} (key, body) VALUES (?, ?)', rows)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# ordered list of university links backed by a table in a sqlite file, appends are written immediately
+class LinkList:
+    def __init__(self, path, table):
+        self.table = table
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread = False, isolation_level = None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(f'CREATE TABLE IF NOT EXISTS {table} (position INTEGER PRIMARY KEY AUTOINCREMENT, link TEXT UNIQUE)')
+
+    def append(self, link):
+        with self.lock:
+            self.connection.execute(f'INSERT OR IGNORE INTO {self.table} (link) VALUES (?)', (link,))
+
+    def extend(self, links):
+        with self.lock, self.connection:
+            self.connection.execute('BEGIN')
+            self.connection.executemany(f'INSERT OR IGNORE INTO {self.table} (link) VALUES (?)', [(link,) for link in links])
+
+    def __contains__(self, link):
+        with self.lock:
+            row = self.connection.execute(f'SELECT 1 FROM {self.table} WHERE link = ?', (link,)).fetchone()
+        return row is not None
+
+    def __iter__(self):
+        with self.lock:
+            links = [row[0] for row in self.connection.execute(f'SELECT link FROM {self.table} ORDER BY position')]
+        return iter(links)
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute(f'SELECT COUNT(*) FROM {self.table}').fetchone()[0]
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+# copies an old json cache file into a store the first time the store is opened
+def import_json_cache(filename, store):
+    if len(store) > 0 or not os.path.exists(filename):
+        return
+    with open(filename, 'r') as cache_file:
+        contents = json.loads(cache_file.read())
+    if isinstance(store, LinkList):
+        store.extend(contents)
+    else:
+        store.update(contents)
+
+# collapses pages cached under links with fragments, like link#!academics, into one page under the canonical link
+# caches made before links were canonicalized hold every university's page five times
+def migrate_page_cache(pages):
+    links = [link for link in pages if canonical_url(link) != link]
+    if not links:
+        return
+    canonical = {}
+    for link in links:
+        if canonical_url(link) not in pages and canonical_url(link) not in canonical:
+            canonical[canonical_url(link)] = pages[link]
+    pages.update(canonical)
+    for link in links:
+        del pages[link]
+    if isinstance(pages, PageStore):
+        pages.vacuum()
+
+### APPLICATION CONTEXT ###
+
+DATABASE = 'universities.db'
+# directory holding html.html and major_temp.html
+TEMPLATE_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+# holds the database session and the page caches, each opened the first time it is used
+# so importing this module never touches the network, the caches or the database
+class AppContext:
+    def __init__(self, database = DATABASE, page_cache = PAGE_CACHE):
+        self.database = database
+        self.page_cache = page_cache
+        # searches are answered from the snapshot instead of sql when set
+        self.use_snapshot = False
+
+    # databases built by older versions are migrated when first opened
+    @cached_property
+    def engine(self):
+        engine = create_engine('sqlite:///' + self.database, echo=False)
+        if self.database_exists():
+            migrate_database(engine)
+        return engine
+
+    @cached_property
+    def session(self):
+        Session = sessionmaker(bind=self.engine)
+        return Session()
+
+    # caching html from individual university pages
+    @cached_property
+    def pages(self):
+        pages = PageStore(self.page_cache, 'university_pages')
+        import_json_cache('university_htmls.txt', pages)
+        migrate_page_cache(pages)
+        return pages
+
+    # caching results from google places search
+    @cached_property
+    def places(self):
+        places = PageStore(self.page_cache, 'google_places')
+        import_json_cache('google_places.txt', places)
+        migrate_places_cache(places)
+        return places
+
+    # progress of run_pipeline, so an interrupted crawl resumes where it stopped
+    @cached_property
+    def checkpoints(self):
+        return PageStore(self.page_cache, 'checkpoints')
+
+    # the pooled http session every request goes through, see http_get
+    @cached_property
+    def http(self):
+        return http_session()
+
+    # looks up coordinates for names missing from places, see GooglePlacesGeocoder
+    @cached_property
+    def geocoder(self):
+        return GooglePlacesGeocoder()
+
+    # caching links from individual university pages in a list for efficient looping
+    @cached_property
+    def links(self):
+        links = LinkList(self.page_cache, 'university_links')
+        import_json_cache('links_list.txt', links)
+        return links
+
+    # pooled read-only connections for serving many readers at once, see create_app
+    # the database is switched to wal mode first so readers never wait on a rebuild or on each other
+    @cached_property
+    def read_engine(self):
+        with self.engine.connect() as connection:
+            connection.execute('PRAGMA journal_mode=WAL')
+        url = 'sqlite:///file:' + quote(os.path.abspath(self.database)) + '?mode=ro&uri=true'
+        engine = create_engine(url, poolclass = QueuePool, pool_size = READ_POOL_SIZE, connect_args = {'check_same_thread' : False})
+        event.listen(engine, 'connect', lambda connection, record: connection.execute('PRAGMA query_only=ON'))
+        return engine
+
+    # the results page templates, each compiled the first time it is used and again only if its file changes
+    # compiled templates are also cached on disk so later runs don't compile them either
+    @cached_property
+    def templates(self):
+        from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+        return Environment(loader = FileSystemLoader(TEMPLATE_DIRECTORY), bytecode_cache = FileSystemBytecodeCache())
+
+    # pages of plots already shown, see FigureCache
+    @cached_property
+    def figures(self):
+        import tempfile
+        return FigureCache(tempfile.mkdtemp(prefix = 'university_plots_'))
+
+    # read-only columnar copy of the University and Location data, see UniversitySnapshot
+    @cached_property
+    def snapshot(self):
+        with METRICS.timer('snapshot.load'):
+            return UniversitySnapshot.load(self.session)
+
+    def database_exists(self):
+        return os.path.exists(self.database) and os.path.getsize(self.database) > 0
+
+    # closes whatever has been opened so far, the next use opens it again
+    def close(self):
+        self.__dict__.pop('snapshot', None)
+        if 'http' in self.__dict__:
+            self.__dict__.pop('http').close()
+        opened = {name : self.__dict__.pop(name) for name in ('session', 'engine', 'read_engine', 'pages', 'places', 'links', 'checkpoints') if name in self.__dict__}
+        if 'session' in opened:
+            opened['session'].close()
+        for name in ('engine', 'read_engine'):
+            if name in opened:
+                opened[name].dispose()
+        for name in ('pages', 'places', 'links', 'checkpoints'):
+            if name in opened and hasattr(opened[name], 'close'):
+                opened[name].close()
+
+
+APP = AppContext()
+
+# older names for the context's members, still available as module attributes
+LAZY_NAMES = {'UNIVERSITIES' : 'pages', 'GOOGLE_PLACES' : 'places', 'UNIVERSITY_LIST' : 'links', 'session' : 'session', 'engine' : 'engine'}
+
+def __getattr__(name):
+    if name in LAZY_NAMES:
+        return getattr(APP, LAZY_NAMES[name])
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
 ### CLASSES ###
 
@@ -53,13 +546,15 @@ except:
 
 Base = declarative_base() 
 
+# ids follow the order universities were scraped in, Princeton Review's ranking
 class University(Base):
     __tablename__ = 'University'
-    name = Column(String(32), primary_key = True)
+    id = Column(Integer, primary_key = True)
+    name = Column(String(32), unique = True, nullable = False)
     acceptance = Column(Float)
-    tuition = Column(Float)
+    tuition = Column(Float, index = True)
     gpa = Column(Float)
-    degree = relationship('Major', back_populates = 'university')
+    degree = relationship('UniversityMajor', back_populates = 'university')
     location = relationship('Location', back_populates = 'university')
     lat = Column(Float)
     lng = Column(Float)
@@ -73,62 +568,351 @@ class University(Base):
         self.lng = lng
 
 
+# every distinct major once, universities are linked to theirs through UniversityMajor
 class Major(Base):
     __tablename__ = 'Major'
-    name = Column(String(32), ForeignKey('University.name'))
-    major = Column(String(32))
     id = Column(Integer, primary_key = True, autoincrement = True)
-    university = relationship('University', back_populates = 'degree')
-    
-    def __init__(self, name, major):
-        self.name = name
+    major = Column(String(32), unique = True, nullable = False)
+    universities = relationship('UniversityMajor', back_populates = 'major')
+
+    def __init__(self, major):
         self.major = major
 
 
+# links a university to each of its majors, in the order its page lists them
+class UniversityMajor(Base):
+    __tablename__ = 'UniversityMajor'
+    university_id = Column(Integer, ForeignKey('University.id'), primary_key = True)
+    major_id = Column(Integer, ForeignKey('Major.id'), primary_key = True, index = True)
+    university = relationship('University', back_populates = 'degree')
+    major = relationship('Major', back_populates = 'universities')
+
+    def __init__(self, university_id, major_id):
+        self.university_id = university_id
+        self.major_id = major_id
+
+
 class Location(Base):
     __tablename__ = 'Location'
-    name = Column(String(32), ForeignKey('University.name'), primary_key = True)
+    university_id = Column(Integer, ForeignKey('University.id'), primary_key = True)
     address = Column(String(64))
     city = Column(String(32))
-    state = Column(String(32))
+    state = Column(String(32), index = True)
     zip_code = Column(String(32))
     university = relationship('University', back_populates = 'location')
 
-    def __init__(self, name, address, city, state, zip_code):
-        self.name = name
+    def __init__(self, university_id, address, city, state, zip_code):
+        self.university_id = university_id
         self.address = address
         self.city = city
         self.state = state
         self.zip_code = zip_code
 
+
+# the university page each row was built from and a hash of its html, used to rebuild only what changed
+class SourcePage(Base):
+    __tablename__ = 'SourcePage'
+    link = Column(String(128), primary_key = True)
+    name = Column(String(32))
+    content_hash = Column(String(40))
+
+    def __init__(self, link, name, content_hash):
+        self.link = link
+        self.name = name
+        self.content_hash = content_hash
+
+# statistics of one measure (tuition, acceptance or gpa) over the universities in a state, offering a major, or both,
+# with '' standing for every state and major_id 0 for every major, so ('', 0) holds every university, see refresh_summaries
+# a major's spellings in different cases share one group, kept under the first of their ids
+class Summary(Base):
+    __tablename__ = 'Summary'
+    # rows are stored in primary key order, so the key isn't kept a second time in an index
+    __table_args__ = {'sqlite_with_rowid' : False}
+    state = Column(String(32), primary_key = True)
+    major_id = Column(Integer, primary_key = True)
+    measure = Column(String(16), primary_key = True)
+    # universities in the group, and how many of them have a value for the measure
+    universities = Column(Integer)
+    count = Column(Integer)
+    mean = Column(Float)
+    min = Column(Float)
+    p25 = Column(Float)
+    median = Column(Float)
+    p75 = Column(Float)
+    p90 = Column(Float)
+    max = Column(Float)
+
+    def __init__(self, state, major_id, measure, universities, count, mean, min, p25, median, p75, p90, max):
+        self.state = state
+        self.major_id = major_id
+        self.measure = measure
+        self.universities = universities
+        self.count = count
+        self.mean = mean
+        self.min = min
+        self.p25 = p25
+        self.median = median
+        self.p75 = p75
+        self.p90 = p90
+        self.max = max
+
+
+### SCHEMA ###
+
+# bumped whenever migrate_database learns a new step, stored in the database's user_version
+SCHEMA_VERSION = 3
+
+# full-text index over the names in Major, kept in step with it by triggers
+# the trigram tokenizer makes substring searches like '%computer science%' index lookups
+MAJOR_SEARCH_SQL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS MajorSearch USING fts5(major, content='Major', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS Major_search_insert AFTER INSERT ON Major BEGIN INSERT INTO MajorSearch (rowid, major) VALUES (new.id, new.major); END",
+    "CREATE TRIGGER IF NOT EXISTS Major_search_delete AFTER DELETE ON Major BEGIN INSERT INTO MajorSearch (MajorSearch, rowid, major) VALUES ('delete', old.id, old.major); END",
+    "CREATE TRIGGER IF NOT EXISTS Major_search_update AFTER UPDATE ON Major BEGIN INSERT INTO MajorSearch (MajorSearch, rowid, major) VALUES ('delete', old.id, old.major); INSERT INTO MajorSearch (rowid, major) VALUES (new.id, new.major); END",
+]
+
+# kept out of Base so create_all leaves the virtual table to migrate_database
+major_search = Table('MajorSearch', MetaData(), Column('rowid', Integer), Column('major', String))
+
+# creates any missing tables, then brings the database up to SCHEMA_VERSION
+def create_tables(engine):
+    Base.metadata.create_all(engine)
+    migrate_database(engine)
+
+# creates the major name search table and its triggers, and indexes the majors already in Major
+def create_major_search(connection):
+    try:
+        for statement in MAJOR_SEARCH_SQL:
+            connection.execute(statement)
+        connection.execute("INSERT INTO MajorSearch (MajorSearch) VALUES ('rebuild')")
+    except(exc.OperationalError):
+        # sqlite without fts5 or the trigram tokenizer, major searches fall back to LIKE
+        pass
+
+# upgrades a database built by an older version of this program, does nothing if it is current
+# tables made by create_all are already in the current layout and only need the search table and summaries
+def migrate_database(engine):
+    with engine.connect() as connection:
+        version = connection.execute('PRAGMA user_version').scalar()
+        if version >= SCHEMA_VERSION:
+            return
+        # before version 3 Major held a row per university and major, keyed on the university's name
+        old_layout = 'name' in [row[1] for row in connection.execute('PRAGMA table_info(Major)')]
+        with connection.begin():
+            # version 1: indexes for the search filters and the major name search table
+            if version < 1 and old_layout:
+                connection.execute('CREATE INDEX IF NOT EXISTS ix_Major_name ON Major (name)')
+                connection.execute('CREATE INDEX IF NOT EXISTS ix_Major_major ON Major (major)')
+                connection.execute('CREATE INDEX IF NOT EXISTS ix_Location_state ON Location (state)')
+                connection.execute('CREATE INDEX IF NOT EXISTS ix_University_tuition ON University (tuition)')
+            # version 2: per-state and per-major statistics, filled in below
+            if version < 2:
+                Summary.__table__.create(connection, checkfirst = True)
+            # version 3: universities get integer ids, which Location and UniversityMajor refer to, and each major
+            # is kept once in Major, so searches match a few hundred major names instead of every university's
+            if version < 3 and old_layout:
+                rewrite_tables(connection)
+            create_major_search(connection)
+            refresh_summaries(connection)
+            connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        if version < 3 and old_layout:
+            # hands the space of the old tables back, which fails harmlessly while another connection is reading
+            try:
+                connection.execute('VACUUM')
+            except(exc.OperationalError):
+                pass
+        connection.execute('ANALYZE')
+    MAJOR_SEARCH_ENGINES.pop(engine, None)
+
+# moves a database's University, Major and Location tables from the layout before version 3 into the current one,
+# keeping universities in scrape order and each university's majors in the order its page lists them
+def rewrite_tables(connection):
+    for trigger in ('Major_search_insert', 'Major_search_delete', 'Major_search_update'):
+        connection.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    connection.execute('DROP TABLE IF EXISTS MajorSearch')
+    for index in ('ix_Major_name', 'ix_Major_major', 'ix_Location_state', 'ix_University_tuition'):
+        connection.execute(f'DROP INDEX IF EXISTS {index}')
+    for table in ('University', 'Major', 'Location'):
+        connection.execute(f'ALTER TABLE {table} RENAME TO {table}_old')
+    # create_all may have made an empty UniversityMajor already, and Summary is keyed on major names before version 3
+    connection.execute('DROP TABLE IF EXISTS UniversityMajor')
+    connection.execute('DROP TABLE IF EXISTS Summary')
+    Base.metadata.create_all(connection, tables = [University.__table__, Major.__table__, UniversityMajor.__table__, Location.__table__, Summary.__table__])
+    connection.execute('INSERT INTO University (id, name, acceptance, tuition, gpa, lat, lng) '
+                       'SELECT rowid, name, acceptance, tuition, gpa, lat, lng FROM University_old ORDER BY rowid')
+    connection.execute('INSERT INTO Major (major) SELECT major FROM Major_old WHERE major IS NOT NULL GROUP BY major ORDER BY MIN(id)')
+    connection.execute('INSERT OR IGNORE INTO UniversityMajor (university_id, major_id) SELECT University.id, Major.id FROM Major_old '
+                       'JOIN University ON University.name = Major_old.name JOIN Major ON Major.major = Major_old.major ORDER BY Major_old.id')
+    connection.execute('INSERT INTO Location (university_id, address, city, state, zip_code) '
+                       'SELECT University.id, address, city, state, zip_code FROM Location_old JOIN University ON University.name = Location_old.name')
+    for table in ('Major', 'Location', 'University'):
+        connection.execute(f'DROP TABLE {table}_old')
+
+# whether the database has the major name search table
+def has_major_search(engine):
+    if engine not in MAJOR_SEARCH_ENGINES:
+        with engine.connect() as connection:
+            MAJOR_SEARCH_ENGINES[engine] = connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'MajorSearch'").scalar() > 0
+    return MAJOR_SEARCH_ENGINES[engine]
+
+MAJOR_SEARCH_ENGINES = {}
+
+# takes a major search term, returns the ids of the majors that contain it
+# searches look these up once and then match universities on the ids alone
+def major_ids(session, term):
+    # trigrams need at least three characters
+    if len(term) >= 3 and has_major_search(session.get_bind()):
+        phrase = '"' + term.replace('"', '""') + '"'
+        query = session.query(major_search.c.rowid).filter(major_search.c.major.op('MATCH')(phrase))
+    else:
+        query = session.query(Major.id).filter(Major.major.like('%' + term + '%'))
+    return sorted(major_id for major_id, in query)
+
 ### COLLECTING DATA ###
 
+# base url for all Princeton Review pages, set the PRINCETON_REVIEW_URL environment variable (or this) to crawl
+# a local stand-in server like the one in fixture_server.py
+PRINCETON_REVIEW_URL = os.environ.get('PRINCETON_REVIEW_URL', 'https://www.princetonreview.com')
+# defaults used for the concurrent crawl mode
+CRAWL_WORKERS = 8
+CRAWL_RATE = 10.0
+
+# spaces out requests to each host so that no host sees more than rate requests per second
+class RateLimiter:
+    def __init__(self, rate = CRAWL_RATE):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_request = {}
+        self.lock = threading.Lock()
+
+    # blocks the calling thread until the host of link may be requested again
+    def wait(self, link):
+        host = urlsplit(link).netloc
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_request.get(host, now))
+            self.next_request[host] = start + self.interval
+        delay = start - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+# fetches pages on a thread pool and stores them in the cache, keeping at most max_in_flight requests queued
+# a page already queued is not queued again, its future is shared instead
+class Crawler:
+    def __init__(self, workers = CRAWL_WORKERS, rate = CRAWL_RATE, max_in_flight = None):
+        self.executor = ThreadPoolExecutor(max_workers = workers)
+        self.limiter = RateLimiter(rate)
+        self.max_in_flight = max_in_flight or workers * 4
+        self.slots = threading.BoundedSemaphore(self.max_in_flight)
+        self.lock = threading.Lock()
+        # canonical link of each queued page to its future
+        self.futures = {}
+        self.error = None
+
+    # fetches a page on the calling thread, respecting the rate limit
+    def get(self, link):
+        self.limiter.wait(link)
+        response = http_get(link)
+        response.raise_for_status()
+        return response.text
+
+    # fetches or revalidates a page into the cache, respecting the rate limit
+    def fetch_into_cache(self, link):
+        self.limiter.wait(link)
+        return fetch_page(link)
+
+    # queues link to be fetched into the cache, blocks while the in-flight queue is full
+    def submit(self, link):
+        link = canonical_url(link)
+        with self.lock:
+            if link in self.futures:
+                return self.futures[link]
+        self.slots.acquire()
+        try:
+            future = self.executor.submit(self.fetch_into_cache, link)
+        except:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.futures[link] = future
+        future.add_done_callback(lambda future: self.finished(link, future))
+        return future
+
+    def finished(self, link, future):
+        with self.lock:
+            if self.futures.get(link) is future:
+                del self.futures[link]
+            if self.error is None and future.exception() is not None:
+                self.error = future.exception()
+        self.slots.release()
+
+    # waits for every queued fetch, raising the first error encountered
+    def join(self):
+        with self.lock:
+            futures = list(self.futures.values())
+        wait(futures)
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.executor.shutdown(wait = True)
+
+
 # collects the urls and html for university sites from Princeton Review's browse pages
 # takes int argument and returns dict of university pages collected for testing
-def get_start_sites(num_pages = 11):
+# with workers > 1 university pages are fetched concurrently, rate limited to rate requests per second per host
+def get_start_sites(num_pages = 11, workers = 1, rate = CRAWL_RATE, max_in_flight = None):
+    from bs4 import BeautifulSoup as bs
+    crawler = None
+    if workers > 1:
+        crawler = Crawler(workers, rate, max_in_flight)
     # start page link
-    link = 'https://www.princetonreview.com/college-search'
+    link = PRINCETON_REVIEW_URL + '/college-search'
     pages = {}
-    for i in range(num_pages): 
-        # get start page and create soup
-        html = requests.get(link).text
-        soup = bs(html, 'html.parser')
-        # use soup to get university links and html and adds to dict
-        pages.update(get_university_sites(soup))
-        # finds next link to collect more universities
-        next_parent = soup.find_all(name = 'ul', attrs={'class' : 'pagination'})
-        next_child = next_parent[0].find_all(name = 'a')
-        next = next_child[-1]['href']
-        link = 'https://www.princetonreview.com/' + next
+    try:
+        for i in range(num_pages): 
+            # get start page and create soup
+            if crawler:
+                html = crawler.get(link)
+            else:
+                response = http_get(link)
+                response.raise_for_status()
+                html = response.text
+            soup = bs(html, 'html.parser')
+            # use soup to get university links and html and adds to dict
+            pages.update(get_university_sites(soup, crawler))
+            # finds next link to collect more universities
+            link = next_browse_link(soup)
+        if crawler:
+            crawler.join()
+            pages = {link : APP.pages[link] for link in pages}
+    finally:
+        if crawler:
+            crawler.close()
     # returns pages for testing 
     return pages
 
 # takes browse page as argument, finds links and html for university sites and returns as a dict for testing
-def get_university_sites(soup):
-    link_list = []
+# when given a crawler, pages are queued on it and the dict holds their futures instead of html
+def get_university_sites(soup, crawler = None):
     local_links = {}
+    # appending university link portion to base, adding to list, and grabbing html
+    for link in university_links(soup):
+        # appends pages to university_list
+        if link in APP.links:
+            pass
+        else:
+            APP.links.append(link)
+        # adds the page to the cache
+        link, html = get_next_university_links(link, crawler)
+        local_links[link] = html
+    # returns local_links dict for testing
+    return local_links
+
+# takes a browse page soup, returns the full links of the universities it lists, in order
+def university_links(soup):
+    link_list = []
     # finding university-specific part of link
-    parent_class = soup.find_all(name = 'div', attrs={'class' : 'col-md-3'})
     child_class = soup.find_all(name = 'a')
     for response in child_class:
         try:
@@ -140,48 +924,65 @@ def get_university_sites(soup):
                 pass
         except(KeyError):
             pass
-    # appending university link portion to base, adding to list, and grabbing html
-    base = 'https://www.princetonreview.com'
-    for university in link_list:
-        link = base + university
-        # appends pages to university_list
-        if link in UNIVERSITY_LIST:
-            pass
-        else:
-            UNIVERSITY_LIST.append(link)
-        # adds pages to cache
-        if link in UNIVERSITIES:
-            pass
-        else:
-            html = requests.get(link).text
-            UNIVERSITIES[link] = html
-        # gets sub-pages for each university
-        link, html = get_next_university_links(link)
-        local_links[link] = html
-    # returns local_links dict for testing
-    return local_links
+    return [PRINCETON_REVIEW_URL + link for link in link_list]
 
-# takes a university link, returns links and html for testing
-def get_next_university_links(link):
-    # creates sub_pages links
-    academics = link + '#!academics'
-    tuition = link + '#!tuition'
-    student_body = link + '#!studentbody'
-    visit = link + '#!visiting'
-    links = [academics, tuition, student_body, visit]
-    # adds sub-pages to cache
-    for link in links:
-        if link in UNIVERSITIES:
-            pass
-        else:
-            html = requests.get(link).text
-            UNIVERSITIES[link] = html
+# takes a browse page soup, returns the link of the next browse page
+def next_browse_link(soup):
+    next_parent = soup.find_all(name = 'ul', attrs={'class' : 'pagination'})
+    next_child = next_parent[0].find_all(name = 'a')
+    return PRINCETON_REVIEW_URL + '/' + next_child[-1]['href']
+
+# takes a university link, returns its canonical link and html for testing
+# the academics, tuition, student body and visiting sections are #! fragments of the one page, so it is
+# fetched and cached once under its canonical_url and every extractor reads that copy
+# when given a crawler, an uncached page is queued on it and a future is returned in place of html
+def get_next_university_links(link, crawler = None):
+    link = canonical_url(link)
+    future = None
+    # adds the page to cache
+    if link in APP.pages:
+        pass
+    elif crawler:
+        future = crawler.submit(link)
+    else:
+        fetch_page(link)
+    if crawler:
+        return link, future
     # returns link and html for testing
-    return link, UNIVERSITIES[link]
+    return link, APP.pages[link]
     
-# takes base university link, returns name, gpa, and acceptance rate
-def get_admissions_data(link):
-    soup = bs(requests.get(link).text, 'html.parser')
+# raised by offline builds when a page or google places result is not in the cache
+class CacheMissError(KeyError):
+    pass
+
+# takes a link, returns its html from the cache, fetching and caching it on a miss unless offline
+# links with fragments share their page with the canonical_url
+def get_page(link, offline = False):
+    link = canonical_url(link)
+    try:
+        return APP.pages[link]
+    except(KeyError):
+        if offline:
+            raise CacheMissError(link)
+    return fetch_page(link)
+
+# tags the extractors read, everything else (head, scripts, styles, inline text) is skipped while parsing
+PAGE_TAGS = ['div', 'span', 'ul']
+
+# parses university page html once with the fastest parser available, keeping only the tags extractors need
+@timed('parse.page')
+def parse_university_page(html):
+    from bs4 import BeautifulSoup as bs, SoupStrainer
+    try:
+        import lxml
+        parser = 'lxml'
+    except(ImportError):
+        parser = 'html.parser'
+    return bs(html, parser, parse_only = SoupStrainer(PAGE_TAGS))
+
+# takes university page soup, returns acceptance rate, gpa and name
+@timed('parse.admissions')
+def parse_admissions(soup):
     parent_class = soup.find_all(name = 'div', attrs={'class' : 'number-callout'})
     name = soup.find(name = 'span', attrs = {'itemprop' : 'name'}).text
     # getting acceptance rate and converting to decimal
@@ -198,12 +999,14 @@ def get_admissions_data(link):
                 for item in child_class:
                     if item.find(name = 'div', attrs = {'class' : 'bold'}).text == 'Average HS GPA':
                         average_gpa = item.find(name = 'div', attrs={'class':'number-callout'}).string
+                        # plain str so the value doesn't hold on to the parse tree
+                        if average_gpa is not None:
+                            average_gpa = str(average_gpa)
     return acceptance_rate, average_gpa, name
 
-# takes base university link, returns list of majors
-def get_academics_data(link):
-    link += '#!academics'
-    soup = bs(UNIVERSITIES[link], 'html.parser')
+# takes university page soup, returns list of majors
+@timed('parse.majors')
+def parse_majors(soup):
     parent_class = soup.find_all(name = 'ul', attrs={'class' : 'list-unstyled'})
     major_list = []
     for i in range(len(parent_class)):
@@ -214,10 +1017,10 @@ def get_academics_data(link):
             major_list.append(text)
     return major_list
 
-# takes base university link, returns address components
-def get_visit_data(link):
-    link += '#!visiting'
-    soup = bs(UNIVERSITIES[link], 'html.parser')
+# takes university page soup, returns address components
+@timed('parse.address')
+def parse_address(soup):
+    street_address, city, state, zip_code = None, None, None, None
     parent_class = soup.find_all(name = 'div', attrs = {'class' : 'row'})
     for item in parent_class:
         try:
@@ -240,10 +1043,9 @@ def get_visit_data(link):
             break
     return street_address, city, state, zip_code
 
-# takes base university link, returns tuition
-def get_tuition_data(link):
-    link += '#!tuition'
-    soup = bs(UNIVERSITIES[link], 'html.parser')
+# takes university page soup, returns tuition
+@timed('parse.tuition')
+def parse_tuition(soup):
     parent_class = soup.find_all(name = 'div', attrs = {'class' : 'row'})
     for row in parent_class:
         if row.find(name = 'h4'):
@@ -259,112 +1061,856 @@ def get_tuition_data(link):
 
     return 0.0
 
-# takes university object and returns coordinates
-def get_coordinates_for_university(university):
-    # construct url
-    base_url = 'https://maps.googleapis.com/maps/api/place/textsearch/json?'
-    input = university.replace('--', '+')
-    input = input.replace('-', '+')
-    input = input.replace(' ', '+')
-    input_type = 'textquery'
-    field = 'location,name'
-    key = google_places_key
-    url = base_url + 'input=' + input + '&inputtype=' + input_type + '&fields=' + field + '&key=' + key
-    page = None
-    # use cache to get data
-    if url in GOOGLE_PLACES:
-        page = GOOGLE_PLACES[url]
-    else:
-        page = requests.get(url).text
-        GOOGLE_PLACES[url] = page
-    # isolate lat and lng
-    dict = json.loads(page)
+# takes base university link, returns name, gpa, and acceptance rate
+@timed('extract.admissions')
+def get_admissions_data(link):
+    return parse_admissions(parse_university_page(get_page(link)))
+
+# takes base university link, returns list of majors
+@timed('extract.academics')
+def get_academics_data(link):
+    return parse_majors(parse_university_page(get_page(link)))
+
+# takes base university link, returns address components
+@timed('extract.visit')
+def get_visit_data(link):
+    return parse_address(parse_university_page(get_page(link)))
+
+# takes base university link, returns tuition
+@timed('extract.tuition')
+def get_tuition_data(link):
+    return parse_tuition(parse_university_page(get_page(link)))
+
+# every field create_database needs from one university page
+UniversityRecord = namedtuple('UniversityRecord', ['link', 'name', 'acceptance', 'tuition', 'gpa', 'majors', 'address', 'city', 'state', 'zip_code', 'content_hash'])
+
+# takes page html, returns the hash recorded for it in SourcePage
+def content_hash(html):
+    return hashlib.sha1(html.encode('utf-8')).hexdigest()
+
+# takes a university link and its page html, parses the page once and returns a UniversityRecord
+def extract_university(link, html):
+    soup = parse_university_page(html)
+    acceptance_rate, average_gpa, name = parse_admissions(soup)
+    tuition = parse_tuition(soup)
+    major_list = parse_majors(soup)
+    street_address, city, state, zip_code = parse_address(soup)
+    return UniversityRecord(link, name, acceptance_rate, tuition, average_gpa, major_list, street_address, city, state, zip_code, content_hash(html))
+
+# runs first in each extraction process, a forked one starts with a copy of the parent's metrics (and of its lock,
+# which may have been held), and those would otherwise be handed back with the first record and counted twice
+def start_extraction_worker():
+    METRICS.lock = threading.Lock()
+    METRICS.reset()
+
+# runs in the extraction processes, returns the record along with the metrics recorded while making it
+def extract_item(item):
+    record = extract_university(*item)
+    return record, METRICS.drain()
+
+# takes university links and yields their UniversityRecords in order, parsing pages across a process pool
+# pages are read from the cache as the pool needs them so only a few are held in memory at once
+def extract_universities(links, workers = None, offline = False):
+    return extract_pages(((link, get_page(link, offline)) for link in links), workers)
+
+# takes (link, html) pairs and yields their UniversityRecords in order, see extract_universities
+def extract_pages(items, workers = None):
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for item in items:
+            yield extract_university(*item)
+        return
+
+    def finish(future):
+        record, metrics = future.result()
+        METRICS.merge(metrics)
+        return record
+
+    with ProcessPoolExecutor(max_workers = workers, initializer = start_extraction_worker) as executor:
+        pending = deque()
+        for item in items:
+            pending.append(executor.submit(extract_item, item))
+            if len(pending) >= workers * 4:
+                yield finish(pending.popleft())
+        while pending:
+            yield finish(pending.popleft())
+
+### GEOCODING ###
+
+# google places text search url, set the PLACES_URL environment variable (or this) to geocode against a stand-in server
+PLACES_URL = os.environ.get('PLACES_URL', 'https://maps.googleapis.com/maps/api/place/textsearch/json')
+# geocoding requests in flight at once, and universities geocoded together during a build
+GEOCODE_WORKERS = 8
+GEOCODE_BATCH_SIZE = 200
+# a failed request is tried GEOCODE_ATTEMPTS times, waiting GEOCODE_BACKOFF ms and doubling up to GEOCODE_MAX_BACKOFF ms
+GEOCODE_ATTEMPTS = 4
+GEOCODE_BACKOFF = 500
+GEOCODE_MAX_BACKOFF = 8000
+
+# raised by a geocoder when a request failed in a way that is worth retrying
+class GeocodeError(Exception):
+    pass
+
+# takes a university name, returns the key its google places result is cached under
+# so the cache survives a new api key and differences in case and punctuation
+def place_key(name):
+    return ' '.join(re.findall('[a-z0-9]+', name.lower()))
+
+# looks names up with google places text search
+# a geocoder is anything with a lookup(name) method returning google places json, see StaticGeocoder
+class GooglePlacesGeocoder:
+    def __init__(self, key = None, url = None, timeout = 10):
+        if key is None:
+            from secrets import google_places_key
+            key = google_places_key
+        self.key = key
+        self.url = url or PLACES_URL
+        self.timeout = timeout
+
+    def lookup(self, name):
+        params = {'input' : name, 'inputtype' : 'textquery', 'fields' : 'location,name', 'key' : self.key}
+        # lookup_place retries, so each lookup is a single request
+        response = http_get(self.url, attempts = 1, params = params, timeout = self.timeout)
+        if response.status_code == 429 or response.status_code >= 500:
+            raise GeocodeError(f'{response.status_code} from {self.url}')
+        response.raise_for_status()
+        page = response.text
+        status = json.loads(page).get('status')
+        if status in ('OVER_QUERY_LIMIT', 'UNKNOWN_ERROR'):
+            raise GeocodeError(status)
+        return page
+
+
+# stand-in geocoder answering from a dict of names to (lat, lng), for tests and builds without network access
+# names it doesn't know get default, or an empty result like a failed google places search if there is none
+class StaticGeocoder:
+    def __init__(self, coordinates, default = None):
+        self.coordinates = {place_key(name) : location for name, location in coordinates.items()}
+        self.default = default
+
+    def lookup(self, name):
+        location = self.coordinates.get(place_key(name), self.default)
+        if location is None:
+            return json.dumps({'results' : [], 'status' : 'ZERO_RESULTS'})
+        result = {'name' : name, 'geometry' : {'location' : {'lat' : location[0], 'lng' : location[1]}}}
+        return json.dumps({'results' : [result], 'status' : 'OK'})
+
+
+# takes google places json, returns the lat and lng of the first result or (None, None)
+def parse_place(page):
+    results = json.loads(page).get('results', [])
     # if no results, return empty
-    if len(dict['results']) == 0:
+    if len(results) == 0:
         return None, None
-    # checking accuracy of results
-    result = dict['results'][0]
     try:
-        lat = result['geometry']['location']['lat']
-        lng = result['geometry']['location']['lng']
-        return lat, lng
+        location = results[0]['geometry']['location']
+        return location['lat'], location['lng']
     except(KeyError):
-        pass
-    return
+        return None, None
+
+# takes a geocoder and a name, returns the geocoder's json, backing off exponentially between failed attempts
+def lookup_place(geocoder, name):
+    import requests
+    from retrying import Retrying
+    retryable = (GeocodeError, requests.ConnectionError, requests.Timeout)
+    retrier = Retrying(stop_max_attempt_number = GEOCODE_ATTEMPTS, wait_exponential_multiplier = GEOCODE_BACKOFF,
+                       wait_exponential_max = GEOCODE_MAX_BACKOFF, retry_on_exception = lambda error: isinstance(error, retryable))
+    return retrier.call(geocoder.lookup, name)
+
+# takes university names, returns a dict of name to (lat, lng)
+# names missing from the cache are looked up workers at a time with APP.geocoder, and each result is cached
+# as soon as it arrives so an interrupted build keeps its progress
+# names that still fail after retrying get (None, None) and are left uncached, offline raises CacheMissError instead
+@timed('build.geocode')
+def geocode_universities(names, workers = GEOCODE_WORKERS, offline = False):
+    import requests
+    coordinates = {}
+    missing = {}
+    for name in names:
+        key = place_key(name)
+        try:
+            page = APP.places[key]
+        except(KeyError):
+            if offline:
+                raise CacheMissError(key)
+            missing.setdefault(key, []).append(name)
+            continue
+        coordinates[name] = parse_place(page)
+    if not missing:
+        return coordinates
+    geocoder = APP.geocoder
+
+    def geocode(key, name):
+        try:
+            page = lookup_place(geocoder, name)
+        except(GeocodeError, requests.RequestException):
+            return None, None
+        APP.places[key] = page
+        return parse_place(page)
+
+    with ThreadPoolExecutor(max_workers = max(1, workers)) as executor:
+        futures = {key : executor.submit(geocode, key, key_names[0]) for key, key_names in missing.items()}
+        for key, future in futures.items():
+            for name in missing[key]:
+                coordinates[name] = future.result()
+    return coordinates
+
+# takes UniversityRecords, yields (record, lat, lng), geocoding batch_size records at a time
+def geocode_records(records, offline = False, batch_size = None):
+    batch_size = batch_size or GEOCODE_BATCH_SIZE
+    records = iter(records)
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if not batch:
+            return
+        coordinates = geocode_universities([record.name for record in batch], offline = offline)
+        for record in batch:
+            lat, lng = coordinates[record.name]
+            yield record, lat, lng
+
+# takes university name and returns coordinates, raising CacheMissError instead of searching if offline
+def get_coordinates_for_university(university, offline = False):
+    return geocode_universities([university], 1, offline)[university]
+
+# re-keys google places results cached under their full request url, api key included, by place_key
+def migrate_places_cache(places):
+    urls = [key for key in places if key.startswith('http')]
+    if not urls:
+        return
+    pages = {}
+    for url in urls:
+        # the name was sent with its spaces and dashes replaced by +
+        name = url.split('input=', 1)[-1].split('&inputtype=', 1)[0].replace('+', ' ')
+        key = place_key(name)
+        if key not in places and key not in pages:
+            pages[key] = places[url]
+    places.update(pages)
+    for url in urls:
+        del places[url]
 
 ### BUILDING DATABASE ###
 
-# creates class instances and builds database, returns university_list for testing
-def create_database():
-    university_list = []
-    for link in UNIVERSITY_LIST:
+# rows written per executemany while bulk loading
+LOAD_BATCH_SIZE = 2000
+
+# pragmas applied to the loading connection for the duration of a bulk load
+LOAD_PRAGMAS = {'synchronous' : 'OFF', 'cache_size' : '-65536', 'temp_store' : 'MEMORY'}
+
+# builds the database from the cached pages, returns the number of universities loaded
+# pages are parsed once each across workers processes (one per core by default)
+# everything is read from the cache, offline builds raise CacheMissError instead of fetching anything missing
+# with clear, existing rows are deleted in the same transaction so a failed build leaves the old data in place
+@timed('build.total')
+def create_database(workers = None, offline = False, clear = False):
+    create_tables(APP.engine)
+    if offline:
+        # fail before doing any work if a page is missing
+        for link in APP.links:
+            if link not in APP.pages:
+                raise CacheMissError(link)
+    # release anything the session holds so the load connection can write
+    APP.session.rollback()
+    with APP.engine.connect() as connection:
+        saved_pragmas = set_load_pragmas(connection)
+        try:
+            with connection.begin():
+                suspended = suspend_major_search(connection)
+                if clear:
+                    for table in (SourcePage, UniversityMajor, Major, Location, University):
+                        connection.execute(table.__table__.delete())
+                loaded = build_universities(connection, workers, offline)
+                resume_major_search(connection, suspended)
+                refresh_summaries(connection)
+        finally:
+            restore_pragmas(connection, saved_pragmas)
+    APP.session.expire_all()
+    data_changed()
+    return loaded
+
+# drops the triggers keeping MajorSearch in step with Major for a bulk load, returns whether there were any
+# indexing each row as its trigger fires is many times slower than rebuilding the index once the rows are in
+def suspend_major_search(connection):
+    if connection.execute("SELECT COUNT(*) FROM sqlite_master WHERE name = 'MajorSearch'").scalar() == 0:
+        return False
+    for trigger in ('Major_search_insert', 'Major_search_delete', 'Major_search_update'):
+        connection.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+    return True
+
+# rebuilds MajorSearch from Major and puts its triggers back after suspend_major_search
+@timed('build.index')
+def resume_major_search(connection, suspended):
+    if suspended:
+        connection.execute("INSERT INTO MajorSearch (MajorSearch) VALUES ('rebuild')")
+        for statement in MAJOR_SEARCH_SQL[1:]:
+            connection.execute(statement)
+
+# switches the connection to fast, non-durable loading settings, returns the previous settings
+def set_load_pragmas(connection):
+    saved = {}
+    pragmas = dict(LOAD_PRAGMAS)
+    journal_mode = connection.execute('PRAGMA journal_mode').scalar()
+    # wal is already cheap to load into and can't be left while other connections are open
+    if journal_mode.lower() != 'wal':
+        pragmas['journal_mode'] = 'MEMORY'
+    for pragma, value in pragmas.items():
+        saved[pragma] = connection.execute(f'PRAGMA {pragma}').scalar()
+        connection.execute(f'PRAGMA {pragma} = {value}')
+    return saved
+
+def restore_pragmas(connection, saved):
+    for pragma, value in saved.items():
+        connection.execute(f'PRAGMA {pragma} = {value}')
+
+# extracts every cached university and writes its rows, see load_universities
+def build_universities(connection, workers, offline):
+    return load_universities(connection, geocode_records(extract_universities(APP.links, workers, offline), offline))
+
+# takes (UniversityRecord, lat, lng) triples and writes their rows with batched executemany inserts,
+# flushing each batch as it fills so memory stays flat however many universities and majors there are
+# returns the number of universities loaded
+# ids are given out here rather than by sqlite, so the rows referring to a university or major go in the same batches
+def load_universities(connection, located_records):
+    loaded = 0
+    batches = {University : [], Location : [], Major : [], UniversityMajor : [], SourcePage : []}
+    university_id = connection.execute(select([func.max(University.id)])).scalar() or 0
+    major_ids = {major : major_id for major_id, major in connection.execute(select([Major.id, Major.major]))}
+    next_major_id = max(major_ids.values(), default = 0)
+
+    def flush(table):
+        if batches[table]:
+            connection.execute(table.__table__.insert(), batches[table])
+            batches[table] = []
+
+    for record, lat, lng in located_records:
+        university_id += 1
         # creating universities
-        tuition = get_tuition_data(link)
-        acceptance_rate, average_gpa, university_name = get_admissions_data(link)
-        lat, lng = get_coordinates_for_university(university_name)
-        university = University(university_name, acceptance_rate, tuition, average_gpa, lat, lng)
-        university_list.append(university)
-        session.add(university)
-        major_list = get_academics_data(link)
-        # creating majors
-        for major_name in major_list:
-            major = Major(university_name, major_name)
-            session.add(major)
+        loaded += 1
+        batches[University].append({'id' : university_id, 'name' : record.name, 'acceptance' : record.acceptance, 'tuition' : record.tuition, 'gpa' : record.gpa, 'lat' : lat, 'lng' : lng})
+        # creating majors, each new one added to Major once
+        linked = set()
+        for major_name in record.majors:
+            if major_name not in major_ids:
+                next_major_id += 1
+                major_ids[major_name] = next_major_id
+                batches[Major].append({'id' : next_major_id, 'major' : major_name})
+            if major_ids[major_name] not in linked:
+                linked.add(major_ids[major_name])
+                batches[UniversityMajor].append({'university_id' : university_id, 'major_id' : major_ids[major_name]})
         # creating addresses
-        street_address, city, state, zip_code = get_visit_data(link)
-        location = Location(university_name, street_address, city, state, zip_code)
-        session.add(location)
+        batches[Location].append({'university_id' : university_id, 'address' : record.address, 'city' : record.city, 'state' : record.state, 'zip_code' : record.zip_code})
+        batches[SourcePage].append({'link' : record.link, 'name' : record.name, 'content_hash' : record.content_hash})
+        for table in batches:
+            if len(batches[table]) >= LOAD_BATCH_SIZE:
+                flush(table)
+    for table in batches:
+        flush(table)
+    return loaded
+
+# deletes a university's rows from every table, majors no longer linked to any university stay in Major
+def delete_university(session, name):
+    university_id = session.query(University.id).filter(University.name == name).scalar()
+    if university_id is None:
+        return
+    changed_summaries(session).update(university_summary_keys(session, name))
+    session.query(UniversityMajor).filter(UniversityMajor.university_id == university_id).delete(synchronize_session = False)
+    session.query(Location).filter(Location.university_id == university_id).delete(synchronize_session = False)
+    session.query(University).filter(University.id == university_id).delete(synchronize_session = False)
+
+# takes major names, returns their ids in Major in the same order without repeats, adding any it doesn't have yet
+def intern_majors(session, majors):
+    known = dict(session.query(Major.major, Major.id).filter(Major.major.in_(set(majors)))) if majors else {}
+    for major_name in majors:
+        if major_name not in known:
+            major = Major(major_name)
+            session.add(major)
+            session.flush()
+            known[major_name] = major.id
+    return list(OrderedDict.fromkeys(known[major_name] for major_name in majors))
+
+# adds or replaces a university's rows from its UniversityRecord, returns whether it already existed
+def upsert_university(session, record, lat, lng):
+    university = session.query(University).filter(University.name == record.name).first()
+    existed = university is not None
+    keys = changed_summaries(session)
+    if existed:
+        keys.update(university_summary_keys(session, record.name))
+    keys.update(summary_keys(record.state, record.majors))
+    if university is None:
+        university = University(record.name, record.acceptance, record.tuition, record.gpa, lat, lng)
+        session.add(university)
+        session.flush()
+    else:
+        university.acceptance, university.tuition, university.gpa, university.lat, university.lng = record.acceptance, record.tuition, record.gpa, lat, lng
+    session.merge(Location(university.id, record.address, record.city, record.state, record.zip_code))
+    session.query(UniversityMajor).filter(UniversityMajor.university_id == university.id).delete(synchronize_session = False)
+    links = [{'university_id' : university.id, 'major_id' : major_id} for major_id in intern_majors(session, record.majors)]
+    if links:
+        session.execute(UniversityMajor.__table__.insert(), links)
+    session.merge(SourcePage(record.link, record.name, record.content_hash))
+    return existed
+
+# updates the database from the cache, re-extracting only pages whose html hash changed since the last build
+# all changes are made in one transaction, returns a dict of the university names added, updated and removed
+@timed('build.update')
+def update_database(workers = None, offline = False):
+    create_tables(APP.engine)
+    session = APP.session
+    known = {source.link : source for source in session.query(SourcePage)}
+    links = list(APP.links)
+    changed = []
+    for link in links:
+        html = get_page(link, offline)
+        if link not in known or known[link].content_hash != content_hash(html):
+            changed.append(link)
+    report = {'added' : [], 'updated' : [], 'removed' : []}
+    try:
+        for link in set(known) - set(links):
+            delete_university(session, known[link].name)
+            session.delete(known[link])
+            report['removed'].append(known[link].name)
+        for record, lat, lng in geocode_records(extract_universities(changed, workers, offline), offline):
+            # drop the old rows if the page now names a different university
+            if record.link in known and known[record.link].name != record.name:
+                delete_university(session, known[record.link].name)
+            if upsert_university(session, record, lat, lng):
+                report['updated'].append(record.name)
+            else:
+                report['added'].append(record.name)
+        refresh_changed_summaries(session)
+    except:
+        session.rollback()
+        changed_summaries(session).clear()
+        raise
     session.commit()
-    return university_list
+    if report['added'] or report['updated'] or report['removed']:
+        data_changed()
+    return report
    
-### DISPLAY FUNCTIONS ###
+### SUMMARIES ###
 
-# takes result set and launches distribution of tuition
-def tuition_distrubution(results):
-    universities = []
-    tuition = []
-    # if user requests 'major=', results will be resultset and not just universities
-    if type(results[0]) == University:
-         universities = results       
+# measures summarized for each group, in the order they are shown
+SUMMARY_MEASURES = ['tuition', 'acceptance', 'gpa']
+# statistics stored for each measure, the same ones column_summary gives
+SUMMARY_STATISTICS = ['count', 'mean', 'min', 'p25', 'median', 'p75', 'p90', 'max']
+# past this many states or majors to refresh, their groups are all recomputed instead of filtered with IN (...)
+SUMMARY_MAX_FILTER = 500
+
+# takes values, returns SUMMARY_STATISTICS of those that aren't missing (None or 0), or a count of 0 and Nones
+# percentiles are interpolated between the closest values, the way numpy.percentile does
+def value_summary(values):
+    values = sorted(value for value in values if value)
+    if not values:
+        return (0,) + (None,) * (len(SUMMARY_STATISTICS) - 1)
+
+    def percentile(q):
+        position = (len(values) - 1) * q / 100
+        low = int(position)
+        high = min(low + 1, len(values) - 1)
+        return values[low] + (values[high] - values[low]) * (position - low)
+
+    return len(values), sum(values) / len(values), values[0], percentile(25), percentile(50), percentile(75), percentile(90), values[-1]
+
+# takes a university's state and majors, returns the (state, major) keys of the Summary groups it is counted in
+def summary_keys(state, majors):
+    keys = {('', '')}
+    if state:
+        keys.add((state, ''))
+    for major in majors:
+        keys.add(('', major.lower()))
+        if state:
+            keys.add((state, major.lower()))
+    return keys
+
+# takes a session and a university name, returns summary_keys of the university's rows in the database
+def university_summary_keys(session, name):
+    university_id = session.query(University.id).filter(University.name == name).scalar()
+    state = session.query(Location.state).filter(Location.university_id == university_id).scalar()
+    majors = [major for major, in session.query(Major.major).join(UniversityMajor).filter(UniversityMajor.university_id == university_id)]
+    return summary_keys(state, majors)
+
+# the keys of Summary groups changed in the session since they were last refreshed, see refresh_changed_summaries
+def changed_summaries(session):
+    return session.info.setdefault('summary_keys', set())
+
+# recomputes the Summary groups changed in the session, in its transaction, so they are committed along with the changes
+def refresh_changed_summaries(session):
+    keys = changed_summaries(session)
+    if keys:
+        session.flush()
+        refresh_summaries(session.connection(), keys)
+        keys.clear()
+
+# takes a connection and lowercase major names, or None for every major, returns a dict of each name found to the id
+# its Summary groups are kept under, the first of the ids its spellings have in Major
+def summary_major_ids(connection, majors = None):
+    query = select([func.lower(Major.major), func.min(Major.id)]).group_by(func.lower(Major.major))
+    if majors is not None and len(majors) <= SUMMARY_MAX_FILTER:
+        query = query.where(func.lower(Major.major).in_(majors))
+    return dict(connection.execute(query).fetchall())
+
+# takes a connection and the (state, major) keys of Summary groups, recomputes those groups from the universities in them
+# without keys every group is recomputed, groups left without universities are deleted
+# groups are stored under the major's id in summary_major_ids, or 0 for every major
+@timed('build.summaries')
+def refresh_summaries(connection, keys = None):
+    summary = Summary.__table__
+    values = [University.tuition, University.acceptance, University.gpa]
+    groups = {}
+    majors = None if keys is None else {major for state, major in keys if major}
+    ids = summary_major_ids(connection, majors) if majors is None or majors else {}
+    if keys is not None:
+        keys = {(state, ids[major] if major else 0) for state, major in keys if not major or major in ids}
+
+    def add(key, row):
+        group = groups.setdefault(key, [])
+        group.append(row)
+
+    if keys is None or ('', 0) in keys:
+        for row in connection.execute(select(values)):
+            add(('', 0), row)
+    states = None if keys is None else {state for state, major_id in keys if state and not major_id}
+    if states is None or states:
+        query = select([Location.state] + values).select_from(University.__table__.join(Location.__table__, Location.university_id == University.id))
+        if states is not None and len(states) <= SUMMARY_MAX_FILTER:
+            query = query.where(Location.state.in_(states))
+        for state, *row in connection.execute(query):
+            if state and (states is None or state in states):
+                add((state, 0), row)
+    if majors is None or majors:
+        query = select([Location.state, Major.major, University.id] + values).select_from(
+            University.__table__.join(UniversityMajor.__table__, UniversityMajor.university_id == University.id).join(Major.__table__, Major.id == UniversityMajor.major_id)
+            .outerjoin(Location.__table__, Location.university_id == University.id))
+        if majors is not None and len(majors) <= SUMMARY_MAX_FILTER:
+            query = query.where(func.lower(Major.major).in_(majors))
+        seen = set()
+        for state, major, university_id, *row in connection.execute(query):
+            # a major listed twice in different cases counts its university once
+            major_id = ids.get(major.lower())
+            if major_id is None or (university_id, major_id) in seen:
+                continue
+            seen.add((university_id, major_id))
+            if keys is None or ('', major_id) in keys:
+                add(('', major_id), row)
+            if state and (keys is None or (state, major_id) in keys):
+                add((state, major_id), row)
+    rows = []
+    for (state, major_id), group in groups.items():
+        for position, measure in enumerate(SUMMARY_MEASURES):
+            statistics = value_summary([row[position] for row in group])
+            rows.append(dict(zip(SUMMARY_STATISTICS, statistics), state = state, major_id = major_id, measure = measure, universities = len(group)))
+    if keys is None:
+        connection.execute(summary.delete())
+    elif keys:
+        connection.execute(summary.delete().where(and_(summary.c.state == bindparam('key_state'), summary.c.major_id == bindparam('key_major_id'))),
+                           [{'key_state' : state, 'key_major_id' : major_id} for state, major_id in keys])
+    if rows:
+        connection.execute(summary.insert(), rows)
+
+SummaryParams = namedtuple('SummaryParams', ['state', 'major', 'by'])
+
+# takes a summary command, returns its SummaryParams or None if the command is invalid
+# state= and major= pick the group, by=state or by=major lists the group for every state or major instead
+def parse_summary(command):
+    state = ''
+    major = ''
+    by = None
+    for parameter in command.split()[1:]:
+        if parameter.startswith('state=') and len(parameter) > 6:
+            state = parameter[6:].upper()
+        elif parameter.startswith('major=') and len(parameter) > 6:
+            major = parameter[6:].replace('_', ' ').lower()
+        elif parameter in ('by=state', 'by=major'):
+            by = parameter[3:]
+        else:
+            return None
+    if (by == 'state' and state) or (by == 'major' and major):
+        return None
+    return SummaryParams(state, major, by)
+
+# takes SummaryParams, returns a list of (state, major, {measure : {statistic : value}}) from the Summary table
+# the major is looked up in Major once, then each group is an index lookup however many universities it summarizes
+@timed('summary.lookup')
+def run_summary(params, session = None):
+    session = session or APP.session
+    major_id = 0
+    if params.major:
+        major_id = summary_major_ids(session.connection(), {params.major}).get(params.major)
+        if major_id is None:
+            return []
+    major = func.coalesce(func.lower(Major.major), '')
+    query = session.query(Summary, major).outerjoin(Major, Major.id == Summary.major_id)
+    if params.by != 'state':
+        query = query.filter(Summary.state == params.state)
     else:
-        for result in results:
-            universities.append(result[0])
-    for university in universities:
-        tuition.append(university.tuition)
-    fig = go.Figure(data = [go.Histogram(x = tuition)])
-    fig.show()
-    return
+        query = query.filter(Summary.state != '')
+    if params.by != 'major':
+        query = query.filter(Summary.major_id == major_id)
+    else:
+        query = query.filter(Summary.major_id != 0)
+    groups = OrderedDict()
+    for row, major_name in query.order_by(Summary.state, major):
+        group = groups.setdefault((row.state, major_name), {})
+        group[row.measure] = dict({statistic : getattr(row, statistic) for statistic in SUMMARY_STATISTICS}, universities = row.universities)
+    return [(state, major, measures) for (state, major), measures in groups.items()]
 
-# takes result set and launches map of results
-def plot_universities(results):
-    universities = []
-    # if user requests 'major=', results will be resultset and not just universities
-    if type(results[0]) == University:
-         universities = results       
+# takes a summary command, prints the statistics it asks for and returns them, or BAD_COMMAND
+def process_summary(command, session = None):
+    params = parse_summary(command)
+    if params is None:
+        return BAD_COMMAND
+    groups = run_summary(params, session)
+    if not groups:
+        print('\nNo universities matched your parameters.')
+    elif params.by:
+        print(f'\n{params.by.capitalize():<40}{"count":>7}' + ''.join(f'{measure + " median":>20}' for measure in SUMMARY_MEASURES))
+        for state, major, measures in groups:
+            medians = [measures[measure]['median'] for measure in SUMMARY_MEASURES]
+            print(f'{(state if params.by == "state" else major)[:39]:<40}{measures["tuition"]["universities"]:>7}' + ''.join(f'{median:>20.2f}' if median is not None else f'{"-":>20}' for median in medians))
     else:
-        for result in results:
-            universities.append(result[0])
-    lat_list = []
-    lng_list = []
-    name_list = []
-    for university in universities:
-        lat = university.lat
-        lng = university.lng
-        if not (lat and lng):
-            continue
+        state, major, measures = groups[0]
+        print(f'\n{", ".join(part for part in (state, major) if part) or "All universities"} ({measures["tuition"]["universities"]} universities)')
+        for measure in SUMMARY_MEASURES:
+            summary = measures[measure]
+            if summary['count'] == 0:
+                print(f'\n{measure.capitalize()}: no data')
+                continue
+            print(f"\n{measure.capitalize()} ({summary['count']} universities): mean {summary['mean']:.2f}, median {summary['median']:.2f}, min {summary['min']:.2f}, 25th percentile {summary['p25']:.2f}, 75th percentile {summary['p75']:.2f}, 90th percentile {summary['p90']:.2f}, max {summary['max']:.2f}")
+    return groups
+
+### PIPELINE ###
+
+# universities upserted between commits, each commit is a checkpoint an interrupted run resumes after
+PIPELINE_COMMIT_SIZE = 100
+
+# takes a number of browse pages, yields the links of universities on them not seen before
+# each link is saved to APP.links before it is yielded, and the browse page reached is checkpointed after each page,
+# so a run started after an interrupted one carries on from the page after the last one finished
+def discover_links(num_pages, crawler = None, offline = False):
+    from bs4 import BeautifulSoup as bs
+    key = discovery_key()
+    state = json.loads(APP.checkpoints[key]) if key in APP.checkpoints else {'pages' : 0, 'link' : PRINCETON_REVIEW_URL + '/college-search'}
+    while state['pages'] < num_pages:
+        if offline:
+            raise CacheMissError(state['link'])
+        if crawler:
+            html = crawler.get(state['link'])
         else:
-            lat_list.append(lat)
-            lng_list.append(lng)
-            name_list.append(university.name)
+            response = http_get(state['link'])
+            response.raise_for_status()
+            html = response.text
+        soup = bs(html, 'html.parser')
+        for link in university_links(soup):
+            if link not in APP.links:
+                APP.links.append(link)
+                METRICS.count('pipeline.discovered')
+                yield link
+        state = {'pages' : state['pages'] + 1, 'link' : next_browse_link(soup)}
+        APP.checkpoints[key] = json.dumps(state)
+
+# the checkpoint discover_links keeps the browse page it reached under, until run_pipeline finishes
+def discovery_key():
+    return 'discovery ' + PRINCETON_REVIEW_URL
+
+# takes links, yields them in order once their pages are cached, fetching up to the crawler's max_in_flight at a time
+# with refresh, cached pages are revalidated too, see fetch_page
+def fetch_pages(links, crawler = None, offline = False, refresh = False):
+    pending = deque()
+    window = crawler.max_in_flight if crawler else 1
+    for link in links:
+        future = None
+        if (refresh and not offline) or link not in APP.pages:
+            if offline:
+                raise CacheMissError(link)
+            if crawler:
+                future = crawler.submit(link)
+            else:
+                fetch_page(link)
+            METRICS.count('pipeline.fetched')
+        pending.append((link, future))
+        while pending and (len(pending) > window or pending[0][1] is None or pending[0][1].done()):
+            link, future = pending.popleft()
+            if future is not None:
+                future.result()
+            yield link
+    while pending:
+        link, future = pending.popleft()
+        if future is not None:
+            future.result()
+        yield link
+
+# takes cached links, yields (link, html) for those whose page changed since it was last loaded into the database
+def changed_pages(links, session):
+    for link in links:
+        html = APP.pages[link]
+        loaded = session.query(SourcePage.content_hash).filter(SourcePage.link == link).scalar()
+        if loaded == content_hash(html):
+            METRICS.count('pipeline.unchanged')
+            continue
+        yield link, html
+
+# crawls num_pages browse pages into the database in one streaming pass: links are discovered, fetched, extracted,
+# geocoded and upserted as they go, every stage holding only a bounded number of universities at once
+# pages and links are cached as they arrive and the database is committed every PIPELINE_COMMIT_SIZE universities,
+# so an interrupted run can simply be run again: it skips whatever was already loaded and carries on crawling
+# with refresh every cached page is revalidated as well, so pages changed since they were fetched are loaded again
+# returns a dict of the university names added and updated
+@timed('pipeline.total')
+def run_pipeline(num_pages = 11, workers = CRAWL_WORKERS, rate = CRAWL_RATE, extract_workers = None, offline = False, refresh = False):
+    create_tables(APP.engine)
+    session = APP.session
+    APP.checkpoints['pipeline'] = 'running'
+    crawler = Crawler(workers, rate) if workers > 1 and not offline else None
+    report = {'added' : [], 'updated' : []}
+    uncommitted = 0
+    try:
+        # links from an earlier, interrupted run come first so universities keep the order they were listed in
+        links = itertools.chain(list(APP.links), discover_links(num_pages, crawler, offline))
+        pages = changed_pages(fetch_pages(links, crawler, offline, refresh), session)
+        for record, lat, lng in geocode_records(extract_pages(pages, extract_workers), offline):
+            known = session.query(SourcePage).filter(SourcePage.link == record.link).first()
+            # drop the old rows if the page now names a different university
+            if known is not None and known.name != record.name:
+                delete_university(session, known.name)
+            with METRICS.timer('pipeline.upsert'):
+                existed = upsert_university(session, record, lat, lng)
+            report['updated' if existed else 'added'].append(record.name)
+            uncommitted += 1
+            if uncommitted >= PIPELINE_COMMIT_SIZE:
+                refresh_changed_summaries(session)
+                session.commit()
+                uncommitted = 0
+        refresh_changed_summaries(session)
+        session.commit()
+        # the next run walks the browse pages from the start again, to find universities listed since
+        APP.checkpoints.pop(discovery_key(), None)
+        APP.checkpoints['pipeline'] = 'finished'
+    except BaseException:
+        session.rollback()
+        changed_summaries(session).clear()
+        raise
+    finally:
+        if crawler:
+            crawler.close()
+        if report['added'] or report['updated']:
+            data_changed()
+    return report
+
+# whether a run_pipeline was interrupted and hasn't been run again to the end
+def pipeline_interrupted():
+    return APP.checkpoints.get('pipeline') == 'running'
+
+### DISPLAY FUNCTIONS ###
+
+# above this many points the map shows clusters instead of every university
+PLOT_MAX_POINTS = 2000
+# bars shown by the tuition graph before the rest are grouped into one "Other" bar
+PLOT_TOP_N = 50
+# bins the tuition distribution is counted into
+PLOT_BINS = 40
+
+# plots written to html pages, one per plot of a result set, so showing the same plot again only reopens its page
+# the pages share one copy of plotly.js and the least recently used are deleted past maxsize
+class FigureCache:
+    def __init__(self, directory, maxsize = 32):
+        self.directory = directory
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.written = 0
+
+    # takes a plot name, results and a function making the figure from result_columns, returns the path of its page
+    def page(self, kind, results, make_figure):
+        key = (kind, len(results), hash(tuple(results)))
+        with self.lock:
+            path = self.entries.get(key)
+            if path is not None and os.path.exists(path):
+                self.entries.move_to_end(key)
+                METRICS.count('plot.cache.hit')
+                return path
+        METRICS.count('plot.cache.miss')
+        with METRICS.timer(f'plot.{kind}'):
+            figure = make_figure(result_columns(results))
+        with self.lock:
+            self.written += 1
+            path = os.path.join(self.directory, f'{kind}-{self.written}.html')
+            with METRICS.timer('plot.write'):
+                figure.write_html(path, include_plotlyjs = 'directory', auto_open = False)
+            self.entries[key] = path
+            while len(self.entries) > self.maxsize:
+                old_key, old_path = self.entries.popitem(last = False)
+                if os.path.exists(old_path):
+                    os.remove(old_path)
+        return path
+
+# takes the path of a plot's page and opens it in the browser
+def show_page(path):
+    import webbrowser
+    webbrowser.open_new_tab('file://' + os.path.abspath(path))
+
+# takes result columns, returns a histogram of tuition counted here so the figure holds only the bins
+def tuition_histogram(columns):
+    import numpy as np
+    import plotly.graph_objs as go
+    tuition = columns['tuition'][~np.isnan(columns['tuition'])]
+    counts, edges = np.histogram(tuition, bins = PLOT_BINS)
+    return go.Figure(data = [go.Bar(x = (edges[:-1] + edges[1:]) / 2, y = counts, width = np.diff(edges))],
+                     layout = go.Layout(bargap = 0, xaxis = go.layout.XAxis(title = 'Tuition'), yaxis = go.layout.YAxis(title = 'Universities')))
+
+# takes result columns, returns a bar graph of tuition
+# past PLOT_TOP_N universities only the most expensive get bars, and the rest are one bar at their mean tuition
+def tuition_bars(columns):
+    import numpy as np
+    import plotly.graph_objs as go
+    names, tuition = columns['name'], columns['tuition']
+    if len(names) > PLOT_TOP_N:
+        order = np.argsort(-np.nan_to_num(tuition), kind = 'stable')
+        top, rest = order[:PLOT_TOP_N], order[PLOT_TOP_N:]
+        names = np.append(names[top], f'Other ({len(rest)} universities, mean)')
+        tuition = np.append(tuition[top], np.nanmean(tuition[rest]) if np.any(~np.isnan(tuition[rest])) else 0.0)
+    return go.Figure([go.Bar(x = names, y = tuition)])
+
+# takes arrays of latitudes, longitudes and names, returns them merged into at most PLOT_MAX_POINTS clusters
+# as (lats, lngs, labels, counts), each cluster placed at the mean of its universities
+# clusters are grid cells, doubled in size until there are few enough of them
+def cluster_points(lat, lng, names):
+    import numpy as np
+    if len(lat) <= PLOT_MAX_POINTS:
+        return lat, lng, names, np.ones(len(lat), dtype = int)
+    size = 0.25
+    while True:
+        cells = np.floor(lat / size) * 100000 + np.floor(lng / size)
+        keys, inverse, counts = np.unique(cells, return_inverse = True, return_counts = True)
+        if len(keys) <= PLOT_MAX_POINTS:
+            break
+        size *= 2
+    cluster_lat = np.bincount(inverse, weights = lat) / counts
+    cluster_lng = np.bincount(inverse, weights = lng) / counts
+    # a cluster of one keeps its university's name
+    first = np.zeros(len(keys), dtype = int)
+    first[inverse[::-1]] = np.arange(len(inverse))[::-1]
+    labels = np.where(counts == 1, names[first], np.char.add(counts.astype(str), ' universities').astype(object))
+    return cluster_lat, cluster_lng, labels, counts
+
+# takes result columns, returns a map of the universities with coordinates
+def university_map(columns):
+    import numpy as np
+    import plotly.graph_objs as go
+    from secrets import mapbox_key
+    lat = columns['lat']
+    lng = columns['lng']
+    # skips universities without coordinates
+    mapped = ~(np.isnan(lat) | np.isnan(lng) | (lat == 0.0) | (lng == 0.0))
+    lat_list, lng_list, name_list, counts = cluster_points(lat[mapped], lng[mapped], columns['name'][mapped])
     # creates plot
     fig = go.Figure(go.Scattermapbox(
         lat=lat_list,
         lon=lng_list,
         mode='markers',
         marker=go.scattermapbox.Marker(
-            size=9
+            size=9 + 4 * np.log2(counts)
         ),
-        text=name_list
+        text=name_list,
+        customdata=counts
     ))
     # adds map to plot
     fig.update_layout(
@@ -373,134 +1919,867 @@ def plot_universities(results):
             accesstoken=mapbox_key,
             bearing=0,
             center=go.layout.mapbox.Center(
-                lat=np.mean(lat_list),
-                lon=np.mean(lng_list)
+                lat=np.mean(lat[mapped]),
+                lon=np.mean(lng[mapped])
             ),
             pitch=0,
             zoom=2.75
         )
     )
-    fig.show()
-    return
- 
+    return fig
+
+# takes result set and launches distribution of tuition
+def tuition_distrubution(results):
+    show_page(APP.figures.page('distribution', results, tuition_histogram))
+
+# takes result set and launches map of results
+def plot_universities(results):
+    show_page(APP.figures.page('map', results, university_map))
+
 # takes result set and launches bar graph of tuition
 def graph_tuition(results):
-    universities = []
-    # if user requests 'major=', results will be resultset and not just universities
-    if type(results[0]) == University:
-         universities = results       
+    show_page(APP.figures.page('graph', results, tuition_bars))
+
+# takes result set and prints summary statistics of its tuition, acceptance rate and gpa
+def describe_results(results):
+    columns = result_columns(results)
+    for column in ('tuition', 'acceptance', 'gpa'):
+        summary = column_summary(columns[column])
+        if summary['count'] == 0:
+            print(f'\n{column.capitalize()}: no data')
+            continue
+        print(f"\n{column.capitalize()} ({summary['count']} universities): mean {summary['mean']:.2f}, median {summary['median']:.2f}, min {summary['min']:.2f}, 25th percentile {summary['p25']:.2f}, 75th percentile {summary['p75']:.2f}, 90th percentile {summary['p90']:.2f}, max {summary['max']:.2f}")
+        histogram = summary['histogram']
+        for count, low, high in zip(histogram['counts'], histogram['edges'], histogram['edges'][1:]):
+            print(f'    {low:>10.2f} - {high:<10.2f} {count}')
+
+# page search results are written to and opened from
+RESULTS_PAGE = 'university.html'
+
+# takes command, results and an open file, writes the results page to it a row at a time
+@timed('render.results')
+def render_search_results(command, results, out):
+    if isinstance(results[0], SearchResult):
+        is_university = True
+        template = APP.templates.get_template('html.html')
     else:
-        for result in results:
-            universities.append(result[0])
-    name_list = []
-    tuition_list = []
-    for university in universities:
-        name_list.append(university.name)
-        tuition_list.append(university.tuition)
-    fig = go.Figure([go.Bar(x=name_list, y=tuition_list)])
-    fig.show()
+        is_university = False
+        template = APP.templates.get_template('major_temp.html')
+    acceptance = 'acceptance' in command
+    gpa = 'gpa' in command
+    tuition = 'tuition' in command
+    distance = 'near=' in command
+    out.writelines(template.generate(results=results, command=command, tuition=tuition, is_university=is_university, gpa=gpa, acceptance=acceptance, distance=distance))
 
 # takes results and displays them in an html table
+@timed('display.results')
 def display_search_results(command, results):
-    gpa = False
-    acceptance = False
-    is_university = False
-    tuition = False
-    if type(results[0]) == University:
-        is_university = True
-        file = open('html.html', 'r')
-        contents = file.read()
-        file.close()
-    else:
-        file = open('major_temp.html', 'r')
-        contents = file.read()
-        file.close()
-    if 'acceptance' in command:
-        acceptance = True
-    if 'gpa' in command:
-        gpa = True
-    if 'tuition' in command:
-        tuition = True
+    import webbrowser
     print('\nLaunching matching results...')
-    template = Template(contents)
-    html =  template.render(results=results, command=command, tuition=tuition, is_university=is_university, gpa=gpa, acceptance=acceptance)
-    f = open('university.html', 'w')
-    f.write(html)
-    f.close
-    webbrowser.open_new('university.html')
+    with open(RESULTS_PAGE, 'w') as out:
+        render_search_results(command, results, out)
+    webbrowser.open_new(RESULTS_PAGE)
 
 
 ### USER INTERFACE ###
 
-# takes validified university search, converts it to a query, and returns query results
-def process_university_search(command):
+BAD_COMMAND = 'Bad command, please try again.'
+
+# one row of search results, holding only the columns results are displayed, mapped and graphed with
+# distance is in km from the point of a near= search, None otherwise
+SearchResult = namedtuple('SearchResult', ['name', 'acceptance', 'tuition', 'gpa', 'lat', 'lng', 'state', 'distance'], defaults = (None,))
+
+# a parsed search, None for anything not filtered on
+# acceptance and gpa are (low, high) ranges and sort is a column name, with '-' in front for descending
+# near is a (lat, lng) point results are ordered by distance from, and radius a distance in km they must be within
+SearchParams = namedtuple('SearchParams', ['state', 'major', 'tuition', 'acceptance', 'gpa', 'limit', 'offset', 'sort', 'near', 'radius'], defaults = (None, None))
+
+# columns search results can be sorted by
+SORT_COLUMNS = {'name' : University.name, 'tuition' : University.tuition, 'acceptance' : University.acceptance, 'gpa' : University.gpa, 'count' : func.count(UniversityMajor.major_id)}
+
+# takes a range parameter value like '10-30' or '30', returns (low, high)
+# a single number is the high end for acceptance and the low end for gpa
+def parse_range(value, single_is_high):
+    if '-' in value:
+        low, high = value.split('-', 1)
+        return float(low), float(high)
+    if single_is_high:
+        return None, float(value)
+    return float(value), None
+
+# takes a search command, returns its SearchParams or None if the command is invalid
+def parse_university_search(command):
     parameters = command.split()
     major = None
-    acceptance = False
     limit = 10
+    offset = 0
     tuition = None
     state = None
-    for parameter in parameters:
-        if parameter.startswith('state'):
-            state = parameter[6:].upper()
-        elif parameter.startswith('major'):
-            major = '%' + parameter[6:].replace('_', ' ') + '%'
-        elif parameter.startswith('tuition'):
-            try:
+    acceptance = None
+    gpa = None
+    sort = None
+    near = None
+    radius = None
+    nearest = None
+    try:
+        for parameter in parameters:
+            if parameter.startswith('state='):
+                state = parameter[6:].upper()
+            elif parameter.startswith('major='):
+                major = parameter[6:].replace('_', ' ').lower()
+            elif parameter.startswith('tuition='):
                 tuition = float(parameter[8:])
-            except(ValueError):
-                return 'Bad command, please try again.'
-        elif parameter.startswith('limit'):
-            try:
+            elif parameter.startswith('limit='):
                 limit = int(parameter[6:])
-            except(ValueError):
-                return 'Bad command, please try again.'
-        elif parameter in ('search','acceptance','gpa'):
-            pass
-        else:
-            return 'Bad command, please try again.'
-    # if major, tuition, and state have been specified
-    if major and tuition and state:
-        results = session.query(University,func.count(University.name)).join(Location).join(Major).filter(Major.major.like(major)).filter(University.tuition <= tuition).filter(University.tuition>0.0).filter(Location.state == state).group_by(University.name).all()
-        return results[0:limit]  
-    # if major and tuition are specified
-    elif major and tuition and not state:
-        results = session.query(University,func.count(University.name)).join(Major).filter(Major.major.like(major)).filter(text(f'University.tuition < {tuition}')).filter(University.tuition>0.0).group_by(Major.name).all()
-        return results[0:limit] 
-    # if tuition and state are specified
-    elif not major and tuition and state:
-        results = session.query(University).join(Location).filter(University.tuition <= tuition).filter(University.tuition>0.0).filter(Location.state == state).all()
-        return results[0:limit] 
-    # if major and state are specified
-    elif major and not tuition and state:
-        results = session.query(University,func.count(University.name)).join(Location).join(Major).filter(Major.major.like(major)).filter(Location.state == state).group_by(University.name).all()
-        return results[0:limit]
-    # if major is specified
-    elif major and not tuition and not state:
-        results = session.query(University,func.count(University.name)).join(Major).filter(Major.major.like(major)).group_by(University.name).all()
-        return results[0:limit]
-    # if tuition is specified
-    elif not major and tuition and not state:
-        results = session.query(University).filter(University.tuition <= tuition).filter(University.tuition>0.0)
-        return results[0:limit]
-    # if state is specified
-    elif not major and not tuition and state:
-        results = session.query(University).join(Location).filter(Location.state == state).all()
-        return results[0:limit]
+            elif parameter.startswith('offset='):
+                offset = int(parameter[7:])
+            elif parameter.startswith('acceptance='):
+                acceptance = parse_range(parameter[11:], True)
+            elif parameter.startswith('gpa='):
+                gpa = parse_range(parameter[4:], False)
+            elif parameter.startswith('near='):
+                lat, lng = parameter[5:].split(',')
+                near = (float(lat), float(lng))
+                if not (-90.0 <= near[0] <= 90.0 and -180.0 <= near[1] <= 180.0):
+                    return None
+            elif parameter.startswith('radius='):
+                radius = float(parameter[7:])
+            elif parameter.startswith('nearest='):
+                nearest = int(parameter[8:])
+            elif parameter.startswith('sort='):
+                sort = parameter[5:]
+                if sort.lstrip('-') not in SORT_COLUMNS or (sort.lstrip('-') == 'count' and not major):
+                    return None
+            elif parameter in ('search','acceptance','gpa'):
+                pass
+            else:
+                return None
+    except(ValueError):
+        return None
+    if limit < 0 or offset < 0:
+        return None
+    # radius and nearest only mean something with a point to measure from
+    if (radius is not None or nearest is not None) and not near:
+        return None
+    if radius is not None and radius <= 0.0:
+        return None
+    if nearest is not None:
+        if nearest <= 0:
+            return None
+        limit = nearest
+    if not (major or tuition or state or acceptance or gpa or near):
+        return None
+    return SearchParams(state, major, tuition, acceptance, gpa, limit, offset, sort, near, radius)
+
+# takes a column and a (low, high) range, returns the filters for it
+def range_filters(column, value_range):
+    low, high = value_range
+    filters = [column > 0.0]
+    if low is not None:
+        filters.append(column >= low)
+    if high is not None:
+        filters.append(column <= high)
+    return filters
+
+# takes SearchParams, returns a query for just the columns in SearchResult (and the major count for major searches)
+# every filter is a bound parameter, and the ordering, limit and offset are applied by the database
+# names limits the query to those universities, and paginate=False leaves off the limit and offset
+# the major term is looked up in Major once, callers building several queries for one search can pass its ids in
+def build_university_query(session, params, names = None, paginate = True, ids = None):
+    columns = [University.name, University.acceptance, University.tuition, University.gpa, University.lat, University.lng, Location.state]
+    if params.major:
+        columns.append(func.count(UniversityMajor.major_id))
+    query = session.query(*columns).select_from(University)
+    if params.state:
+        query = query.join(Location).filter(Location.state == params.state)
+    else:
+        query = query.outerjoin(Location)
+    if params.major:
+        if ids is None:
+            ids = major_ids(session, params.major)
+        query = query.join(UniversityMajor).filter(UniversityMajor.major_id.in_(ids)).group_by(University.id)
+    if params.tuition:
+        query = query.filter(University.tuition <= params.tuition).filter(University.tuition > 0.0)
+    if params.acceptance:
+        query = query.filter(*range_filters(University.acceptance, params.acceptance))
+    if params.gpa:
+        query = query.filter(*range_filters(University.gpa, params.gpa))
+    if names is not None:
+        query = query.filter(University.name.in_(names))
+    # by default results keep the order universities were scraped in, Princeton Review's ranking
+    if params.sort:
+        column = SORT_COLUMNS[params.sort.lstrip('-')]
+        query = query.order_by(column.desc() if params.sort.startswith('-') else column, University.id)
     else:
-        return 'Bad command, please try again.'
+        query = query.order_by(University.id)
+    if not paginate:
+        return query
+    return query.limit(params.limit).offset(params.offset)
+
+# bounded cache of search results keyed on SearchParams, least recently used entries are evicted first
+# and entries older than ttl seconds are ignored, results are plain namedtuples so they are safe to share
+class SearchCache:
+    def __init__(self, maxsize = 256, ttl = 300.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    # returns the cached results for key, or None
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or (self.ttl and time.monotonic() - entry[0] > self.ttl):
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return list(entry[1])
+
+    def put(self, key, results):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), tuple(results))
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last = False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'size' : len(self.entries), 'maxsize' : self.maxsize, 'hits' : self.hits, 'misses' : self.misses}
+
+
+SEARCH_CACHE = SearchCache()
+
+# forgets everything derived from the database's rows, called whenever a build changes them
+def data_changed():
+    SEARCH_CACHE.clear()
+    GEO_INDEXES.clear()
+    APP.__dict__.pop('snapshot', None)
+
+# takes a session, returns a value that changes whenever any process commits to its database, or None for an in-memory one
+# data_changed only runs in the process that made the change, so caches shared with a rebuilding process are keyed on this too
+# commits change the database file or, in wal mode, its log, so their modification times and sizes are enough
+def database_version(session):
+    url = session.get_bind().url
+    path = url.database
+    if not path or path == ':memory:':
+        return None
+    if url.query.get('uri'):
+        path = unquote(urlsplit(path).path)
+    version = []
+    for name in (path, path + '-wal'):
+        try:
+            stat = os.stat(name)
+            version.append((stat.st_mtime_ns, stat.st_size))
+        except(OSError):
+            version.append(None)
+    return tuple(version)
+
+# takes a query row, returns it as a SearchResult, or a (SearchResult, major count) pair for major searches
+def search_result(row, params, distance = None):
+    if params.major:
+        return (SearchResult(*row[:7], distance), row[7])
+    return SearchResult(*row, distance)
+
+# takes a SEARCH_CACHE key and a function running the search, returns the cached results or runs it and caches them
+def cached_search(key, search):
+    results = SEARCH_CACHE.get(key)
+    if results is not None:
+        METRICS.count('search.cache.hit')
+        return results
+    METRICS.count('search.cache.miss')
+    results = search()
+    SEARCH_CACHE.put(key, results)
+    return list(results)
+
+# takes SearchParams and runs them, returns a list of SearchResults, or of (SearchResult, major count) for major searches
+# repeated searches against the same database, unchanged since, are answered from SEARCH_CACHE
+def run_university_search(params, session = None):
+    session = session or APP.session
+
+    def search():
+        if params.near:
+            with METRICS.timer('search.near'):
+                return run_near_search(params, session)
+        with METRICS.timer('search.sql'):
+            return [search_result(row, params) for row in build_university_query(session, params)]
+
+    return cached_search((str(session.get_bind().url), database_version(session), params), search)
+
+# most names put in one IN (...) filter, more are looked up in chunks of this many
+MAX_NAME_FILTER = 500
+# where each of SORT_COLUMNS is in the rows build_university_query returns
+SORT_POSITIONS = {'name' : 0, 'acceptance' : 1, 'tuition' : 2, 'gpa' : 3, 'count' : 7}
+
+# takes SearchParams, names and their positions in scrape order, returns the query's rows for just those universities
+# in the query's order, looking the names up MAX_NAME_FILTER at a time so only the universities named are read
+def named_rows(session, params, position_by_name, ids = None):
+    names = list(position_by_name)
+    if len(names) <= MAX_NAME_FILTER:
+        return build_university_query(session, params, names, paginate = False, ids = ids).all()
+    rows = []
+    for start in range(0, len(names), MAX_NAME_FILTER):
+        rows.extend(build_university_query(session, params, names[start:start + MAX_NAME_FILTER], paginate = False, ids = ids))
+    # the chunks are put back in the order one query would have given: scrape order, then stably by the sort column,
+    # with missing values first going up and last going down like sqlite's
+    rows.sort(key = lambda row: position_by_name[row[0]])
+    if params.sort:
+        position = SORT_POSITIONS[params.sort.lstrip('-')]
+        rows.sort(key = lambda row: (row[position] is not None, row[position]), reverse = params.sort.startswith('-'))
+    return rows
+
+# takes SearchParams with near set, returns the closest matching universities
+# the spatial index finds universities within a radius, which grows until enough of them match the other filters
+def run_near_search(params, session):
+    names, index = geo_index(session)
+    wanted = params.offset + params.limit
+    limit = min(params.radius or MAX_DISTANCE_KM, MAX_DISTANCE_KM)
+    # the nearest universities are only enough when results are ordered by distance, a sorted search needs all of them
+    radius = limit if params.sort else min(limit, GEO_START_RADIUS_KM)
+    ids = major_ids(session, params.major) if params.major else None
+    while True:
+        positions, distances = index.within(params.near[0], params.near[1], radius)
+        distance_by_name = dict(zip(names[positions].tolist(), distances.tolist()))
+        rows = named_rows(session, params, dict(zip(names[positions].tolist(), positions.tolist())), ids)
+        if len(rows) >= wanted or radius >= limit:
+            break
+        radius = min(limit, radius * 4)
+    results = [search_result(row, params, distance_by_name[row[0]]) for row in rows]
+    # rows come back in scrape order (or the requested sort), a stable sort keeps that order between equal distances
+    if not params.sort:
+        results.sort(key = lambda result: result_distance(result))
+    return results[params.offset:params.offset + params.limit]
+
+def result_distance(result):
+    if isinstance(result, SearchResult):
+        return result.distance
+    return result[0].distance
+
+# takes validified university search, converts it to a query, and returns query results
+@timed('search.total')
+def process_university_search(command, session = None):
+    params = parse_university_search(command)
+    if params is None:
+        return BAD_COMMAND
+    if APP.use_snapshot and session is None:
+        # the snapshot is dropped along with SEARCH_CACHE when the data changes, see data_changed
+        def search():
+            with METRICS.timer('search.snapshot'):
+                return APP.snapshot.search(params)
+
+        return cached_search(('snapshot', str(APP.engine.url), params), search)
+    return run_university_search(params, session)
+
+### COLUMNAR SNAPSHOT ###
+
+# numeric University columns held in the snapshot
+SNAPSHOT_COLUMNS = ['acceptance', 'tuition', 'gpa', 'lat', 'lng']
+
+# read-only copy of every university as numpy arrays in scrape order: a float array per numeric column,
+# an array of state codes into states, and a packed bitmap with one row per major and one bit per university
+# searches, sorting, top-k and summary statistics all run as vectorized operations over it
+class UniversitySnapshot:
+    def __init__(self, names, columns, states, state_codes, major_names, major_bits):
+        self.names = names
+        self.columns = columns
+        self.states = states
+        self.state_codes = state_codes
+        self.state_index = {state : code for code, state in enumerate(states)}
+        self.major_names = major_names
+        self.major_bits = major_bits
+
+    # reads the University, Location and Major tables once and returns their snapshot
+    @classmethod
+    def load(cls, session):
+        import numpy as np
+        rows = session.query(University.id, University.name, University.acceptance, University.tuition, University.gpa, University.lat, University.lng, Location.state).outerjoin(Location).order_by(University.id).all()
+        names = np.array([row[1] for row in rows], dtype = object)
+        values = np.array([row[2:7] for row in rows], dtype = float).reshape(len(rows), len(SNAPSHOT_COLUMNS))
+        columns = {column : values[:, i].copy() for i, column in enumerate(SNAPSHOT_COLUMNS)}
+        states, state_codes = np.unique(np.array([row[7] or '' for row in rows], dtype = object), return_inverse = True)
+        # one bitmap row per distinct major, and another for each case the same university lists it in, so counts match sql
+        positions = {row[0] : i for i, row in enumerate(rows)}
+        rows_by_major = {}
+        seen = {}
+        university_positions = []
+        major_rows = []
+        for university_id, major in session.query(UniversityMajor.university_id, Major.major).join(Major):
+            if university_id not in positions:
+                continue
+            key = (university_id, major.lower())
+            seen[key] = seen.get(key, 0) + 1
+            major_key = (major.lower(), seen[key])
+            if major_key not in rows_by_major:
+                rows_by_major[major_key] = len(rows_by_major)
+            university_positions.append(positions[university_id])
+            major_rows.append(rows_by_major[major_key])
+        matrix = np.zeros((len(rows_by_major), len(names)), dtype = bool)
+        matrix[major_rows, university_positions] = True
+        major_names = [major for major, occurrence in rows_by_major]
+        return cls(names, columns, list(states), state_codes, major_names, np.packbits(matrix, axis = 1))
+
+    def __len__(self):
+        return len(self.names)
+
+    # takes a major search term, returns how many of each university's majors contain it
+    def major_counts(self, term):
+        import numpy as np
+        rows = [i for i, major in enumerate(self.major_names) if term in major]
+        if not rows:
+            return np.zeros(len(self), dtype = int)
+        return np.unpackbits(self.major_bits[rows], axis = 1, count = len(self)).sum(axis = 0)
+
+    # takes SearchParams, returns a boolean mask of matching universities and their major counts (None without major)
+    def mask(self, params):
+        import numpy as np
+        mask = np.ones(len(self), dtype = bool)
+        counts = None
+        if params.state:
+            mask &= self.state_codes == self.state_index.get(params.state, -1)
+        if params.major:
+            counts = self.major_counts(params.major)
+            mask &= counts > 0
+        tuition = self.columns['tuition']
+        with np.errstate(invalid = 'ignore'):
+            if params.tuition:
+                mask &= (tuition <= params.tuition) & (tuition > 0.0)
+            for column, value_range in (('acceptance', params.acceptance), ('gpa', params.gpa)):
+                if value_range:
+                    values = self.columns[column]
+                    low, high = value_range
+                    mask &= values > 0.0
+                    if low is not None:
+                        mask &= values >= low
+                    if high is not None:
+                        mask &= values <= high
+        return mask, counts
+
+    # takes the name of a column (or 'name'), returns its array
+    def column(self, name):
+        if name == 'name':
+            return self.names
+        return self.columns[name]
+
+    # spatial index over the university coordinates
+    @cached_property
+    def geo(self):
+        return GeoIndex(self.columns['lat'], self.columns['lng'])
+
+    # takes SearchParams with near set and the filter mask, returns positions of matching universities
+    # within a radius that grows until enough match, in scrape order, and their distances
+    def near(self, params, mask):
+        import numpy as np
+        wanted = params.offset + params.limit
+        limit = min(params.radius or MAX_DISTANCE_KM, MAX_DISTANCE_KM)
+        # like run_near_search, a sorted search starts at the full radius
+        radius = limit if params.sort else min(limit, GEO_START_RADIUS_KM)
+        while True:
+            positions, distances = self.geo.within(params.near[0], params.near[1], radius)
+            keep = mask[positions]
+            if keep.sum() >= wanted or radius >= limit:
+                break
+            radius = min(limit, radius * 4)
+        positions, distances = positions[keep], distances[keep]
+        order = np.argsort(positions)
+        return positions[order], distances[order]
+
+    # takes SearchParams, returns the same results run_university_search would, without touching the database
+    def search(self, params):
+        import numpy as np
+        mask, counts = self.mask(params)
+        distances = None
+        if params.near:
+            indexes, distances = self.near(params, mask)
+        else:
+            indexes = np.flatnonzero(mask)
+        if params.sort:
+            name = params.sort.lstrip('-')
+            values = counts[indexes] if name == 'count' else self.column(name)[indexes]
+            ranks = sort_ranks(values)
+            if params.sort.startswith('-'):
+                ranks = -ranks
+            # ties keep scrape order, like the sql ordering
+            order = np.lexsort((indexes, ranks))
+        elif params.near:
+            order = np.lexsort((indexes, distances))
+        else:
+            order = slice(None)
+        indexes = indexes[order][params.offset:params.offset + params.limit]
+        if params.near:
+            distances = distances[order][params.offset:params.offset + params.limit]
+        results = self.results(indexes, distances)
+        if params.major:
+            return list(zip(results, counts[indexes].tolist()))
+        return results
+
+    # takes university positions and optionally their distances, returns their SearchResults
+    def results(self, indexes, distances = None):
+        columns = [self.names[indexes].tolist()]
+        for column in SNAPSHOT_COLUMNS:
+            columns.append([None if value != value else value for value in self.columns[column][indexes].tolist()])
+        columns.append([self.states[code] or None for code in self.state_codes[indexes].tolist()])
+        columns.append(distances.tolist() if distances is not None else [None] * len(indexes))
+        return [SearchResult(*row) for row in zip(*columns)]
+
+    # takes a column name and k, returns the positions of the k universities with the highest (or lowest) values,
+    # optionally only among the given positions
+    def top_k(self, column, k, indexes = None, descending = True):
+        import numpy as np
+        if indexes is None:
+            indexes = np.arange(len(self))
+        values = self.column(column)[indexes]
+        keep = ~np.isnan(values)
+        indexes, values = indexes[keep], values[keep]
+        if descending:
+            values = -values
+        k = min(k, len(values))
+        if k == 0:
+            return indexes[:0]
+        nearest = np.argpartition(values, k - 1)[:k]
+        return indexes[nearest[np.argsort(values[nearest], kind = 'stable')]]
+
+    # takes a column name, returns its summary statistics, optionally only over the given positions
+    def summary(self, column, indexes = None, bins = 10):
+        values = self.column(column)
+        if indexes is not None:
+            values = values[indexes]
+        return column_summary(values, bins)
+
+# takes sort values, returns integer ranks that order the same way, with missing values first like sqlite
+def sort_ranks(values):
+    import numpy as np
+    if values.dtype == object:
+        return np.unique(values, return_inverse = True)[1].reshape(-1)
+    ranks = np.full(len(values), -1)
+    valid = ~np.isnan(values)
+    ranks[valid] = np.unique(values[valid], return_inverse = True)[1].reshape(-1)
+    return ranks
+
+# takes an array of values, returns count, mean, median, percentiles and histogram bins for the known ones
+# (0.0 is how the scraper records a missing tuition or gpa, so zeros are left out as well)
+def column_summary(values, bins = 10):
+    import numpy as np
+    values = values[~np.isnan(values) & (values != 0.0)]
+    if len(values) == 0:
+        return {'count' : 0}
+    p25, median, p75, p90 = np.percentile(values, [25, 50, 75, 90])
+    counts, edges = np.histogram(values, bins = bins)
+    return {'count' : int(len(values)), 'mean' : float(values.mean()), 'min' : float(values.min()), 'p25' : float(p25), 'median' : float(median), 'p75' : float(p75), 'p90' : float(p90), 'max' : float(values.max()), 'histogram' : {'counts' : counts.tolist(), 'edges' : edges.tolist()}}
+
+### GEOSPATIAL INDEX ###
+
+EARTH_RADIUS_KM = 6371.0088
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180.0
+# half way around the earth, no two points are further apart
+MAX_DISTANCE_KM = EARTH_RADIUS_KM * math.pi
+# size of the index's grid cells in degrees, and the first radius tried for near searches
+GEO_CELL_DEGREES = 1.0
+GEO_START_RADIUS_KM = 100.0
+
+# takes a point and arrays of latitudes and longitudes, returns the great-circle distance in km to each
+def haversine(lat, lng, lats, lngs):
+    import numpy as np
+    lat1, lng1 = math.radians(lat), math.radians(lng)
+    lat2, lng2 = np.radians(lats), np.radians(lngs)
+    a = np.sin((lat2 - lat1) / 2.0) ** 2 + math.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2.0) ** 2
+    return 2.0 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+# grid of cells GEO_CELL_DEGREES on a side, each holding the positions of the points inside it
+# radius searches only measure distances to points in cells overlapping the radius' bounding box
+# points without coordinates (missing or 0.0, as the map skips them) are left out
+class GeoIndex:
+    def __init__(self, lats, lngs, cell = GEO_CELL_DEGREES):
+        import numpy as np
+        self.lats = lats
+        self.lngs = lngs
+        self.cell = cell
+        self.columns = int(round(360.0 / cell))
+        with np.errstate(invalid = 'ignore'):
+            valid = ~(np.isnan(lats) | np.isnan(lngs)) & (lats != 0.0) & (lngs != 0.0)
+        positions = np.flatnonzero(valid)
+        cells = {}
+        for position, row, column in zip(positions.tolist(), np.floor(lats[positions] / cell).astype(int).tolist(), np.floor(lngs[positions] / cell).astype(int).tolist()):
+            cells.setdefault((row, self.wrap(column)), []).append(position)
+        self.cells = {key : np.array(value, dtype = int) for key, value in cells.items()}
+
+    # takes a grid column, returns the same column numbered within -180 to 180 degrees
+    def wrap(self, column):
+        half = self.columns // 2
+        return (column + half) % self.columns - half
+
+    # takes a point and radius in km, returns the grid cells that could hold points within the radius
+    def candidate_cells(self, lat, lng, radius):
+        angle = radius / EARTH_RADIUS_KM
+        low_lat, high_lat = lat - math.degrees(angle), lat + math.degrees(angle)
+        rows = range(math.floor(low_lat / self.cell), math.floor(high_lat / self.cell) + 1)
+        # the widest longitude span of the circle, everything if it reaches a pole
+        if low_lat <= -90.0 or high_lat >= 90.0 or math.sin(angle) >= math.cos(math.radians(lat)):
+            columns = None
+        else:
+            span = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(lat))))
+            first, last = math.floor((lng - span) / self.cell), math.floor((lng + span) / self.cell)
+            columns = None if last - first + 1 >= self.columns else {self.wrap(column) for column in range(first, last + 1)}
+        # look keys up directly when the box is small, otherwise scan the occupied cells
+        if columns is not None and len(rows) * len(columns) <= len(self.cells):
+            return [(row, column) for row in rows for column in columns if (row, column) in self.cells]
+        return [key for key in self.cells if key[0] in rows and (columns is None or key[1] in columns)]
+
+    # takes a point and radius in km, returns the positions of points within the radius and their distances
+    def within(self, lat, lng, radius):
+        import numpy as np
+        cells = self.candidate_cells(lat, lng, radius)
+        if not cells:
+            return np.zeros(0, dtype = int), np.zeros(0)
+        positions = np.concatenate([self.cells[key] for key in cells])
+        distances = haversine(lat, lng, self.lats[positions], self.lngs[positions])
+        keep = distances <= radius
+        return positions[keep], distances[keep]
+
+    # takes a point, returns the positions of the n closest points and their distances, closest first
+    def nearest(self, lat, lng, n):
+        import numpy as np
+        radius = GEO_START_RADIUS_KM
+        while True:
+            positions, distances = self.within(lat, lng, radius)
+            if len(positions) >= n or radius >= MAX_DISTANCE_KM:
+                break
+            radius = min(MAX_DISTANCE_KM, radius * 4)
+        order = np.lexsort((positions, distances))[:n]
+        return positions[order], distances[order]
+
+
+# spatial index over each database's coordinates for sql searches, keyed on the database url
+# each is kept with the database_version it was built at and rebuilt once the database changes
+GEO_INDEXES = {}
+
+# takes a session, returns the university names in scrape order and a GeoIndex over their coordinates
+def geo_index(session):
+    import numpy as np
+    key = str(session.get_bind().url)
+    version = database_version(session)
+    if key not in GEO_INDEXES or GEO_INDEXES[key][0] != version:
+        rows = session.query(University.name, University.lat, University.lng).order_by(University.id).all()
+        names = np.array([row[0] for row in rows], dtype = object)
+        coordinates = np.array([row[1:] for row in rows], dtype = float).reshape(len(rows), 2)
+        GEO_INDEXES[key] = (version, names, GeoIndex(coordinates[:, 0].copy(), coordinates[:, 1].copy()))
+    return GEO_INDEXES[key][1:]
+
+# takes search results, returns a dict of column name to numpy array, built in one pass
+def result_columns(results):
+    import numpy as np
+    # if user requests 'major=', results will be (university, count) pairs and not just universities
+    if not isinstance(results[0], SearchResult):
+        results = [result[0] for result in results]
+    names, acceptance, tuition, gpa, lat, lng, states, distances = zip(*results)
+    columns = {'name' : np.array(names, dtype = object), 'state' : np.array(states, dtype = object)}
+    for column, values in (('acceptance', acceptance), ('tuition', tuition), ('gpa', gpa), ('lat', lat), ('lng', lng)):
+        columns[column] = np.array(values, dtype = float)
+    return columns
     
+### JSON API ###
+
+# connections kept open by the read-only engine the api queries through
+READ_POOL_SIZE = 8
+# most results one api request returns, larger limits are cut down to this
+API_MAX_LIMIT = 100
+# responses smaller than this many bytes aren't worth compressing
+API_GZIP_MIN_SIZE = 500
+
+# takes a search result, returns it as a dict for json responses
+def result_json(result):
+    if isinstance(result, SearchResult):
+        university, count = result, None
+    else:
+        university, count = result
+    row = university._asdict()
+    if university.distance is None:
+        del row['distance']
+    if count is not None:
+        row['major_count'] = count
+    return row
+
+# takes an AppContext, returns a flask app serving its database as json
+# GET /universities takes the search parameters as query arguments, GET /universities/<name> returns one university
+# each request gets its own session from a pool of read-only connections, so requests don't wait on each other
+def create_app(context = None):
+    from flask import Flask, jsonify, request, url_for
+    from sqlalchemy.orm import scoped_session
+    context = context or APP
+    app = Flask(__name__)
+    app.config['JSON_SORT_KEYS'] = False
+    Session = scoped_session(sessionmaker(bind = context.read_engine))
+
+    def error(status, message):
+        response = jsonify({'error' : message})
+        response.status_code = status
+        return response
+
+    @app.route('/universities')
+    def search_universities():
+        # spaces in values become underscores, the way they're typed in the repl
+        arguments = ['_'.join(value.split()) for value in request.args.values()]
+        command = ' '.join(['search'] + [f'{key}={value}' for key, value in zip(request.args.keys(), arguments)])
+        params = parse_university_search(command.lower())
+        if params is None:
+            return error(400, BAD_COMMAND)
+        params = params._replace(limit = min(params.limit, API_MAX_LIMIT))
+        results = run_university_search(params, Session())
+        body = {'results' : [result_json(result) for result in results], 'limit' : params.limit, 'offset' : params.offset, 'next' : None}
+        # a full page may have more after it
+        if params.limit and len(results) == params.limit and 'nearest' not in request.args:
+            arguments = dict(request.args.items(), limit = params.limit, offset = params.offset + params.limit)
+            body['next'] = url_for('search_universities', **arguments)
+        return jsonify(body)
+
+    @app.route('/universities/<name>')
+    def get_university(name):
+        session = Session()
+        university = session.query(University).filter(University.name == name).first()
+        if university is None:
+            return error(404, f'No university named {name}.')
+        location = session.query(Location).filter(Location.university_id == university.id).first()
+        majors = [major for major, in session.query(Major.major).join(UniversityMajor).filter(UniversityMajor.university_id == university.id).order_by(text('"UniversityMajor".rowid'))]
+        body = {'name' : university.name, 'acceptance' : university.acceptance, 'tuition' : university.tuition, 'gpa' : university.gpa,
+                'lat' : university.lat, 'lng' : university.lng, 'majors' : majors}
+        if location is not None:
+            body.update({'address' : location.address, 'city' : location.city, 'state' : location.state, 'zip_code' : location.zip_code})
+        return jsonify(body)
+
+    # compresses the response if the client accepts gzip, then tags the body that is sent and
+    # answers 304 Not Modified if the client already has it
+    @app.after_request
+    def finish_response(response):
+        if response.status_code != 200 or response.direct_passthrough:
+            return response
+        response.vary.add('Accept-Encoding')
+        body = response.get_data()
+        if len(body) >= API_GZIP_MIN_SIZE and request.accept_encodings['gzip']:
+            response.set_data(gzip.compress(body))
+            response.headers['Content-Encoding'] = 'gzip'
+        response.cache_control.no_cache = True
+        response.add_etag()
+        return response.make_conditional(request)
+
+    @app.teardown_appcontext
+    def remove_session(exception):
+        Session.remove()
+
+    return app
+
+### BATCH QUERIES ###
+
+# formats batch results are written in
+BATCH_FORMATS = ('jsonl', 'csv')
+# columns of csv batch output, one row per result, a search without results gets one row with no name
+BATCH_COLUMNS = ['query', 'command', 'rank', 'name', 'acceptance', 'tuition', 'gpa', 'lat', 'lng', 'state', 'distance', 'major_count', 'error']
+
+# takes the lines of a batch file, yields the search commands in them, skipping blank lines and # comments
+def batch_commands(lines):
+    for line in lines:
+        command = line.strip().lower()
+        if command and not command.startswith('#'):
+            yield command
+
+# takes search commands, yields (command, results) for each in order, results are BAD_COMMAND for invalid commands
+# with workers > 1 the searches run on that many threads, each with its own read-only connection from the context's
+# read_engine, with at most workers * 4 of them running ahead of the results yielded
+def run_batch(commands, workers = 1, context = None):
+    context = context or APP
+    if workers <= 1:
+        for command in commands:
+            yield command, process_university_search(command, context.session)
+        return
+    Session = sessionmaker(bind = context.read_engine)
+    local = threading.local()
+    sessions = []
+
+    def search(command):
+        if not hasattr(local, 'session'):
+            local.session = Session()
+            sessions.append(local.session)
+        return process_university_search(command, local.session)
+
+    pending = deque()
+    try:
+        with ThreadPoolExecutor(max_workers = workers) as executor:
+            try:
+                for command in commands:
+                    pending.append((command, executor.submit(search, command)))
+                    while pending and (len(pending) > workers * 4 or pending[0][1].done()):
+                        command, future = pending.popleft()
+                        yield command, future.result()
+                while pending:
+                    command, future = pending.popleft()
+                    yield command, future.result()
+            finally:
+                # searches not started yet are dropped if the caller stops early
+                for command, future in pending:
+                    future.cancel()
+    finally:
+        for session in sessions:
+            session.close()
+
+# takes (command, results) pairs and a file, writes them to it as they arrive, returns the number of commands written
+# jsonl writes one object per command with its results, csv one row per result, see BATCH_COLUMNS
+# invalid commands and searches without results still get a line, so every command can be accounted for
+@timed('batch.write')
+def write_batch(batch, out, format = 'jsonl'):
+    writer = csv.DictWriter(out, BATCH_COLUMNS) if format == 'csv' else None
+    if writer:
+        writer.writeheader()
+    written = 0
+    for query, (command, results) in enumerate(batch):
+        rows = [] if results == BAD_COMMAND else [result_json(result) for result in results]
+        if writer is None:
+            line = {'query' : query, 'command' : command}
+            if results == BAD_COMMAND:
+                line['error'] = BAD_COMMAND
+            else:
+                line.update(count = len(rows), results = rows)
+            out.write(json.dumps(line) + '\n')
+        elif not rows:
+            writer.writerow({'query' : query, 'command' : command, 'error' : BAD_COMMAND if results == BAD_COMMAND else None})
+        else:
+            for rank, row in enumerate(rows, 1):
+                writer.writerow(dict(row, query = query, command = command, rank = rank))
+        written += 1
+    return written
+
+# runs the search commands in the file at path (- for stdin) and writes their results to stdout, see write_batch
+def batch_main(path, format = 'jsonl', workers = 1):
+    if not APP.database_exists():
+        print(f'{APP.database} does not exist, start the program without --batch to build it first.', file = sys.stderr)
+        return 1
+    try:
+        lines = sys.stdin if path == '-' else open(path, 'r')
+    except(OSError) as error:
+        print(f'Cannot read {path}: {error.strerror}.', file = sys.stderr)
+        return 1
+    try:
+        write_batch(run_batch(batch_commands(lines), workers), sys.stdout, format)
+    finally:
+        if lines is not sys.stdin:
+            lines.close()
+    return 0
+
 # takes user command and determines invalid input and which function to pass the command to for results, returns command results
 def process_command(command):
     components = command.split()
     results = []
     if len(components) == 0:
-        print('Bad command, please try again.')
+        print(BAD_COMMAND)
     elif components[0] == 'search':
         results = process_university_search(command.lower())
     else:
-        print('Bad command, please try again.')
-    if results == 'Bad command, please try again.':
+        print(BAD_COMMAND)
+    if results == BAD_COMMAND:
         print('\n' + results)
     elif len(results) == 0:
         print('\nNo results matched your parameters.')\
@@ -509,25 +2788,27 @@ def process_command(command):
         display_search_results(command, results)
     return results
     
-# setting up database for query use and accomadating for empty caches
-empty = False
-cwd = os.getcwd()
-if not database_exists(f'sqlite:///universities.db'):
-    empty = True
-if not os.path.exists(os.getcwd() +'\\University_htmls.txt'):
-    get_start_sites()
-engine = create_engine('sqlite:///universities.db', echo=False)
-Session = sessionmaker(bind=engine)
-session = Session()
-
 if __name__ == "__main__":   
-    # creates database if non-existent
-    if empty:
-        print('\nBuilding database...')
-        Base.metadata.create_all(engine)
-        create_database()
+    parser = argparse.ArgumentParser(description = 'Search universities from the Princeton Review, interactively or in batches.')
+    parser.add_argument('--batch', metavar = 'FILE', help = 'run the search commands in FILE (- for stdin), one per line, and write their results to stdout instead of starting the prompt')
+    parser.add_argument('--format', choices = BATCH_FORMATS, default = 'jsonl', help = 'format batch results are written in')
+    parser.add_argument('--workers', type = int, default = 1, help = 'batch searches run at once, each on its own read-only connection')
+    args = parser.parse_args()
+    if args.batch:
+        raise SystemExit(batch_main(args.batch, args.format, args.workers))
+    # the repl answers searches from the in-memory snapshot
+    APP.use_snapshot = True
+    # crawls and creates database if non-existent, or finishes a crawl that was interrupted
+    if not APP.database_exists() or pipeline_interrupted():
+        print('\nBuilding database, press Ctrl+C to stop and run again later to resume...')
+        try:
+            # links cached by an older version are built without crawling again
+            run_pipeline(num_pages = 0 if len(APP.links) > 0 and not pipeline_interrupted() else 11)
+        except(KeyboardInterrupt):
+            print('\nStopped, everything fetched so far is saved. Run again to resume.')
+            raise SystemExit
     command = ''
-    help = '\nOptions:\n\nEnter \'search\' followed by any combination of these parameters: \'state=\' followed by a state abbreviation, \'major=\' followed by a major with underscores where spaces would be, \'tuition=\' plus a number without commas, decimal points, or other symbols, or \'limit=\' plus a number to limit results by. Add \'gpa\' or \'acceptance\' to this search to have those statistics displayed in results.\n\nOnce you have results, enter \'map\' to map results, \'graph\' to see a bar graph of tuition, or \'distribution\' to see a distribution of tuition.\n\nEnter \'help\' to these options again.\n\nEnter \'quit\' to exit.  '
+    help = '\nOptions:\n\nEnter \'search\' followed by any combination of these parameters: \'state=\' followed by a state abbreviation, \'major=\' followed by a major with underscores where spaces would be, \'tuition=\' plus a number without commas, decimal points, or other symbols, \'limit=\' plus a number to limit results by, \'offset=\' plus a number of results to skip, \'acceptance=\' plus a maximum acceptance rate or a range like 10-30, \'gpa=\' plus a minimum average GPA or a range like 3.5-4.0, or \'sort=\' followed by name, tuition, acceptance, gpa or (with major=) count, with a \'-\' in front to sort descending, \'near=\' plus a latitude and longitude like 42.36,-71.06 to list the closest universities first, with \'radius=\' plus a distance in km to only include universities that close or \'nearest=\' plus how many of the closest universities to show. Add \'gpa\' or \'acceptance\' to this search to have those statistics displayed in results.\n\nOnce you have results, enter \'map\' to map results, \'graph\' to see a bar graph of tuition, \'distribution\' to see a distribution of tuition, or \'describe\' to see summary statistics of tuition, acceptance rate and GPA.\n\nEnter \'summary\' to see the same statistics for every university, kept up to date in the database so they take no searching, optionally followed by \'state=\' and/or \'major=\' (like \'summary state=NY major=computer_science\'), or by \'by=state\' or \'by=major\' to list the medians for every state or major.\n\nEnter \'rebuild\' to update the database from cached pages that changed since the last build, fetching any that are missing, or \'rebuild full\' to rebuild every row. Add \'offline\' to either to rebuild without using the network.\n\nEnter \'serve\' to serve searches as JSON over HTTP, optionally followed by a port (5000 by default): GET /universities takes the search parameters as query arguments, like /universities?state=NY&major=computer science, and GET /universities/<name> returns one university.\n\nEnter \'crawl\' to crawl the Princeton Review\'s browse pages into the database, loading each university as it is fetched, optionally followed by a number of browse pages (11 by default). A crawl stopped with Ctrl+C carries on from where it stopped the next time. Enter \'crawl refresh\' to also check every cached page for changes, reloading those that changed.\n\nEnter \'stats\' to see how many times, and how long, each stage (HTTP requests, parsing, geocoding, SQL, searches, rendering and plotting) has run, \'stats export\' followed by a file name to save them as JSON, or \'stats reset\' to start counting again. Enter \'sql echo\' to print every SQL statement with its time, \'sql slow\' followed by a number of ms to print only statements that slow, or \'sql off\' to stop.\n\nEnter \'help\' to these options again.\n\nEnter \'quit\' to exit.  '
     results = []
     print('\nEnter a command to get started or enter \'help\' for options and instructions.')
     while command != 'quit':
@@ -552,35 +2833,69 @@ if __name__ == "__main__":
             else:
                 print('\nLaunching tuition distribution...')
                 tuition_distrubution(results)
+        elif command == 'describe':
+            if type(results) == str or len(results) == 0:
+                print('\nNo results to describe, make a request first.')
+            else:
+                describe_results(results)
+        elif command.startswith('summary'):
+            if process_summary(command) == BAD_COMMAND:
+                print('\n' + BAD_COMMAND)
         elif command == 'help':
             print(help)
-        elif command == 'rebuild':
-            print('\nDeleting tables and rebuilding database...')
-            session.query(University).delete()
-            session.query(Location).delete()
-            session.query(Major).delete()
-            session.commit()
-            Base.metadata.create_all(engine)
-            create_database()
+        elif re.fullmatch(r'crawl( refresh)?( \d+)?', command):
+            numbers = [int(word) for word in command.split()[1:] if word.isdigit()]
+            num_pages = numbers[0] if numbers else 11
+            refresh = 'refresh' in command.split()
+            print(f'\nCrawling {num_pages} browse pages into the database{", revalidating cached pages" if refresh else ""}, press Ctrl+C to stop...')
+            try:
+                report = run_pipeline(num_pages, refresh = refresh)
+                print(f'\nAdded {len(report["added"])} and updated {len(report["updated"])} universities.')
+            except(KeyboardInterrupt):
+                print('\nStopped, enter \'crawl\' again to resume.')
+        elif command == 'stats':
+            print('\n' + METRICS.report())
+        elif command == 'stats reset':
+            METRICS.reset()
+            print('\nStatistics cleared.')
+        elif command.startswith('stats export ') and len(command.split()) == 3:
+            METRICS.export(command.split()[2])
+            print(f'\nStatistics written to {command.split()[2]}.')
+        elif command in ('sql echo', 'sql off') or (command.startswith('sql slow ') and len(command.split()) == 3):
+            try:
+                if command == 'sql echo':
+                    configure_sql_log(echo = True)
+                elif command == 'sql off':
+                    configure_sql_log()
+                else:
+                    configure_sql_log(slow_ms = float(command.split()[2]))
+            except(ValueError):
+                print('\nInvalid command, please try again.')
+        elif command.startswith('serve') and len(command.split()) <= 2:
+            try:
+                port = int(command.split()[1]) if len(command.split()) == 2 else 5000
+            except(ValueError):
+                print('\nInvalid port, please try again.')
+                continue
+            print(f'\nServing the JSON search API at http://127.0.0.1:{port}/universities, press Ctrl+C to stop...')
+            create_app().run(port = port, threaded = True)
+        elif command.startswith('rebuild') and set(command.split()[1:]) <= {'full', 'offline'}:
+            offline = 'offline' in command.split()
+            try:
+                if 'full' in command.split():
+                    print('\nDeleting tables and rebuilding database...')
+                    create_database(offline = offline, clear = True)
+                else:
+                    print('\nUpdating database from changed pages...')
+                    report = update_database(offline = offline)
+                    print(f'\nAdded {len(report["added"])}, updated {len(report["updated"])} and removed {len(report["removed"])} universities.')
+                    for change in ('added', 'updated', 'removed'):
+                        for name in report[change]:
+                            print(f'{change.capitalize()}: {name}')
+            except(CacheMissError) as error:
+                print(f'\n{error.args[0]} is not cached, database left unchanged.')
         elif command == 'quit':
             print('\nExiting program...')
         else:
             print('\nInvalid command, please try again.')
 
-
-
-# writing cache to file
-cache_dump = json.dumps(UNIVERSITIES)
-cache_contents = open('university_htmls.txt', 'w')
-cache_contents.write(cache_dump)
-cache_contents.close()
-
-cache_dump = json.dumps(UNIVERSITY_LIST)
-cache_contents = open('links_list.txt', 'w')
-cache_contents.write(cache_dump)
-cache_contents.close()
-
-cache_dump = json.dumps(GOOGLE_PLACES)
-cache_contents = open('google_places.txt', 'w')
-cache_contents.write(cache_dump)
-cache_contents.close()
\ No newline at end of file
@@ -0,0 +1,168 @@
+import argparse
+import gzip
+import hashlib
+import random
+import re
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+from final_project import StaticGeocoder, place_key
+from synthetic import SyntheticUniversities
+
+# local stand-in for the Princeton Review and Google Places, serving synthetic universities
+# browse pages at /college-search?page=n, university pages at /college/synthetic-<index>-<id> and
+# places results at /maps/api/place/textsearch/json?input=<name>, with optional latency and failures
+# university pages carry an etag and last-modified date and are answered with 304 when unchanged, and responses
+# are gzipped for clients that accept it, like the real site
+# run with --help to serve it from the command line
+
+UNIVERSITY_PATH = re.compile(r'^/college/synthetic-(\d+)-\d+$')
+PLACES_PATH = '/maps/api/place/textsearch/json'
+
+
+class FixtureHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        fixture = self.server.fixture
+        url = urlsplit(self.path)
+        kind = 'places' if url.path == PLACES_PATH else 'browse' if url.path == '/college-search' else 'university'
+        fixture.delay()
+        if fixture.fails():
+            fixture.count(kind, error = True)
+            return self.respond(503, 'text/plain', 'Service Unavailable')
+        fixture.count(kind)
+        query = parse_qs(url.query)
+        if kind == 'browse':
+            return self.respond(200, 'text/html', fixture.browse_page(int(query.get('page', ['1'])[0])))
+        if kind == 'places':
+            return self.respond(200, 'application/json', fixture.place(query.get('input', [''])[0]))
+        match = UNIVERSITY_PATH.match(url.path)
+        if match is None or int(match.group(1)) >= len(fixture.universities):
+            return self.respond(404, 'text/html', '<html><body>Not Found</body></html>')
+        page = fixture.universities.page(int(match.group(1)))
+        etag = '"' + hashlib.sha1(page.encode('utf-8')).hexdigest() + '"'
+        validators = {'ETag' : etag, 'Last-Modified' : fixture.last_modified}
+        if self.headers.get('If-None-Match') == etag:
+            fixture.count('university', not_modified = True)
+            return self.respond(304, 'text/html', '', validators)
+        return self.respond(200, 'text/html', page, validators)
+
+    def respond(self, status, content_type, body, headers = {}):
+        body = body.encode('utf-8')
+        gzipped = status != 304 and 'gzip' in self.headers.get('Accept-Encoding', '')
+        if gzipped:
+            body = gzip.compress(body)
+        self.send_response(status)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if gzipped:
+            self.send_header('Content-Encoding', 'gzip')
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+# serves count synthetic universities, per_page to a browse page, on a background thread
+# every response waits latency seconds (plus up to jitter more) and error_rate of them are 503 errors
+class FixtureServer:
+    def __init__(self, count = 1000, per_page = 25, latency = 0.0, jitter = 0.0, error_rate = 0.0, seed = 0, host = '127.0.0.1', port = 0):
+        self.universities = SyntheticUniversities(count, seed)
+        self.per_page = per_page
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = {'browse' : 0, 'university' : 0, 'places' : 0}
+        self.errors = {'browse' : 0, 'university' : 0, 'places' : 0}
+        # how many of those requests were answered with 304 not modified
+        self.not_modified = {'browse' : 0, 'university' : 0, 'places' : 0}
+        self.last_modified = formatdate(usegmt = True)
+        self.httpd = ThreadingHTTPServer((host, port), FixtureHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.fixture = self
+        self.url = f'http://{host}:{self.httpd.server_port}'
+        # base urls to set PRINCETON_REVIEW_URL and PLACES_URL to
+        self.princeton_review_url = self.url
+        self.places_url = self.url + PLACES_PATH
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target = self.httpd.serve_forever, daemon = True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exception):
+        self.stop()
+
+    def delay(self):
+        with self.lock:
+            wait = self.latency + self.random.uniform(0, self.jitter)
+        if wait > 0:
+            time.sleep(wait)
+
+    def fails(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def count(self, kind, error = False, not_modified = False):
+        with self.lock:
+            (self.errors if error else self.not_modified if not_modified else self.requests)[kind] += 1
+
+    # takes a page number, returns the browse page linking to its universities and the next page
+    def browse_page(self, page):
+        start = (page - 1) * self.per_page
+        indexes = range(max(0, start), min(len(self.universities), start + self.per_page))
+        links = ''.join(f'<div class="col-md-3"><a href="{self.universities.path(index)}">{self.universities.university(index)[0].name}</a></div>' for index in indexes)
+        return f'<html><body><div class="row">{links}</div><ul class="pagination"><li><a href="college-search?page={page - 1}">Previous</a></li><li><a href="college-search?page={page + 1}">Next</a></li></ul></body></html>'
+
+    # takes the name searched for, returns google places json for the university it names
+    def place(self, name):
+        match = re.search(r'(\d+)$', name.strip())
+        if match and int(match.group(1)) < len(self.universities):
+            record, lat, lng = self.universities.university(int(match.group(1)))
+            if place_key(record.name) == place_key(name) and lat is not None:
+                return StaticGeocoder({record.name : (lat, lng)}).lookup(record.name)
+        return StaticGeocoder({}).lookup(name)
+
+    def stats(self):
+        with self.lock:
+            return {'requests' : dict(self.requests), 'errors' : dict(self.errors), 'not_modified' : dict(self.not_modified)}
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Serve synthetic Princeton Review pages and Google Places results locally.')
+    parser.add_argument('--count', type = int, default = 1000, help = 'number of universities')
+    parser.add_argument('--per-page', type = int, default = 25, help = 'universities on each browse page')
+    parser.add_argument('--latency', type = float, default = 0.0, help = 'seconds every response waits')
+    parser.add_argument('--jitter', type = float, default = 0.0, help = 'up to this many more seconds, chosen at random')
+    parser.add_argument('--error-rate', type = float, default = 0.0, help = 'fraction of requests answered with 503')
+    parser.add_argument('--seed', type = int, default = 0)
+    parser.add_argument('--port', type = int, default = 8000)
+    args = parser.parse_args(argv)
+    server = FixtureServer(args.count, args.per_page, args.latency, args.jitter, args.error_rate, args.seed, port = args.port)
+    print(f'Serving {args.count} universities, point the crawler at them with:')
+    print(f'    export PRINCETON_REVIEW_URL={server.princeton_review_url}')
+    print(f'    export PLACES_URL={server.places_url}')
+    try:
+        server.httpd.serve_forever()
+    except(KeyboardInterrupt):
+        pass
+    finally:
+        server.httpd.server_close()
+
+if __name__ == '__main__':
+    main()
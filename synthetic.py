@@ -0,0 +1,129 @@
+import os
+import random
+import final_project
+from final_project import UniversityRecord, StaticGeocoder, content_hash, place_key, create_tables, set_load_pragmas, restore_pragmas, load_universities, suspend_major_search, resume_major_search, refresh_summaries, DATABASE
+from sqlalchemy import create_engine
+
+# synthetic universities shaped like the ones scraped from the Princeton Review, for benchmarks and load tests
+# every university is made from its index alone, so any one of them can be made without making the rest
+
+STATES = ['AL', 'AK', 'AZ', 'AR', 'CA', 'CO', 'CT', 'DC', 'DE', 'FL', 'GA', 'HI', 'ID', 'IL', 'IN', 'IA', 'KS', 'KY', 'LA', 'ME', 'MD', 'MA', 'MI', 'MN', 'MS', 'MO',
+          'MT', 'NE', 'NV', 'NH', 'NJ', 'NM', 'NY', 'NC', 'ND', 'OH', 'OK', 'OR', 'PA', 'RI', 'SC', 'SD', 'TN', 'TX', 'UT', 'VT', 'VA', 'WA', 'WV', 'WI', 'WY']
+KINDS = ['University', 'College', 'Institute of Technology', 'State University']
+
+# used when there is no scraped database to copy majors from
+MAJORS = ['Accounting', 'African American Studies', 'Anthropology', 'Applied Mathematics', 'Architecture', 'Art History', 'Astronomy', 'Biochemistry',
+          'Biology', 'Biomedical Engineering', 'Business Administration and Management', 'Chemical Engineering', 'Chemistry', 'Civil Engineering',
+          'Classics', 'Cognitive Science', 'Communication', 'Computer Engineering', 'Computer Science', 'Creative Writing', 'Criminal Justice',
+          'Dance', 'Economics', 'Education', 'Electrical Engineering', 'English Language and Literature', 'Environmental Science', 'Film Studies',
+          'Finance', 'French Language and Literature', 'Geology', 'History', 'International Relations', 'Journalism', 'Linguistics', 'Marketing',
+          'Mathematics', 'Mechanical Engineering', 'Music', 'Neuroscience', 'Nursing', 'Philosophy', 'Physics', 'Political Science and Government',
+          'Psychology', 'Public Health', 'Religious Studies', 'Sociology', 'Spanish Language and Literature', 'Statistics', 'Theatre', 'Urban Studies']
+
+# takes a database built from scraped pages, returns its distinct majors and each university's number of majors
+# falls back to MAJORS, most universities offering most of them, if there is no such database
+def major_distribution(source = DATABASE):
+    import sqlite3
+    if source and os.path.exists(source):
+        connection = sqlite3.connect(source)
+        try:
+            majors = [major for major, in connection.execute('SELECT DISTINCT major FROM Major ORDER BY major')]
+            fan_out = [count for count, in connection.execute('SELECT COUNT(*) FROM UniversityMajor GROUP BY university_id ORDER BY university_id')]
+        finally:
+            connection.close()
+        if majors and fan_out:
+            return majors, fan_out
+    generator = random.Random(0)
+    return MAJORS, [min(len(MAJORS), max(1, int(generator.lognormvariate(3.6, 0.5)))) for i in range(1000)]
+
+
+class SyntheticUniversities:
+    def __init__(self, count, seed = 0, source = DATABASE):
+        self.count = count
+        self.seed = seed
+        self.majors, self.fan_out = major_distribution(source)
+
+    def __len__(self):
+        return self.count
+
+    # takes an index, returns the path of the university's page
+    def path(self, index):
+        return f'/college/synthetic-{index}-{2000000 + index}'
+
+    # takes an index, returns the university's link under the current PRINCETON_REVIEW_URL
+    def link(self, index):
+        return final_project.PRINCETON_REVIEW_URL + self.path(index)
+
+    # takes an index, returns the university's (UniversityRecord, lat, lng), content_hash is left for page() to fill in
+    # a few universities have no tuition or coordinates, like the scraped ones
+    def university(self, index):
+        generator = random.Random(f'{self.seed}-{index}')
+        name = f'Synthetic {KINDS[index % len(KINDS)]} {index:06d}'
+        majors = generator.sample(self.majors, min(len(self.majors), generator.choice(self.fan_out)))
+        tuition = 0.0 if generator.random() < 0.03 else float(round(generator.uniform(5000, 60000), -1))
+        gpa = '%.2f' % generator.uniform(2.8, 4.3)
+        address = f'{generator.randint(1, 9999)} {generator.choice(["Main", "College", "University", "Campus", "Elm"])} Street'
+        city = f'City {generator.randint(1, 400)}'
+        record = UniversityRecord(self.link(index), name, float(generator.randint(4, 95)), tuition, gpa, majors, address, city,
+                                  generator.choice(STATES), '%05d' % generator.randint(1000, 99999), None)
+        if generator.random() < 0.01:
+            return record, None, None
+        return record, generator.uniform(25.0, 49.0), generator.uniform(-124.0, -67.0)
+
+    # takes an index, returns the university's page the way the Princeton Review lays it out
+    def page(self, index):
+        record, lat, lng = self.university(index)
+        major_items = ''.join(f'<li><h6>\n{major}\n</h6></li>' for major in record.majors)
+        return f'''<html><head><title>{record.name}</title><script>var page = "{record.name}";</script></head><body>
+        <h1><span itemprop="name">{record.name}</span></h1>
+        <div class="row"><h4>Overview</h4>
+            <div class="col-sm-4"><div class="bold">Applicants</div><div class="number-callout">{record.acceptance * 300:.0f}</div></div>
+            <div class="col-sm-4"><div class="bold">Acceptance Rate</div><div class="number-callout">{record.acceptance:.0f}%</div></div>
+            <div class="col-sm-4"><div class="bold">Average HS GPA</div><div class="number-callout">{record.gpa}</div></div>
+        </div>
+        <div class="row"><h4>Majors</h4><ul class="list-unstyled">{major_items}</ul></div>
+        <div class="row"><h4>Expenses per Academic Year</h4><div class="number-callout">${record.tuition:,.0f}</div></div>
+        <div class="row"><span itemprop="streetAddress"> {record.address} </span><span itemprop="addressLocality">{record.city}</span>
+            <span itemprop="addressRegion">{record.state}</span><span itemprop="postalCode">{record.zip_code}</span></div>
+        </body></html>'''
+
+    # yields (UniversityRecord, lat, lng) for every university, with the hash of its page
+    def located_records(self):
+        for index in range(self.count):
+            record, lat, lng = self.university(index)
+            yield record._replace(content_hash = content_hash(self.page(index))), lat, lng
+
+    # takes a path, writes a universities.db-shaped database of every university there the way create_database does
+    def write_database(self, path):
+        engine = create_engine('sqlite:///' + path, echo = False)
+        create_tables(engine)
+        with engine.connect() as connection:
+            saved_pragmas = set_load_pragmas(connection)
+            try:
+                with connection.begin():
+                    suspended = suspend_major_search(connection)
+                    load_universities(connection, self.located_records())
+                    resume_major_search(connection, suspended)
+                    refresh_summaries(connection)
+            finally:
+                restore_pragmas(connection, saved_pragmas)
+            connection.execute('ANALYZE')
+        engine.dispose()
+
+    # takes an AppContext, fills its page cache, links and google places cache with every university,
+    # so create_database and update_database can be run against it offline
+    def fill_cache(self, context, batch_size = 1000):
+        coordinates = {}
+        for start in range(0, self.count, batch_size):
+            pages = {}
+            for index in range(start, min(self.count, start + batch_size)):
+                record, lat, lng = self.university(index)
+                pages[record.link] = self.page(index)
+                if lat is not None:
+                    coordinates[record.name] = (lat, lng)
+            context.pages.update(pages)
+            context.links.extend(pages)
+        context.geocoder = StaticGeocoder(coordinates)
+        for start in range(0, self.count, batch_size):
+            names = [self.university(index)[0].name for index in range(start, min(self.count, start + batch_size))]
+            context.places.update({place_key(name) : context.geocoder.lookup(name) for name in names})
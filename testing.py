@@ -1,11 +1,967 @@
 from final_project import *
+import final_project
 import unittest
+import gzip
+import json
 import os
+import shutil
 import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# serves fake browse pages with 5 universities each and a pagination link, plus university pages
+class StandInHandler(BaseHTTPRequestHandler):
+    latency = 0.02
+    # every path requested, in order
+    paths = []
+    # requests waiting out their latency now, and the most there have been at once
+    # a request stops counting before its response is sent, so a client waiting on each response never overlaps two
+    lock = threading.Lock()
+    in_flight = 0
+    peak_in_flight = 0
+
+    def do_GET(self):
+        with StandInHandler.lock:
+            StandInHandler.paths.append(self.path)
+            StandInHandler.in_flight += 1
+            StandInHandler.peak_in_flight = max(StandInHandler.peak_in_flight, StandInHandler.in_flight)
+        time.sleep(self.latency)
+        with StandInHandler.lock:
+            StandInHandler.in_flight -= 1
+        if self.path.startswith('/college-search'):
+            page = int(self.path.split('page=')[-1]) if 'page=' in self.path else 1
+            links = ''.join(f'<div class="col-md-3"><a href="/college/school-{page}-{i}-100{page}{i:03}">School</a></div>' for i in range(5))
+            html = f'<html><body>{links}<ul class="pagination"><li><a href="college-search?page={page + 1}">Next</a></li></ul></body></html>'
+        else:
+            html = f'<html><body><span itemprop="name">{self.path}</span></body></html>'
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.end_headers()
+        self.wfile.write(html.encode())
+
+    def log_message(self, *args):
+        pass
+
+
+# builds a university page laid out like Princeton Review's, with every section the extractors read
+def university_page(name, acceptance, tuition, gpa, majors, address, city, state, zip_code):
+    major_items = ''.join(f'<li><h6>\n{major}\n</h6></li>' for major in majors)
+    return f'''<html><head><title>{name}</title><script>var page = "{name}";</script></head><body>
+        <h1><span itemprop="name">{name}</span></h1>
+        <div class="row"><h4>Overview</h4>
+            <div class="col-sm-4"><div class="bold">Applicants</div><div class="number-callout">{acceptance * 300:.0f}</div></div>
+            <div class="col-sm-4"><div class="bold">Acceptance Rate</div><div class="number-callout">{acceptance:.0f}%</div></div>
+            <div class="col-sm-4"><div class="bold">Average HS GPA</div><div class="number-callout">{gpa}</div></div>
+        </div>
+        <div class="row"><h4>Majors</h4><ul class="list-unstyled">{major_items}</ul></div>
+        <div class="row"><h4>Expenses per Academic Year</h4><div class="number-callout">${tuition:,}</div></div>
+        <div class="row"><span itemprop="streetAddress"> {address} </span><span itemprop="addressLocality">{city}</span>
+            <span itemprop="addressRegion">{state}</span><span itemprop="postalCode">{zip_code}</span></div>
+        </body></html>'''
+
+
+# context over a temporary database and page cache, holding two universities' pages
+def temporary_context():
+    directory = tempfile.mkdtemp()
+    context = AppContext(os.path.join(directory, 'universities.db'), os.path.join(directory, 'cache.db'))
+    context.geocoder = StaticGeocoder({}, default = (42.0, -76.0))
+    pages = {
+        'https://www.princetonreview.com/college/test-college-1000001' : university_page('Test College', 12, 45120, '3.91', ['Computer Science', 'History'], '1 College Way', 'Ithaca', 'NY', '14850'),
+        'https://www.princetonreview.com/college/sample-university-1000002' : university_page('Sample University', 64, 18300, '3.40', ['Biology', 'Computer Engineering', 'Music'], '200 Main Street', 'Austin', 'TX', '78712'),
+    }
+    for link, html in pages.items():
+        context.links.append(link)
+        context.pages[link] = html
+    return context
+
+# the scraped universities.db as it was before any test ran, see Test.setUpClass
+PRISTINE_DATABASE = os.path.join(tempfile.mkdtemp(), 'universities.db')
+
+# context over a copy of the scraped universities.db, so tests that change or rebuild the database can't affect each other
+def copied_context():
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'universities.db')
+    shutil.copy(PRISTINE_DATABASE, path)
+    return AppContext(path, os.path.join(directory, 'cache.db'))
+
+# makes context final_project.APP and sets the module settings given, for the length of the with block
+# the old APP and settings are put back and context is closed when the block ends, however it ends
+@contextmanager
+def app_context(context, **settings):
+    names = ['APP'] + list(settings)
+    saved = [getattr(final_project, name) for name in names]
+    final_project.APP = context
+    for name, value in settings.items():
+        setattr(final_project, name, value)
+    try:
+        yield context
+    finally:
+        for name, value in zip(names, saved):
+            setattr(final_project, name, value)
+        context.close()
 
 
 class Test(unittest.TestCase):
+
+    # every test runs against copies of universities.db, so the committed database is left as it is
+    @classmethod
+    def setUpClass(cls):
+        shutil.copy('universities.db', PRISTINE_DATABASE)
+        cls.saved_app = final_project.APP
+        final_project.APP = copied_context()
+
+    @classmethod
+    def tearDownClass(cls):
+        final_project.APP.close()
+        final_project.APP = cls.saved_app
+
+    def test_extraction(self):
+        with app_context(temporary_context(), LOAD_BATCH_SIZE = 2) as context:
+            link = list(context.links)[0]
+            #one pass over the page gives the same fields as the separate extractors
+            record = extract_university(link, context.pages[link])
+            self.assertEqual(record.name, 'Test College')
+            self.assertEqual((record.acceptance, record.tuition, record.gpa), (12.0, 45120.0, '3.91'))
+            self.assertEqual(record.majors, get_academics_data(link))
+            self.assertEqual(record.majors, ['Computer Science', 'History'])
+            self.assertEqual((record.address, record.city, record.state, record.zip_code), get_visit_data(link))
+            self.assertEqual(record.tuition, get_tuition_data(link))
+            #records come back in link order from the process pool
+            records = list(extract_universities(context.links, workers = 2))
+            self.assertEqual([record.name for record in records], ['Test College', 'Sample University'])
+            #database is built from the records, in batches smaller than the number of majors
+            Base.metadata.create_all(context.engine)
+            loaded = create_database(workers = 2)
+            self.assertEqual(loaded, 2)
+            self.assertEqual(context.session.query(UniversityMajor).count(), 5)
+            self.assertEqual(context.session.query(Major).count(), 5)
+            self.assertEqual(context.session.query(University.id).order_by(University.id).all(), [(1,), (2,)])
+            self.assertEqual(context.session.query(Location.state).join(University).filter(University.name == 'Sample University').scalar(), 'TX')
+            #the major search index is rebuilt after the load and its triggers put back
+            self.assertEqual(len(major_ids(context.session, 'computer')), 2)
+            self.assertEqual(context.engine.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'trigger'").scalar(), 3)
+            #admissions data comes from the cache
+            self.assertEqual(get_admissions_data(link), (12.0, '3.91', 'Test College'))
+
+    def test_offline_build(self):
+        with app_context(temporary_context()) as context:
+            Base.metadata.create_all(context.engine)
+            #a missing google places result fails the build and leaves the tables as they were
+            self.assertRaises(CacheMissError, create_database, 1, True)
+            self.assertEqual(context.session.query(University).count(), 0)
+            #a missing page fails before anything is fetched
+            context.links.append('https://www.princetonreview.com/college/missing-college-1000003')
+            self.assertRaises(CacheMissError, get_page, 'https://www.princetonreview.com/college/missing-college-1000003', True)
+            self.assertRaises(CacheMissError, create_database, 1, True)
+
+    def test_incremental_rebuild(self):
+        with app_context(temporary_context()) as context:
+            test_link, sample_link = list(context.links)
+            report = update_database(workers = 1)
+            self.assertEqual(report, {'added' : ['Test College', 'Sample University'], 'updated' : [], 'removed' : []})
+            #nothing changed
+            report = update_database(workers = 1)
+            self.assertEqual(report, {'added' : [], 'updated' : [], 'removed' : []})
+            #one page changed, one school dropped and one added
+            context.pages[test_link] = university_page('Test College', 15, 47000, '3.95', ['Computer Science'], '1 College Way', 'Ithaca', 'NY', '14850')
+            new_link = 'https://www.princetonreview.com/college/new-institute-1000004'
+            context.pages[new_link] = university_page('New Institute', 40, 30000, '3.60', ['Physics'], '9 Lab Road', 'Boston', 'MA', '02115')
+            context.links = [test_link, new_link]
+            report = update_database(workers = 1)
+            self.assertEqual(report, {'added' : ['New Institute'], 'updated' : ['Test College'], 'removed' : ['Sample University']})
+            session = context.session
+            self.assertEqual(session.query(University.tuition).filter(University.name == 'Test College').scalar(), 47000.0)
+            test_id = session.query(University.id).filter(University.name == 'Test College').scalar()
+            self.assertEqual(session.query(Major.major).join(UniversityMajor).filter(UniversityMajor.university_id == test_id).all(), [('Computer Science',)])
+            #only the universities left have locations and majors linked to them
+            self.assertEqual(session.query(Location).count(), 2)
+            self.assertEqual(session.query(UniversityMajor.university_id).distinct().count(), 2)
+            #an updated university keeps its id and a new one is numbered after it
+            self.assertEqual(test_id, 1)
+            self.assertTrue(session.query(University.id).filter(University.name == 'New Institute').scalar() > test_id)
+            #majors no university offers any more stay in Major, a major already there isn't added again
+            context.pages[new_link] = university_page('New Institute', 40, 30000, '3.60', ['Physics', 'Computer Science'], '9 Lab Road', 'Boston', 'MA', '02115')
+            self.assertEqual(update_database(workers = 1)['updated'], ['New Institute'])
+            self.assertEqual(session.query(Major).filter(Major.major == 'Computer Science').count(), 1)
+            self.assertEqual(session.query(UniversityMajor).count(), 3)
+            self.assertEqual(session.query(SourcePage).count(), 2)
+
+    def test_summaries(self):
+        with app_context(temporary_context()) as context:
+
+            def summaries():
+                return sorted((row.state, row.major_id, row.measure, row.universities, row.count, row.mean, row.median, row.max) for row in context.session.query(Summary))
+
+            test_link, sample_link = list(context.links)
+            create_database(workers = 1)
+            #every state, major and state x major pair is summarized, majors in lowercase
+            tuition = run_summary(SummaryParams('', '', None))[0][2]['tuition']
+            self.assertEqual((tuition['universities'], tuition['count'], tuition['min'], tuition['max']), (2, 2, 18300.0, 45120.0))
+            self.assertEqual(tuition['median'], (18300.0 + 45120.0) / 2)
+            groups = run_summary(SummaryParams('NY', 'computer science', None))
+            self.assertEqual(groups[0][2]['acceptance']['mean'], 12.0)
+            self.assertEqual([state for state, major, measures in run_summary(SummaryParams('', 'computer science', 'state'))], ['NY'])
+            self.assertEqual([major for state, major, measures in run_summary(SummaryParams('TX', '', 'major'))], ['biology', 'computer engineering', 'music'])
+            self.assertEqual(run_summary(SummaryParams('ZZ', '', None)), [])
+            #groups are kept under the major's id in Major, 0 standing for every major
+            major_ids = {major_id for major_id, in context.session.query(Summary.major_id).distinct()}
+            self.assertEqual(major_ids, {0} | {major_id for major_id, in context.session.query(Major.id)})
+            self.assertEqual(run_summary(SummaryParams('', 'underwater basketweaving', None)), [])
+            #percentiles match numpy's
+            values = [3.1, 0.0, None, 2.5, 4.0, 3.3, 3.9]
+            present = np.array([3.1, 2.5, 4.0, 3.3, 3.9])
+            count, mean, low, p25, median, p75, p90, high = value_summary(values)
+            self.assertEqual((count, low, high), (5, 2.5, 4.0))
+            for value, expected in zip((mean, p25, median, p75, p90), [present.mean()] + list(np.percentile(present, [25, 50, 75, 90]))):
+                self.assertAlmostEqual(value, expected)
+            #incremental updates leave the same summaries a full recompute does
+            update_database(workers = 1)
+            context.pages[test_link] = university_page('Test College', 15, 47000, '3.95', ['Computer Science', 'Physics'], '1 College Way', 'Austin', 'TX', '78701')
+            new_link = 'https://www.princetonreview.com/college/new-institute-1000004'
+            context.pages[new_link] = university_page('New Institute', 40, 30000, '3.60', ['Physics'], '9 Lab Road', 'Boston', 'MA', '02115')
+            context.links = [test_link, new_link]
+            update_database(workers = 1)
+            incremental = summaries()
+            with context.engine.begin() as connection:
+                refresh_summaries(connection)
+            context.session.expire_all()
+            self.assertEqual(incremental, summaries())
+            self.assertEqual(run_summary(SummaryParams('NY', '', None)), [])
+            self.assertEqual(run_summary(SummaryParams('', 'physics', None))[0][2]['tuition']['universities'], 2)
+            #the summary command
+            self.assertEqual(process_summary('summary state=tx major=computer_science')[0][:2], ('TX', 'computer science'))
+            self.assertEqual(len(process_summary('summary by=state')), 2)
+            self.assertEqual(process_summary('summary by=state state=TX'), BAD_COMMAND)
+            self.assertEqual(process_summary('summary tuition=5'), BAD_COMMAND)
+
+    def test_geocoding(self):
+        with app_context(temporary_context(), GEOCODE_BACKOFF = 1) as context:
+            #results cached under the old request urls are re-keyed by name
+            url = 'https://maps.googleapis.com/maps/api/place/textsearch/json?input=Test+College&inputtype=textquery&fields=location,name&key=old-key'
+            context.places[url] = StaticGeocoder({'Test College' : (42.44, -76.48)}).lookup('Test College')
+            migrate_places_cache(context.places)
+            self.assertEqual(list(context.places), ['test college'])
+            self.assertEqual(get_coordinates_for_university('Test  college', offline = True), (42.44, -76.48))
+            #lookups run concurrently, failures worth retrying are retried and every result is cached as it arrives
+            class FlakyGeocoder(StaticGeocoder):
+                def __init__(self, coordinates):
+                    StaticGeocoder.__init__(self, coordinates)
+                    self.calls = []
+                    self.lock = threading.Lock()
+                    # lookups running now, and the most there have been at once
+                    self.running = 0
+                    self.peak = 0
+                def lookup(self, name):
+                    with self.lock:
+                        self.calls.append(name)
+                        first = self.calls.count(name) == 1
+                        self.running += 1
+                        self.peak = max(self.peak, self.running)
+                    time.sleep(0.05)
+                    with self.lock:
+                        self.running -= 1
+                    if name == 'Flaky University' and first:
+                        raise GeocodeError('OVER_QUERY_LIMIT')
+                    if name == 'Down University':
+                        raise GeocodeError('UNKNOWN_ERROR')
+                    return StaticGeocoder.lookup(self, name)
+            names = ['School %d' % number for number in range(16)] + ['Flaky University', 'Down University', 'Test College', 'school 0']
+            context.geocoder = FlakyGeocoder({name : (float(number), -float(number)) for number, name in enumerate(names[:17])})
+            coordinates = geocode_universities(names, workers = 8)
+            self.assertTrue(2 <= context.geocoder.peak <= 8)
+            self.assertEqual(coordinates['School 3'], (3.0, -3.0))
+            self.assertEqual(coordinates['school 0'], (0.0, -0.0))
+            self.assertEqual(coordinates['Flaky University'], (16.0, -16.0))
+            self.assertEqual(coordinates['Down University'], (None, None))
+            self.assertEqual(coordinates['Test College'], (42.44, -76.48))
+            self.assertEqual(context.geocoder.calls.count('Flaky University'), 2)
+            self.assertEqual(context.geocoder.calls.count('Down University'), GEOCODE_ATTEMPTS)
+            self.assertFalse('Test College' in context.geocoder.calls)
+            self.assertEqual(len(context.places), 18)
+            self.assertFalse('down university' in context.places)
+            #offline builds use only the cache
+            self.assertRaises(CacheMissError, geocode_universities, ['Down University'], 1, True)
+
+    def test_migration(self):
+        #a database in the first layout, with a row in Major for every university's major and a major listed twice
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'universities.db')
+        connection = sqlite3.connect(path)
+        connection.executescript('''
+            CREATE TABLE "University" (name VARCHAR(32) NOT NULL, acceptance FLOAT, tuition FLOAT, gpa FLOAT, lat FLOAT, lng FLOAT, PRIMARY KEY (name));
+            CREATE TABLE "Major" (name VARCHAR(32), major VARCHAR(32), id INTEGER NOT NULL, PRIMARY KEY (id), FOREIGN KEY(name) REFERENCES "University" (name));
+            CREATE TABLE "Location" (name VARCHAR(32) NOT NULL, address VARCHAR(64), city VARCHAR(32), state VARCHAR(32), zip_code VARCHAR(32),
+                                     PRIMARY KEY (name), FOREIGN KEY(name) REFERENCES "University" (name));
+            INSERT INTO University VALUES ('Harvard College', 5.0, 46340.0, 4.18, 42.37, -71.12), ('Cornell University', 11.0, 52853.0, 4.07, 42.45, -76.48),
+                                          ('New York University', 28.0, 50464.0, 3.69, 40.73, -73.99);
+            INSERT INTO Major (name, major) VALUES ('Harvard College', 'Computer Science'), ('Harvard College', 'History'), ('Cornell University', 'Physics'),
+                                                   ('Cornell University', 'Computer Science'), ('Cornell University', 'Physics'), ('New York University', 'Computer Science and Engineering');
+            INSERT INTO Location VALUES ('Harvard College', '86 Brattle Street', 'Cambridge', 'MA', '02138'), ('Cornell University', '410 Thurston Avenue', 'Ithaca', 'NY', '14850'),
+                                        ('New York University', '383 Lafayette Street', 'New York', 'NY', '10003');
+        ''')
+        connection.close()
+        context = AppContext(path, os.path.join(directory, 'cache.db'))
+        with app_context(context):
+            #opening the database migrates it
+            connection = sqlite3.connect(path)
+            self.assertEqual(connection.execute('PRAGMA user_version').fetchone()[0], 0)
+            context.engine
+            self.assertEqual(connection.execute('PRAGMA user_version').fetchone()[0], SCHEMA_VERSION)
+            indexes = [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")]
+            for index in ('ix_UniversityMajor_major_id', 'ix_Location_state', 'ix_University_tuition'):
+                self.assertTrue(index in indexes)
+            self.assertFalse('ix_Major_name' in indexes)
+            #universities are numbered in the order they were scraped, each major is kept once and linked in the order it was listed
+            self.assertEqual(connection.execute('SELECT id, name FROM University ORDER BY id').fetchall(), [(1, 'Harvard College'), (2, 'Cornell University'), (3, 'New York University')])
+            self.assertEqual(connection.execute('SELECT major FROM Major ORDER BY id').fetchall(), [('Computer Science',), ('History',), ('Physics',), ('Computer Science and Engineering',)])
+            self.assertEqual(connection.execute('SELECT university_id, major_id FROM UniversityMajor ORDER BY rowid').fetchall(), [(1, 1), (1, 2), (2, 3), (2, 1), (3, 4)])
+            self.assertEqual(connection.execute("SELECT university_id, city FROM Location WHERE state = 'NY' ORDER BY university_id").fetchall(), [(2, 'Ithaca'), (3, 'New York')])
+            for table in ('University_old', 'Major_old', 'Location_old'):
+                self.assertEqual(connection.execute(f"SELECT COUNT(*) FROM sqlite_master WHERE name = '{table}'").fetchone()[0], 0)
+            #summaries are computed for the existing universities
+            self.assertEqual(connection.execute("SELECT universities FROM Summary WHERE state = '' AND major_id = 0 AND measure = 'tuition'").fetchone()[0], 3)
+            self.assertEqual(connection.execute("SELECT universities FROM Summary WHERE state = '' AND major_id = 3 AND measure = 'tuition'").fetchone()[0], 1)
+            #major searches through the full-text index match the same majors as LIKE, and find the universities offering them
+            like = [major_id for major_id, in connection.execute("SELECT id FROM Major WHERE major LIKE '%computer science%' ORDER BY id")]
+            self.assertEqual(major_ids(context.session, 'computer science'), like)
+            self.assertEqual(like, [1, 4])
+            results = run_university_search(parse_university_search('search major=computer_science state=ny'), context.session)
+            self.assertEqual([(result.name, count) for result, count in results], [('Cornell University', 1), ('New York University', 1)])
+            #triggers keep the index current
+            context.session.add(Major('Underwater Basketweaving'))
+            context.session.commit()
+            self.assertEqual(len(major_ids(context.session, 'basketweav')), 1)
+            connection.close()
+            #migrating again does nothing
+            migrate_database(context.engine)
+            self.assertEqual(context.session.query(UniversityMajor).count(), 5)
+
+    def test_search_cache(self):
+        SEARCH_CACHE.clear()
+        with app_context(copied_context()) as context:
+            hits, misses = SEARCH_CACHE.hits, SEARCH_CACHE.misses
+            results = process_university_search('search state=NY major=Computer_Science')
+            self.assertTrue(len(results) > 0)
+            #the same search, written differently, is a hit
+            cached = process_university_search('search major=computer_science state=ny')
+            self.assertEqual(cached, results)
+            self.assertEqual((SEARCH_CACHE.hits - hits, SEARCH_CACHE.misses - misses), (1, 1))
+            #changing a returned list doesn't change the cache
+            cached.clear()
+            self.assertEqual(process_university_search('search state=NY major=computer_science'), results)
+            #searches answered from the snapshot, as in the repl, are cached too
+            context.use_snapshot = True
+            hits, misses = SEARCH_CACHE.hits, SEARCH_CACHE.misses
+            results = process_university_search('search state=CA sort=-tuition')
+            self.assertEqual(process_university_search('search state=ca sort=-tuition'), results)
+            self.assertEqual((SEARCH_CACHE.hits - hits, SEARCH_CACHE.misses - misses), (1, 1))
+        #least recently used entries are evicted and old entries expire
+        cache = SearchCache(maxsize = 2, ttl = 0.05)
+        cache.put('a', [1])
+        cache.put('b', [2])
+        cache.get('a')
+        cache.put('c', [3])
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), ([1], None, [3]))
+        time.sleep(0.06)
+        self.assertEqual(cache.get('a'), None)
+        #rebuilding the database clears the cache
+        with app_context(temporary_context()) as context:
+            create_database(workers = 1)
+            self.assertEqual(len(process_university_search('search state=TX')), 1)
+            self.assertTrue(SEARCH_CACHE.stats()['size'] > 0)
+            test_link = list(context.links)[0]
+            context.pages[test_link] = university_page('Test College', 15, 47000, '3.95', ['Computer Science'], '1 College Way', 'Austin', 'TX', '78701')
+            update_database(workers = 1)
+            self.assertEqual(SEARCH_CACHE.stats()['size'], 0)
+            self.assertEqual(len(process_university_search('search state=TX')), 2)
+
+    def test_snapshot(self):
+        with app_context(copied_context()) as context:
+            snapshot = UniversitySnapshot.load(context.session)
+            self.assertEqual(len(snapshot), context.session.query(University).count())
+            #vectorized searches give the same results as sql
+            for command in ('search state=NY', 'search state=NY limit=15 offset=5', 'search tuition=20000', 'search major=computer_science',
+                            'search state=CA major=engineering tuition=50000 sort=-count', 'search acceptance=10-30 gpa=3.5 sort=name limit=50',
+                            'search major=history sort=-tuition limit=30', 'search state=ZZ', 'search gpa=3.9-4.5 sort=-acceptance limit=1000'):
+                params = parse_university_search(command)
+                self.assertEqual(snapshot.search(params), run_university_search(params), command)
+            #top k and summary statistics
+            top = snapshot.top_k('tuition', 5)
+            expected = [name for name, in context.session.query(University.name).order_by(University.tuition.desc()).limit(5)]
+            self.assertEqual(snapshot.names[top].tolist(), expected)
+            mask, counts = snapshot.mask(parse_university_search('search state=NY'))
+            summary = snapshot.summary('tuition', mask)
+            tuition = [tuition for tuition, in context.session.query(University.tuition).join(Location).filter(Location.state == 'NY').filter(University.tuition > 0)]
+            self.assertEqual(summary['count'], len(tuition))
+            self.assertAlmostEqual(summary['mean'], sum(tuition) / len(tuition))
+            self.assertEqual(summary['min'], min(tuition))
+            self.assertEqual(sum(summary['histogram']['counts']), len(tuition))
+            #results convert to columns for plotting
+            results = process_university_search('search major=computer_science state=NY')
+            columns = result_columns(results)
+            self.assertEqual(columns['name'].tolist(), [university.name for university, count in results])
+            self.assertEqual(columns['tuition'].dtype, float)
+
+    def test_near_search(self):
+        with app_context(copied_context()) as context:
+            #distances match a known pair: Harvard to Michigan State is about 1,090 km
+            distance = haversine(42.3770029, -71.1166601, np.array([42.701848]), np.array([-84.4821719]))[0]
+            self.assertTrue(1080 < distance < 1100)
+            #radius searches on the grid find exactly the points a full scan does
+            snapshot = UniversitySnapshot.load(context.session)
+            lats, lngs = snapshot.columns['lat'], snapshot.columns['lng']
+            for lat, lng, radius in ((42.36, -71.06, 50), (40.71, -74.0, 300), (37.77, -122.42, 2000), (21.3, -157.8, 5000), (64.8, -147.7, 20000)):
+                positions, distances = snapshot.geo.within(lat, lng, radius)
+                scan = np.flatnonzero((haversine(lat, lng, lats, lngs) <= radius) & (lats != 0.0) & (lngs != 0.0))
+                self.assertEqual(sorted(positions.tolist()), scan.tolist())
+            positions, distances = snapshot.geo.nearest(42.36, -71.06, 5)
+            self.assertEqual(len(positions), 5)
+            self.assertEqual(distances.tolist(), sorted(distances.tolist()))
+            #near searches combine with the other filters, sql and snapshot agree
+            for command in ('search near=42.36,-71.06 radius=50', 'search near=42.36,-71.06 nearest=5', 'search near=40.71,-74.0 radius=500 major=computer_science tuition=50000',
+                            'search near=34.05,-118.24 nearest=3 state=CA', 'search near=40.71,-74.0 radius=200 sort=-tuition limit=20', 'search near=0,0 radius=10'):
+                params = parse_university_search(command)
+                self.assertEqual(snapshot.search(params), run_university_search(params), command)
+            #a sorted near search ranks every university in the radius, not just the nearest ones
+            rows = context.session.query(University.name, University.tuition, University.lat, University.lng).order_by(University.id).all()
+            inside = [(name, tuition) for name, tuition, lat, lng in rows if lat and lng and tuition is not None and haversine(40.71, -74.0, np.array([lat]), np.array([lng]))[0] <= 500]
+            expected = [name for name, tuition in sorted(inside, key = lambda row: -row[1])[:5]]
+            params = parse_university_search('search near=40.71,-74.0 radius=500 sort=-tuition limit=5')
+            self.assertEqual([university.name for university in run_university_search(params)], expected)
+            self.assertEqual([university.name for university in snapshot.search(params)], expected)
+            self.assertTrue(max(university.distance for university in run_university_search(params)) > 100)
+            #more candidates than fit one IN (...) filter are looked up in chunks, giving the same results in the same order
+            commands = ('search near=40.71,-74.0 radius=500 sort=-tuition limit=30', 'search near=40.71,-74.0 radius=800 sort=name limit=40',
+                        'search near=40.71,-74.0 radius=800 major=engineering sort=-count limit=40', 'search near=40.71,-74.0 sort=gpa limit=50',
+                        'search near=40.71,-74.0 radius=800 limit=40')
+            expected = [run_near_search(parse_university_search(command), context.session) for command in commands]
+            saved_filter = final_project.MAX_NAME_FILTER
+            final_project.MAX_NAME_FILTER = 7
+            try:
+                for command, results in zip(commands, expected):
+                    self.assertEqual(run_near_search(parse_university_search(command), context.session), results, command)
+            finally:
+                final_project.MAX_NAME_FILTER = saved_filter
+            results = process_university_search('search near=42.36,-71.06 radius=50 limit=100')
+            self.assertTrue(len(results) > 0)
+            self.assertEqual([university.distance for university in results], sorted(university.distance for university in results))
+            self.assertTrue(all(university.distance <= 50 for university in results))
+            results = process_university_search('search near=42.36,-71.06 nearest=3 state=NY')
+            self.assertEqual(len(results), 3)
+            self.assertTrue(all(university.state == 'NY' for university in results))
+            self.assertEqual(process_university_search('search radius=50 state=NY'), BAD_COMMAND)
+            self.assertEqual(process_university_search('search near=95,0'), BAD_COMMAND)
+
+    def test_api(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'universities.db')
+        shutil.copy(PRISTINE_DATABASE, path)
+        context = AppContext(path, os.path.join(directory, 'cache.db'))
+        client = create_app(context).test_client()
+        try:
+            #searches take the repl's parameters and page through results
+            response = client.get('/universities?state=NY&major=computer science&limit=5')
+            self.assertEqual(response.status_code, 200)
+            body = response.get_json()
+            expected = run_university_search(parse_university_search('search state=NY major=computer_science limit=5'), context.session)
+            self.assertEqual([university['name'] for university in body['results']], [university.name for university, count in expected])
+            self.assertEqual(body['results'][0]['major_count'], expected[0][1])
+            next_page = client.get(body['next']).get_json()
+            self.assertEqual(next_page['offset'], 5)
+            expected = run_university_search(parse_university_search('search state=NY major=computer_science limit=5 offset=5'), context.session)
+            self.assertEqual([university['name'] for university in next_page['results']], [university.name for university, count in expected])
+            self.assertEqual(len(client.get('/universities?tuition=1000000&limit=5000').get_json()['results']), API_MAX_LIMIT)
+            self.assertTrue('distance' in client.get('/universities?near=42.36,-71.06&nearest=3').get_json()['results'][0])
+            self.assertEqual(client.get('/universities?state=NY&limit=-1').status_code, 400)
+            self.assertEqual(client.get('/universities').status_code, 400)
+            #one university
+            harvard = client.get('/universities/Harvard College').get_json()
+            self.assertEqual((harvard['state'], harvard['city']), ('MA', 'Cambridge'))
+            self.assertTrue(len(harvard['majors']) > 0)
+            self.assertEqual(client.get('/universities/No Such College').status_code, 404)
+            #unchanged responses aren't sent again
+            response = client.get('/universities?state=MA')
+            self.assertEqual(response.headers['Cache-Control'], 'no-cache')
+            etag = response.headers['ETag']
+            response = client.get('/universities?state=MA', headers = {'If-None-Match' : etag})
+            self.assertEqual((response.status_code, response.get_data()), (304, b''))
+            #large responses are compressed for clients that accept it
+            response = client.get('/universities?state=MA', headers = {'Accept-Encoding' : 'gzip'})
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertNotEqual(response.headers['ETag'], etag)
+            self.assertEqual(json.loads(gzip.decompress(response.get_data())), client.get('/universities?state=MA').get_json())
+            #concurrent requests each get their own read-only connection
+            results = {}
+            def search(state):
+                results[state] = client.get('/universities?state=' + state + '&limit=20').get_json()['results']
+            threads = [threading.Thread(target = search, args = (state,)) for state in ('NY', 'CA', 'MA', 'TX', 'PA', 'OH', 'IL', 'FL')]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            for state, rows in results.items():
+                self.assertTrue(len(rows) > 0)
+                self.assertTrue(all(row['state'] == state for row in rows))
+            self.assertEqual(context.read_engine.pool.checkedout(), 0)
+            self.assertRaises(exc.OperationalError, context.read_engine.execute, 'DELETE FROM University')
+            self.assertEqual(context.engine.execute('PRAGMA journal_mode').scalar(), 'wal')
+            #a rebuild by another process shows up in cached searches and near searches
+            nearest = client.get('/universities?near=42.36,-71.06&nearest=1').get_json()['results']
+            massachusetts = client.get('/universities?state=MA&limit=500').get_json()['results']
+            connection = sqlite3.connect(path)
+            connection.execute("INSERT INTO University (name, acceptance, tuition, gpa, lat, lng) VALUES ('Boston Test Institute', 50.0, 20000.0, 3.5, 42.36, -71.06)")
+            connection.execute("INSERT INTO Location (university_id, city, state) SELECT id, 'Boston', 'MA' FROM University WHERE name = 'Boston Test Institute'")
+            connection.commit()
+            connection.close()
+            self.assertNotEqual(nearest[0]['name'], 'Boston Test Institute')
+            self.assertEqual(client.get('/universities?near=42.36,-71.06&nearest=1').get_json()['results'][0]['name'], 'Boston Test Institute')
+            self.assertEqual(len(client.get('/universities?state=MA&limit=500').get_json()['results']), len(massachusetts) + 1)
+        finally:
+            context.close()
+
+    def test_batch(self):
+        import csv, io
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'universities.db')
+        shutil.copy(PRISTINE_DATABASE, path)
+        context = AppContext(path, os.path.join(directory, 'cache.db'))
+        lines = ['# tuition report', 'search state=NY major=computer_science limit=5', '', 'search state=ZZ', 'search limit=-1',
+                 'Search near=42.36,-71.06 nearest=3'] + [f'search tuition={tuition} limit=3' for tuition in range(20000, 60000, 1000)]
+        try:
+            #commands are run in order, skipping comments and blank lines
+            commands = list(batch_commands(lines))
+            self.assertEqual(len(commands), 44)
+            self.assertEqual(commands[3], 'search near=42.36,-71.06 nearest=3')
+            out = io.StringIO()
+            self.assertEqual(write_batch(run_batch(commands, context = context), out), 44)
+            rows = [json.loads(line) for line in out.getvalue().splitlines()]
+            expected = run_university_search(parse_university_search(commands[0]), context.session)
+            self.assertEqual([result['name'] for result in rows[0]['results']], [university.name for university, count in expected])
+            self.assertEqual(rows[0]['results'][0]['major_count'], expected[0][1])
+            self.assertEqual((rows[1]['count'], rows[1]['results']), (0, []))
+            self.assertEqual(rows[2]['error'], BAD_COMMAND)
+            self.assertEqual(len(rows[3]['results']), 3)
+            self.assertTrue('distance' in rows[3]['results'][0])
+            #parallel read-only connections give the same output, in the same order
+            SEARCH_CACHE.clear()
+            parallel = io.StringIO()
+            write_batch(run_batch(commands, workers = 4, context = context), parallel)
+            self.assertEqual(parallel.getvalue(), out.getvalue())
+            #csv has a row per result and a row for each command without results
+            out = io.StringIO()
+            write_batch(run_batch(commands, context = context), out, 'csv')
+            table = list(csv.DictReader(io.StringIO(out.getvalue())))
+            self.assertEqual(len(table), sum(max(1, row.get('count', 0)) for row in rows))
+            self.assertEqual((table[0]['query'], table[0]['rank'], table[0]['name']), ('0', '1', rows[0]['results'][0]['name']))
+            self.assertEqual((table[5]['query'], table[5]['name'], table[6]['error']), ('1', '', BAD_COMMAND))
+            #from the command line, reading stdin
+            path = os.pathsep.join([os.path.dirname(os.path.abspath(final_project.__file__))] + sys.path)
+            script = os.path.abspath(final_project.__file__)
+            output = subprocess.run([sys.executable, script, '--batch', '-', '--workers', '2'], input = '\n'.join(lines), cwd = directory,
+                                    env = dict(os.environ, PYTHONPATH = path), capture_output = True, text = True, check = True).stdout
+            self.assertEqual([json.loads(line)['command'] for line in output.splitlines()], commands)
+            #a batch file that can't be read is one line on stderr and exit status 1
+            missing = subprocess.run([sys.executable, script, '--batch', os.path.join(directory, 'missing.txt')], cwd = directory,
+                                     env = dict(os.environ, PYTHONPATH = path), capture_output = True, text = True)
+            self.assertEqual((missing.returncode, missing.stdout), (1, ''))
+            self.assertEqual(len(missing.stderr.strip().splitlines()), 1)
+            self.assertTrue('missing.txt' in missing.stderr)
+        finally:
+            context.close()
+
+    def test_render_results(self):
+        from jinja2 import Template
+        import io
+        for command in ('search state=ny tuition=50000 gpa acceptance', 'search major=computer_science state=ny', 'search near=42.36,-71.06 nearest=5 gpa'):
+            results = process_university_search(command)
+            template = 'html.html' if isinstance(results[0], SearchResult) else 'major_temp.html'
+            #pages are the same as rendering the whole template in one string
+            with open(template, 'r') as file:
+                expected = Template(file.read()).render(results = results, command = command, tuition = 'tuition' in command, is_university = template == 'html.html',
+                                                        gpa = 'gpa' in command, acceptance = 'acceptance' in command, distance = 'near=' in command)
+            out = io.StringIO()
+            render_search_results(command, results, out)
+            self.assertEqual(out.getvalue(), expected)
+        #templates are compiled once
+        self.assertTrue(final_project.APP.templates.get_template('html.html') is final_project.APP.templates.get_template('html.html'))
+        self.assertTrue(final_project.APP.templates.bytecode_cache is not None)
+        #rows are written as they are rendered instead of as one string
+        class Writer:
+            def __init__(self):
+                self.writes = 0
+                self.largest = 0
+            def writelines(self, chunks):
+                for chunk in chunks:
+                    self.writes += 1
+                    self.largest = max(self.largest, len(chunk))
+        results = [SearchResult('University %d' % number, 50.0, 30000.0, 3.5, 40.0, -75.0, 'NY') for number in range(10000)]
+        writer = Writer()
+        render_search_results('search tuition=50000 gpa acceptance limit=10000', results, writer)
+        self.assertTrue(writer.writes > 10000)
+        self.assertTrue(writer.largest < 1000)
+
+    def test_large_plots(self):
+        import plotly.graph_objs as go
+        #spread over the country, with a pile of universities on one spot
+        generator = np.random.RandomState(7)
+        lats = np.concatenate([generator.uniform(25, 49, 9000), np.full(1000, 42.36)])
+        lngs = np.concatenate([generator.uniform(-124, -67, 9000), np.full(1000, -71.06)])
+        results = [SearchResult('University %d' % number, 50.0, float(number), 3.5, lats[number], lngs[number], 'NY') for number in range(10000)]
+        columns = result_columns(results)
+        #the distribution is binned before plotting
+        figure = tuition_histogram(columns)
+        self.assertEqual(len(figure.data[0].y), PLOT_BINS)
+        self.assertEqual(sum(figure.data[0].y), 10000)
+        #the graph shows the most expensive universities and one bar for the rest
+        figure = tuition_bars(columns)
+        self.assertEqual(len(figure.data[0].x), PLOT_TOP_N + 1)
+        self.assertEqual(figure.data[0].x[0], 'University 9999')
+        self.assertEqual(figure.data[0].x[-1], 'Other (9950 universities, mean)')
+        self.assertAlmostEqual(figure.data[0].y[-1], 9949 / 2)
+        self.assertEqual(len(tuition_bars(result_columns(results[:10])).data[0].x), 10)
+        #the map clusters points past the limit and keeps every university in a cluster
+        figure = university_map(columns)
+        counts = figure.data[0].customdata
+        self.assertTrue(len(counts) <= PLOT_MAX_POINTS)
+        self.assertEqual(sum(counts), 10000)
+        self.assertTrue(max(counts) >= 1000)
+        self.assertEqual(len(university_map(result_columns(results[:100])).data[0].lat), 100)
+        #plots of the same results are made once
+        cache = FigureCache(tempfile.mkdtemp(), maxsize = 2)
+        made = []
+        def make_figure(columns):
+            made.append(len(columns['name']))
+            return tuition_histogram(columns)
+        path = cache.page('distribution', results, make_figure)
+        self.assertEqual(cache.page('distribution', list(results), make_figure), path)
+        self.assertEqual(made, [10000])
+        self.assertTrue(os.path.exists(path))
+        self.assertTrue(os.path.getsize(path) < 100000)
+        self.assertNotEqual(cache.page('distribution', results[:10], make_figure), path)
+        cache.page('graph', results, lambda columns: go.Figure())
+        self.assertFalse(os.path.exists(path))
+
+    def test_benchmark(self):
+        import benchmark
+        from synthetic import SyntheticUniversities
+        directory = tempfile.mkdtemp()
+        #synthetic databases are shaped like the scraped one, and the same seed gives the same data
+        universities = SyntheticUniversities(40, seed = 3)
+        self.assertEqual(SyntheticUniversities(40, seed = 3).university(7), universities.university(7))
+        universities.write_database(os.path.join(directory, 'synthetic.db'))
+        context = AppContext(os.path.join(directory, 'synthetic.db'), os.path.join(directory, 'cache.db'))
+        try:
+            self.assertEqual(context.session.query(University).count(), 40)
+            self.assertTrue(context.session.query(Major).count() >= 40)
+            self.assertEqual(context.engine.execute('PRAGMA user_version').scalar(), SCHEMA_VERSION)
+            major = universities.university(0)[0].majors[0]
+            self.assertTrue(len(major_ids(context.session, major.lower())) > 0)
+        finally:
+            context.close()
+        #synthetic pages parse back into the universities they were made from
+        record, lat, lng = universities.university(5)
+        self.assertEqual(extract_university(record.link, universities.page(5))._replace(content_hash = None), record)
+        #every filter combination is timed and the report is json
+        output = os.path.join(directory, 'report.json')
+        report = benchmark.main(['--scales', '40', '--build-scales', '20', '--runs', '1', '--workers', '1', '--crawl-pages', '1', '--crawl-per-page', '5', '--data-dir', directory, '--output', output])
+        with open(output) as report_file:
+            self.assertEqual(json.load(report_file), report)
+        searches = [entry for entry in report['results'] if entry['benchmark'] == 'search']
+        self.assertEqual(len(searches), 2 * (2 ** len(benchmark.SEARCH_FILTERS) - 1))
+        build = [entry for entry in report['results'] if entry['benchmark'] == 'create_database'][0]
+        self.assertEqual(build['rows'], 20)
+        self.assertEqual([entry['rows'] for entry in report['results'] if entry['benchmark'] == 'render'], benchmark.RENDER_SIZES)
+        self.assertEqual([(entry['benchmark'], entry['rows']) for entry in report['results'] if entry['benchmark'] in ('crawl', 'geocode')], [('crawl', 5), ('geocode', 5)])
+        #sql and the snapshot find the same number of rows
+        for sql, snapshot in zip(searches[0::2], searches[1::2]):
+            self.assertEqual((sql['filters'], sql['rows']), (snapshot['filters'], snapshot['rows']))
+        self.assertTrue(all(ratio == 1.0 for key, before, after, ratio in benchmark.compare_reports(report, report)))
+
+    def test_fixture_server(self):
+        from fixture_server import FixtureServer
+        with FixtureServer(count = 30, per_page = 10, latency = 0.01) as server, app_context(temporary_context(), PRINCETON_REVIEW_URL = server.princeton_review_url, GEOCODE_BACKOFF = 1) as context:
+            #browse pages lead to every university, and their pages parse back into the universities served
+            get_start_sites(3, workers = 4, rate = 0)
+            links = [link for link in context.links if link.startswith(server.url)]
+            self.assertEqual(links, [server.universities.link(index) for index in range(30)])
+            record = extract_university(links[12], context.pages[links[12]])
+            self.assertEqual(record._replace(content_hash = None), server.universities.university(12)[0])
+            #at most the browse page being read when the run stopped is read again
+            self.assertTrue(server.stats()['requests']['browse'] <= 4)
+            #places results come from the same universities
+            context.geocoder = GooglePlacesGeocoder(key = 'test-key', url = server.places_url)
+            names = [server.universities.university(index)[0].name for index in range(30)]
+            coordinates = geocode_universities(names + ['Nowhere College'], workers = 4)
+            for index, name in enumerate(names):
+                record, lat, lng = server.universities.university(index)
+                self.assertEqual(coordinates[name], (lat, lng))
+            self.assertEqual(coordinates['Nowhere College'], (None, None))
+            #injected failures are retried
+            server.error_rate = 0.3
+            context.places.clear()
+            coordinates = geocode_universities(names, workers = 4)
+            self.assertTrue(server.stats()['errors']['places'] > 0)
+            self.assertTrue(len(context.places) >= 25)
+            for index, name in enumerate(names):
+                if place_key(name) in context.places:
+                    self.assertEqual(coordinates[name], server.universities.university(index)[1:])
+            #a missing university is a 404
+            import requests
+            self.assertEqual(requests.get(server.url + '/college/synthetic-99-2000099').status_code, 404)
+
+    def test_http_client(self):
+        from fixture_server import FixtureServer
+        with FixtureServer(count = 5, per_page = 5) as server, app_context(temporary_context(), HTTP_ATTEMPTS = 8, HTTP_BACKOFF = 1) as context:
+            link = server.url + server.universities.path(2)
+            #pages are stored with their validators, and compressed on the wire
+            response = http_get(link)
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(fetch_page(link), server.universities.page(2))
+            etag, last_modified = context.pages.validators(link)
+            self.assertEqual(etag, response.headers['ETag'])
+            self.assertEqual(last_modified, server.last_modified)
+            #an unchanged page is revalidated with a 304, over the same pooled session
+            session = context.http
+            self.assertEqual(fetch_page(link), server.universities.page(2))
+            self.assertEqual(server.stats()['not_modified']['university'], 1)
+            self.assertTrue(context.http is session)
+            #a page without validators is fetched whole
+            context.pages[link] = 'stale'
+            self.assertEqual(context.pages.validators(link), (None, None))
+            self.assertEqual(fetch_page(link), server.universities.page(2))
+            self.assertEqual(server.stats()['not_modified']['university'], 1)
+            #failures are retried with backoff, and error pages raise without being cached
+            server.error_rate = 0.5
+            for index in range(5):
+                self.assertEqual(fetch_page(server.url + server.universities.path(index)), server.universities.page(index))
+            self.assertTrue(server.stats()['errors']['university'] > 0)
+            server.error_rate = 0.0
+            import requests
+            self.assertRaises(requests.HTTPError, fetch_page, server.url + '/college/synthetic-99-2000099')
+            self.assertFalse(server.url + '/college/synthetic-99-2000099' in context.pages)
+            self.assertEqual(http_get(server.url + '/college/synthetic-99-2000099').status_code, 404)
+            #stores made before validators were kept gain the columns when opened
+            path = os.path.join(tempfile.mkdtemp(), 'cache.db')
+            connection = sqlite3.connect(path)
+            connection.execute('CREATE TABLE pages (key TEXT PRIMARY KEY, body BLOB)')
+            connection.execute('INSERT INTO pages VALUES (?, ?)', ('a', zlib.compress(b'page a')))
+            connection.commit()
+            connection.close()
+            pages = PageStore(path, 'pages')
+            self.assertEqual((pages['a'], pages.validators('a')), ('page a', (None, None)))
+            pages.store('a', 'page a', '"1"', None)
+            self.assertEqual(pages.validators('a'), ('"1"', None))
+
+    def test_instrumentation(self):
+        #latency histograms and their percentiles
+        metrics = Metrics()
+        for seconds, times in ((0.0005, 90), (0.015, 9), (0.3, 1)):
+            for i in range(times):
+                metrics.observe('stage', seconds)
+        metrics.count('calls', 3)
+        stats = metrics.stats()
+        self.assertEqual(stats['counters'], {'calls' : 3})
+        timer = stats['timers']['stage']
+        self.assertEqual(timer['count'], 100)
+        self.assertEqual((timer['p50_ms'], timer['p90_ms'], timer['p99_ms']), (1, 1, 20))
+        self.assertAlmostEqual(timer['max_ms'], 300)
+        self.assertEqual((timer['buckets']['le_1'], timer['buckets']['le_20'], timer['buckets']['le_500']), (90, 9, 1))
+        #metrics from other processes merge in
+        other = Metrics()
+        other.observe('stage', 0.0005)
+        metrics.merge(other.drain())
+        self.assertEqual(metrics.stats()['timers']['stage']['count'], 101)
+        self.assertEqual(other.stats(), {'counters' : {}, 'timers' : {}})
+        path = os.path.join(tempfile.mkdtemp(), 'stats.json')
+        metrics.export(path)
+        with open(path) as stats_file:
+            self.assertEqual(json.load(stats_file)['timers']['stage']['count'], 101)
+        self.assertTrue('stage' in metrics.report())
+        #builds and searches are timed stage by stage, including parsing in the worker processes
+        with app_context(temporary_context()) as context:
+            METRICS.reset()
+            try:
+                #what was recorded before the build isn't counted again by the worker processes
+                METRICS.count('marker')
+                for i in range(5):
+                    METRICS.observe('before', 0.001)
+                create_database(workers = 2)
+                process_university_search('search state=NY', context.session)
+                process_university_search('search state=NY', context.session)
+                stats = METRICS.stats()
+                self.assertEqual((stats['counters']['marker'], stats['timers']['before']['count']), (1, 5))
+                for name in ('build.total', 'build.geocode', 'build.index', 'parse.page', 'parse.majors', 'sql.execute', 'sql.executemany', 'search.total', 'search.sql'):
+                    self.assertTrue(name in stats['timers'], name)
+                self.assertEqual(stats['timers']['parse.page']['count'], 2)
+                self.assertEqual((stats['counters']['search.cache.miss'], stats['counters']['search.cache.hit']), (1, 1))
+                #slow statements are logged when asked
+                log = os.path.join(tempfile.mkdtemp(), 'sql.log')
+                configure_sql_log(slow_ms = 0, path = log)
+                context.session.query(University).filter(University.name == 'Test College').all()
+                configure_sql_log(slow_ms = 1000000, path = log)
+                context.session.query(Location).all()
+                configure_sql_log()
+                context.session.query(Major).all()
+                with open(log) as log_file:
+                    lines = log_file.read().splitlines()
+                self.assertEqual(len(lines), 1)
+                self.assertTrue('slow' in lines[0] and 'FROM "University"' in lines[0] and 'Test College' in lines[0])
+                self.assertEqual(SQL_LOGGER.handlers, [])
+                #a statement that fails leaves no start time behind
+                with context.engine.connect() as connection:
+                    with self.assertRaises(exc.OperationalError):
+                        connection.execute('SELECT * FROM "Missing"')
+                    executed = METRICS.stats()['timers']['sql.execute']['count']
+                    connection.execute('SELECT 1')
+                    self.assertEqual(METRICS.stats()['timers']['sql.execute']['count'], executed + 1)
+                    self.assertFalse('statement_starts' in connection.info)
+            finally:
+                METRICS.reset()
+
+    def test_pipeline(self):
+        from fixture_server import FixtureServer
+        directory = tempfile.mkdtemp()
+        context = AppContext(os.path.join(directory, 'universities.db'), os.path.join(directory, 'cache.db'))
+        with FixtureServer(count = 30, per_page = 10) as server, app_context(context, PRINCETON_REVIEW_URL = server.princeton_review_url, PIPELINE_COMMIT_SIZE = 5, GEOCODE_BATCH_SIZE = 5) as context:
+            names = [server.universities.university(index)[0].name for index in range(30)]
+
+            #the crawl is interrupted while the 18th university is geocoded
+            class InterruptingGeocoder(StaticGeocoder):
+                def lookup(self, name):
+                    if name == names[17]:
+                        raise KeyboardInterrupt
+                    return StaticGeocoder.lookup(self, name)
+
+            context.geocoder = InterruptingGeocoder({name : (40.0, -75.0) for name in names})
+            self.assertRaises(KeyboardInterrupt, run_pipeline, 3, 4, 0, 1)
+            #everything committed before the interruption is kept
+            loaded = [name for name, in context.session.query(University.name).order_by(text('"University".rowid'))]
+            self.assertEqual(loaded, names[:15])
+            self.assertTrue(pipeline_interrupted())
+            fetched = server.stats()['requests']['university']
+            self.assertTrue(fetched >= 18)
+            #running again resumes, without fetching pages again or reloading universities
+            context.geocoder = StaticGeocoder({name : (40.0, -75.0) for name in names})
+            report = run_pipeline(3, 4, 0, 1)
+            self.assertEqual(report, {'added' : names[15:], 'updated' : []})
+            self.assertEqual(server.stats()['requests']['university'], 30)
+            #at most the browse page being read when the run stopped is read again
+            self.assertTrue(server.stats()['requests']['browse'] <= 4)
+            self.assertFalse(pipeline_interrupted())
+            loaded = [name for name, in context.session.query(University.name).order_by(text('"University".rowid'))]
+            self.assertEqual(loaded, names)
+            self.assertEqual(context.session.query(SourcePage).count(), 30)
+            self.assertEqual(context.session.query(UniversityMajor).join(University).filter(University.name == names[20]).count(), len(server.universities.university(20)[0].majors))
+            #a finished crawl has nothing left to do
+            self.assertEqual(run_pipeline(3, 4, 0, 1), {'added' : [], 'updated' : []})
+            #refreshing revalidates every page, getting 304s for the unchanged ones
+            self.assertEqual(run_pipeline(3, 4, 0, 1, refresh = True), {'added' : [], 'updated' : []})
+            self.assertEqual(server.stats()['not_modified']['university'], 30)
+            self.assertEqual(server.stats()['requests']['university'], 60)
+            #a finished crawl walks the browse pages again, so universities listed on them since are found
+            browse = server.stats()['requests']['browse']
+            server.universities.count, server.per_page = 40, 12
+            report = run_pipeline(3, 4, 0, 1)
+            self.assertEqual(report['added'], [server.universities.university(index)[0].name for index in range(30, 36)])
+            self.assertEqual(server.stats()['requests']['browse'], browse + 3)
+            #crawling further only loads the new universities
+            report = run_pipeline(4, 4, 0, 1)
+            self.assertEqual(report['added'], [server.universities.university(index)[0].name for index in range(36, 40)])
+
+    def test_concurrent_scraping(self):
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        threading.Thread(target = server.serve_forever, daemon = True).start()
+        saved = final_project.PRINCETON_REVIEW_URL, final_project.APP.pages, final_project.APP.links
+        final_project.PRINCETON_REVIEW_URL = f'http://127.0.0.1:{server.server_port}'
+        try:
+            #serial crawl
+            final_project.APP.pages, final_project.APP.links = {}, []
+            StandInHandler.peak_in_flight = 0
+            serial_pages = get_start_sites(2)
+            serial_list = final_project.APP.links
+            self.assertEqual(StandInHandler.peak_in_flight, 1)
+            #concurrent crawl fills the same caches
+            final_project.APP.pages, final_project.APP.links = {}, []
+            del StandInHandler.paths[:]
+            StandInHandler.peak_in_flight = 0
+            pages = get_start_sites(2, workers = 8, rate = 1000, max_in_flight = 4)
+            self.assertEqual(pages, serial_pages)
+            self.assertEqual(final_project.APP.links, serial_list)
+            self.assertEqual(len(final_project.APP.links), 10)
+            #each university's page is fetched and cached once, under its link without a fragment
+            self.assertEqual(sorted(final_project.APP.pages), sorted(serial_list))
+            self.assertEqual(len(StandInHandler.paths), 12)
+            self.assertEqual(len(set(StandInHandler.paths)), 12)
+            #pages are fetched side by side, never more at once than max_in_flight
+            self.assertTrue(1 < StandInHandler.peak_in_flight <= 4)
+            #rate limit spaces requests to one host
+            limiter = RateLimiter(rate = 20)
+            start = time.time()
+            for i in range(5):
+                limiter.wait(final_project.PRINCETON_REVIEW_URL)
+            self.assertTrue(time.time() - start >= 0.19)
+        finally:
+            final_project.PRINCETON_REVIEW_URL, final_project.APP.pages, final_project.APP.links = saved
+            server.shutdown()
+            server.server_close()
       
+    def test_page_store(self):
+        path = os.path.join(tempfile.mkdtemp(), 'cache.db')
+        pages = PageStore(path, 'pages')
+        links = LinkList(path, 'links')
+        html = '<div class="row">' * 1000
+        pages['a'] = html
+        links.append('b')
+        links.append('a')
+        links.append('b')
+        #pages are written as soon as they are set and survive reopening
+        reopened = PageStore(path, 'pages')
+        self.assertTrue('a' in reopened)
+        self.assertFalse('b' in reopened)
+        self.assertEqual(reopened['a'], html)
+        self.assertEqual(list(LinkList(path, 'links')), ['b', 'a'])
+        #bodies are compressed on disk
+        body = sqlite3.connect(path).execute('SELECT body FROM pages').fetchone()[0]
+        self.assertTrue(len(body) < len(html) / 10)
+        #old json caches are imported once
+        old_cache = os.path.join(os.path.dirname(path), 'old.txt')
+        with open(old_cache, 'w') as f:
+            f.write(json.dumps({'c' : 'page c'}))
+        places = PageStore(path, 'places')
+        import_json_cache(old_cache, places)
+        self.assertEqual(dict(places), {'c' : 'page c'})
+        #pages cached once per fragment are collapsed into one page under the canonical link
+        link = 'https://www.princetonreview.com/college/test-college-1000001'
+        old_pages = PageStore(path, 'old_pages')
+        old_pages.update({link + sub_page : html for sub_page in ('', '#!academics', '#!tuition', '#!studentbody', '#!visiting')})
+        old_pages.update({'https://www.princetonreview.com/college/other-1000002#!visiting' : 'other page'})
+        migrate_page_cache(old_pages)
+        self.assertEqual(dict(old_pages), {link : html, 'https://www.princetonreview.com/college/other-1000002' : 'other page'})
+        self.assertEqual(canonical_url(link + '#!tuition'), link)
+
+    def test_import(self):
+        #importing opens no caches or database and skips the heavy modules
+        directory = tempfile.mkdtemp()
+        script = 'import sys, final_project; print(sorted(m for m in ("requests", "bs4", "plotly", "numpy", "jinja2", "flask") if m in sys.modules))'
+        path = os.pathsep.join([os.path.dirname(os.path.abspath(final_project.__file__))] + sys.path)
+        output = subprocess.run([sys.executable, '-c', script], cwd = directory, env = dict(os.environ, PYTHONPATH = path), capture_output = True, text = True, check = True).stdout
+        self.assertEqual(output.strip(), '[]')
+        self.assertEqual(os.listdir(directory), [])
+        #the context opens its members on first use
+        context = AppContext(os.path.join(directory, 'test.db'), os.path.join(directory, 'cache.db'))
+        self.assertFalse(context.database_exists())
+        self.assertEqual(len(context.links), 0)
+        self.assertTrue(os.path.exists(os.path.join(directory, 'cache.db')))
+        context.close()
+
     def test_process_command(self):
         #bad command
         results = process_command('adhoasj=ajsd')
@@ -34,17 +990,15 @@ class Test(unittest.TestCase):
         results = process_university_search('search state=NY tuition=50000 major=computer_science')
         university = results[0][0]        
         majors = results[0][1]
-        engine = create_engine('sqlite:///universities.db', echo=False)
-        Session = sessionmaker(bind=engine)
-        session = Session()
-        count = session.query(University.name).join(Major).filter(Major.major.like('%computer science%')).filter(University.name == university.name).all()
-        self.assertEqual(university.location[0].state,'NY')
+        session = final_project.APP.session
+        count = session.query(University.name).join(UniversityMajor).join(Major).filter(Major.major.like('%computer science%')).filter(University.name == university.name).all()
+        self.assertEqual(university.state,'NY')
         self.assertTrue(university.tuition <= 50000)
         self.assertEqual(len(count), majors)
         #state and tuition
         results = process_university_search('search state=NY tuition=20000')
         university = results[1]
-        self.assertEqual(university.location[0].state,'NY')
+        self.assertEqual(university.state,'NY')
         self.assertTrue(university.tuition <= 20000)
         #tuition
         results = process_university_search('search tuition=20000')
@@ -53,7 +1007,28 @@ class Test(unittest.TestCase):
         #state
         results = process_university_search('search state=NY')
         university = results[1]
-        self.assertTrue(university.location[0].state == 'NY')
+        self.assertTrue(university.state == 'NY')
+        #acceptance and gpa ranges
+        results = process_university_search('search acceptance=10-30 gpa=3.5 limit=100')
+        self.assertTrue(len(results) > 0)
+        for university in results:
+            self.assertTrue(10 <= university.acceptance <= 30)
+            self.assertTrue(university.gpa >= 3.5)
+        #limit, offset and sorting are applied in the query
+        results = process_university_search('search state=NY sort=-tuition limit=5')
+        tuition = [university.tuition for university in results]
+        self.assertEqual(tuition, sorted(tuition, reverse = True))
+        page = process_university_search('search state=NY sort=-tuition limit=2 offset=3')
+        self.assertEqual(page, results[3:5])
+        results = process_university_search('search major=computer_science tuition=40000 sort=-count limit=20')
+        counts = [count for university, count in results]
+        self.assertEqual(counts, sorted(counts, reverse = True))
+        for university, count in results:
+            self.assertTrue(0 < university.tuition <= 40000)
+        #filter values are bound, not pasted into the sql
+        self.assertEqual(process_university_search("search state=ny'_or_1=1"), [])
+        self.assertEqual(process_university_search("search major=x'_or_'1'='1"), [])
+        self.assertEqual(process_university_search('search sort=tuition'), BAD_COMMAND)
     
     def test_universities_data(self):
         harvard_link = 'https://www.princetonreview.com/college/harvard-college-1022984'
@@ -97,33 +1072,32 @@ class Test(unittest.TestCase):
         self.assertEqual(university_name, 'Michigan State University')
   
     def test_create_universities(self):
-        #call function
-        engine = create_engine('sqlite:///universities.db', echo=False)
-        Session = sessionmaker(bind=engine)
-        session = Session()
-        session.query(University).delete()
-        session.query(Location).delete()
-        session.query(Major).delete()
-        session.commit()
-        Base.metadata.create_all(engine)
-        create_database()
-        #test tables   
-        count = session.query(func.count(Major.major)).all()[0][0]
-        print(count)
-        self.assertTrue(count > 0)
-        count = session.query(func.count(University.name)).all()[0][0]
-        self.assertTrue(count > 0)
-        count = session.query(func.count(Location.name)).all()[0][0]
-        self.assertTrue(count> 0)
+        with app_context(copied_context()) as context:
+            #call function
+            session = context.session
+            session.query(University).delete()
+            session.query(Location).delete()
+            session.query(UniversityMajor).delete()
+            session.query(Major).delete()
+            session.commit()
+            create_database()
+            #test tables   
+            count = session.query(func.count(UniversityMajor.major_id)).all()[0][0]
+            print(count)
+            self.assertTrue(count > 0)
+            count = session.query(func.count(University.name)).all()[0][0]
+            self.assertTrue(count > 0)
+            count = session.query(func.count(Location.university_id)).all()[0][0]
+            self.assertTrue(count> 0)
 
     def test_scraping(self):
         #call for one page
         pages = get_start_sites(1)
         #check for link from first page in pages
-        self.assertTrue("https://www.princetonreview.com/college/harvard-college-1022984#!visiting" in pages)
+        self.assertTrue("https://www.princetonreview.com/college/harvard-college-1022984" in pages)
         pages = get_start_sites(3)
         #check for link from second and third page in pages
-        self.assertTrue('https://www.princetonreview.com/college/university-michigan--ann-arbor-1023092#!visiting' in pages)
-        self.assertTrue('https://www.princetonreview.com/college/university-maryland--college-park-1022953#!visiting' in pages)
+        self.assertTrue('https://www.princetonreview.com/college/university-michigan--ann-arbor-1023092' in pages)
+        self.assertTrue('https://www.princetonreview.com/college/university-maryland--college-park-1022953' in pages)
     
 unittest.main()